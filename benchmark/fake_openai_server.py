@@ -0,0 +1,94 @@
+"""
+Local stand-in for the OpenAI chat completions API, streams a canned answer at a configurable speed.
+
+Run it and point the bot at it with openai_api_base_url: "http://localhost:8000/v1":
+
+    python benchmark/fake_openai_server.py --port 8000 --tokens-per-second 50 --latency 0.3
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+DEFAULT_ANSWER = (
+    "Sure! Here is a short answer streamed by the fake OpenAI server. "
+    "It is split into words so that every word arrives as a separate chunk, "
+    "just like tokens of a real completion. "
+)
+
+
+def make_app(tokens_per_second: float = 50, latency: float = 0.3, answer: str = DEFAULT_ANSWER,
+             answer_repeat: int = 1) -> web.Application:
+    """
+    latency is the delay before the first chunk, tokens_per_second the speed of the following ones
+    """
+    tokens = [word + " " for word in (answer * answer_repeat).split()]
+    stats = {"requests": 0, "disconnects": 0}
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        stats["requests"] += 1
+        payload = await request.json()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(delta: dict, finish_reason: str = None) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": payload.get("model", "gpt-3.5-turbo"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        try:
+            await asyncio.sleep(latency)
+            await response.write(chunk({"role": "assistant"}))
+            for token in tokens:
+                await response.write(chunk({"content": token}))
+                await asyncio.sleep(1 / tokens_per_second)
+            await response.write(chunk({}, finish_reason="stop"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # the client stopped reading, e.g. after /stop
+            stats["disconnects"] += 1
+        return response
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first chunk")
+    parser.add_argument("--answer-repeat", type=int, default=1, help="repeat the canned answer to make it longer")
+    args = parser.parse_args()
+
+    web.run_app(
+        make_app(args.tokens_per_second, args.latency, answer_repeat=args.answer_repeat),
+        host=args.host,
+        port=args.port
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Local stand-in for the Telegram Bot API, records every message the bot sends or edits and can answer
+a share of the edits with RetryAfter.
+
+Run it and point the bot at it with telegram_api_base_url: "http://localhost:8081/bot":
+
+    python benchmark/fake_telegram_server.py --port 8081 --retry-after-rate 0.05
+
+Updates for the bot are pushed with FakeTelegramServer.push_update or POST /_updates. They are delivered by
+getUpdates, or, once the bot called setWebhook, posted to the webhook URL with its secret token like Telegram does.
+GET /_stats returns what was recorded so far.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+
+class FakeTelegramServer:
+    def __init__(self, retry_after_rate: float = 0.0, retry_after: int = 1, seed: int = None):
+        """
+        retry_after_rate is the share of editMessageText calls rejected with RetryAfter of retry_after seconds
+        """
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.updates = asyncio.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+        # set by setWebhook, updates are posted there instead of waiting for getUpdates
+        self.webhook_url = None
+        self.webhook_secret_token = None
+        self.webhook_session = None
+        self.webhook_deliveries = set()
+
+        # chat_id -> [(monotonic time, method, text)]
+        self.events = {}
+
+        self.n_requests = 0
+        self.n_sends = 0
+        self.n_edits = 0
+        self.n_retry_after = 0
+        self.n_chat_actions = 0
+        self.n_deletes = 0
+        self.n_webhook_posts = 0
+        self.n_webhook_errors = 0
+
+    def push_update(self, update: dict) -> dict:
+        update["update_id"] = next(self.update_ids)
+        if self.webhook_url is not None:
+            delivery = asyncio.create_task(self._post_to_webhook(update))
+            self.webhook_deliveries.add(delivery)
+            delivery.add_done_callback(self.webhook_deliveries.discard)
+        else:
+            self.updates.put_nowait(update)
+        return update
+
+    async def _post_to_webhook(self, update: dict):
+        if self.webhook_session is None:
+            self.webhook_session = aiohttp.ClientSession()
+
+        headers = {}
+        if self.webhook_secret_token:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret_token
+        self.n_webhook_posts += 1
+        try:
+            async with self.webhook_session.post(self.webhook_url, json=update, headers=headers) as response:
+                if response.status != 200:
+                    self.n_webhook_errors += 1
+        except aiohttp.ClientError:
+            self.n_webhook_errors += 1
+
+    async def close(self):
+        if len(self.webhook_deliveries) > 0:
+            await asyncio.wait(self.webhook_deliveries)
+        if self.webhook_session is not None:
+            await self.webhook_session.close()
+            self.webhook_session = None
+
+    def make_text_update(self, user_id: int, chat_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+
+    def _record(self, chat_id: int, method: str, text: str = None):
+        self.events.setdefault(chat_id, []).append((time.monotonic(), method, text))
+
+    def _message(self, chat_id: int, text: str, message_id: int = None) -> dict:
+        return {
+            "message_id": message_id if message_id is not None else next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    @staticmethod
+    async def _parameters(request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+
+        # python-telegram-bot posts form fields with JSON encoded values
+        parameters = {}
+        for key, value in (await request.post()).items():
+            try:
+                parameters[key] = json.loads(value)
+            except (TypeError, ValueError):
+                parameters[key] = value
+        return parameters
+
+    async def _get_updates(self, parameters: dict) -> list:
+        timeout = float(parameters.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return updates
+
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        self.n_requests += 1
+        method = request.match_info["method"]
+        parameters = await self._parameters(request)
+        chat_id = int(parameters["chat_id"]) if "chat_id" in parameters else None
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "setWebhook":
+            # form values are JSON decoded, a numeric token would come back as a number
+            self.webhook_url = str(parameters["url"]) or None
+            self.webhook_secret_token = str(parameters["secret_token"]) if parameters.get("secret_token") else None
+            result = True
+        elif method == "deleteWebhook":
+            self.webhook_url = None
+            self.webhook_secret_token = None
+            result = True
+        elif method == "getUpdates":
+            if self.webhook_url is not None:
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 409,
+                    "description": "Conflict: can't use getUpdates method while webhook is active",
+                }, status=409)
+            result = await self._get_updates(parameters)
+        elif method == "sendMessage":
+            self.n_sends += 1
+            self._record(chat_id, method, parameters["text"])
+            result = self._message(chat_id, parameters["text"])
+        elif method == "editMessageText":
+            if self.random.random() < self.retry_after_rate:
+                self.n_retry_after += 1
+                self._record(chat_id, "retryAfter")
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+
+            self.n_edits += 1
+            self._record(chat_id, method, parameters["text"])
+            result = self._message(chat_id, parameters["text"], message_id=int(parameters["message_id"]))
+        elif method == "sendChatAction":
+            self.n_chat_actions += 1
+            result = True
+        elif method == "deleteMessage":
+            self.n_deletes += 1
+            self._record(chat_id, method)
+            result = True
+        else:
+            # answerCallbackQuery, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_push_update(self, request: web.Request) -> web.Response:
+        return web.json_response(self.push_update(await request.json()))
+
+    async def _handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.n_requests,
+            "sends": self.n_sends,
+            "edits": self.n_edits,
+            "retry_after": self.n_retry_after,
+            "chat_actions": self.n_chat_actions,
+            "deletes": self.n_deletes,
+            "webhook_posts": self.n_webhook_posts,
+            "webhook_errors": self.n_webhook_errors,
+        }
+
+    async def _on_cleanup(self, app: web.Application):
+        await self.close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_post("/_updates", self._handle_push_update)
+        app.router.add_get("/_stats", self._handle_stats)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of edits rejected with RetryAfter")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds to wait after a RetryAfter")
+    args = parser.parse_args()
+
+    web.run_app(
+        FakeTelegramServer(args.retry_after_rate, args.retry_after).make_app(),
+        host=args.host,
+        port=args.port
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Offline load test of the message pipeline. The bot runs in-process against a fake Telegram Bot API server and a
+fake streaming OpenAI server, N users send M messages each and the run is summarized as messages/sec,
+time to first chunk, edit counts and MongoDB round trips per message.
+
+Settings come from config/config.yml, only the Telegram, OpenAI and MongoDB endpoints and the per-user rate
+limit are overridden. Use a throwaway MongoDB, or --in-memory-mongo if mongomock is installed:
+
+    python benchmark/load_test.py --users 50 --messages 5 --tokens-per-second 50 --retry-after-rate 0.02
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+benchmark_dir = Path(__file__).parent.resolve()
+sys.path.insert(0, str(benchmark_dir.parent / "bot"))
+sys.path.insert(0, str(benchmark_dir))
+
+import fake_openai_server
+from fake_telegram_server import FakeTelegramServer
+
+# benchmark users are created far away from real Telegram ids
+FIRST_USER_ID = 10 ** 12
+
+
+def percentile(values: list, q: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def accept_bulk_sort(builder_class):
+    """
+    pymongo 4.10 and later pass sort to the bulk builder for UpdateOne and ReplaceOne, mongomock 4.3 doesn't take it.
+    The bot never sorts its bulk updates, so the argument is dropped
+    """
+    for name in ("add_update", "add_replace"):
+        add = getattr(builder_class, name)
+
+        def add_without_sort(self, *args, sort=None, _add=add, **kwargs):
+            return _add(self, *args, **kwargs)
+
+        setattr(builder_class, name, add_without_sort)
+
+
+def configure_bot(args, telegram_port: int, openai_port: int):
+    """
+    Points the bot at the fake servers, has to run before bot.py is imported
+    """
+    if args.in_memory_mongo:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        accept_bulk_sort(mongomock.collection.BulkOperationBuilder)
+
+    import config
+    config.telegram_token = "123456:benchmark"
+    config.telegram_api_base_url = f"http://127.0.0.1:{telegram_port}/bot"
+    config.webhook_url = ""
+    config.allowed_telegram_usernames = []
+    config.admin_telegram_usernames = []
+    config.metrics_port = 0
+
+    config.default_backend = "openai"
+    config.chat_mode_backends = {}
+    config.openai_api_key = "benchmark"
+    config.openai_api_base_url = f"http://127.0.0.1:{openai_port}/v1"
+
+    # the load generator sends faster than a person would
+    config.user_messages_per_minute = 10 ** 9
+    config.user_messages_burst = 10 ** 9
+
+    if args.mongodb_uri:
+        config.mongodb_uri = args.mongodb_uri
+
+
+def count_observations(histogram) -> int:
+    return sum(sum(child.counts) for child in histogram.children.values())
+
+
+async def simulate_user(application, telegram: FakeTelegramServer, user_id: int, n_messages: int,
+                        first_chunk_latencies: list, turn_latencies: list):
+    from telegram import Update
+
+    for i in range(n_messages):
+        update = Update.de_json(
+            telegram.make_text_update(user_id, user_id, f"Benchmark question #{i} from user {user_id}"),
+            application.bot
+        )
+
+        start_time = time.monotonic()
+        await application.process_update(update)
+        turn_latencies.append(time.monotonic() - start_time)
+
+        # the first message of the answer, queue notices don't count
+        first_chunk_at = next(
+            (
+                event_time for event_time, method, text in telegram.events.get(user_id, [])
+                if event_time >= start_time and method == "sendMessage" and not text.startswith("⏳")
+            ),
+            None
+        )
+        if first_chunk_at is not None:
+            first_chunk_latencies.append(first_chunk_at - start_time)
+
+
+async def run(args):
+    telegram = FakeTelegramServer(args.retry_after_rate, args.retry_after, seed=args.seed)
+    openai_app = fake_openai_server.make_app(args.tokens_per_second, args.latency, answer_repeat=args.answer_repeat)
+    telegram_runner = await start_site(telegram.make_app(), args.telegram_port)
+    openai_runner = await start_site(openai_app, args.openai_port)
+
+    configure_bot(args, args.telegram_port, args.openai_port)
+    import bot
+
+    application = bot.build_application()
+    await application.initialize()
+    await bot.post_init(application)
+
+    import metrics
+
+    first_chunk_latencies, turn_latencies = [], []
+    n_mongo_round_trips_before = count_observations(metrics.mongo_round_trip_seconds)
+    n_mongo_calls_before = count_observations(metrics.mongo_call_seconds)
+    start_time = time.monotonic()
+    try:
+        await asyncio.gather(*[
+            simulate_user(application, telegram, FIRST_USER_ID + i, args.messages, first_chunk_latencies,
+                          turn_latencies)
+            for i in range(args.users)
+        ])
+        duration = time.monotonic() - start_time
+        n_mongo_round_trips = count_observations(metrics.mongo_round_trip_seconds) - n_mongo_round_trips_before
+        n_mongo_calls = count_observations(metrics.mongo_call_seconds) - n_mongo_calls_before
+
+        # reported before the shutdown, whose final flushes can fail
+        print_report(args, telegram, openai_app, duration, first_chunk_latencies, turn_latencies,
+                     n_mongo_round_trips, n_mongo_calls)
+    finally:
+        try:
+            await bot.post_shutdown(application)
+            await application.shutdown()
+        except Exception as e:
+            print(f"bot shutdown failed: {e!r}", file=sys.stderr)
+        await openai_runner.cleanup()
+        await telegram_runner.cleanup()
+
+
+def print_report(args, telegram: FakeTelegramServer, openai_app: web.Application, duration: float,
+                 first_chunk_latencies: list, turn_latencies: list, n_mongo_round_trips: int, n_mongo_calls: int):
+    n_messages = args.users * args.messages
+    telegram_stats = telegram.stats()
+    print(f"users x messages:       {args.users} x {args.messages}")
+    print(f"duration:               {duration:.2f}s")
+    print(f"throughput:             {n_messages / duration:.2f} messages/sec")
+    print(f"time to first chunk:    p50 {percentile(first_chunk_latencies, 0.5):.3f}s, "
+          f"p99 {percentile(first_chunk_latencies, 0.99):.3f}s")
+    print(f"turn latency:           p50 {percentile(turn_latencies, 0.5):.3f}s, "
+          f"p99 {percentile(turn_latencies, 0.99):.3f}s, mean {statistics.mean(turn_latencies):.3f}s")
+    print(f"answers without chunks: {n_messages - len(first_chunk_latencies)}")
+    print(f"telegram sends:         {telegram_stats['sends']} ({telegram_stats['sends'] / n_messages:.2f}/message)")
+    print(f"telegram edits:         {telegram_stats['edits']} ({telegram_stats['edits'] / n_messages:.2f}/message)")
+    print(f"injected RetryAfter:    {telegram_stats['retry_after']}")
+    print(f"backend requests:       {openai_app['stats']['requests']}")
+    if args.in_memory_mongo:
+        # mongomock answers in-process, pymongo never sends a command
+        print("mongo round trips:      not measured with --in-memory-mongo")
+    else:
+        print(f"mongo round trips:      {n_mongo_round_trips} ({n_mongo_round_trips / n_messages:.2f}/message)")
+    print(f"mongo executor calls:   {n_mongo_calls} ({n_mongo_calls / n_messages:.2f}/message)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent by every user, one after another")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="speed of the fake backend")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the fake backend's first chunk")
+    parser.add_argument("--answer-repeat", type=int, default=1, help="repeat the canned answer to make it longer")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of edits rejected with RetryAfter")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds to wait after a RetryAfter")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the RetryAfter injection")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8000)
+    parser.add_argument("--mongodb-uri", default=None, help="defaults to the bot's configured MongoDB")
+    parser.add_argument("--in-memory-mongo", action="store_true", help="use mongomock instead of a MongoDB server")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
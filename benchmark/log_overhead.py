@@ -0,0 +1,77 @@
+"""
+Measures what the per-message log calls cost the event loop, with the old synchronous stream handler
+and with the bot's queued logging pipeline:
+
+    python benchmark/log_overhead.py --calls 20000 --prompt-length 4000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+import log_pipeline  # noqa: E402
+
+
+def measure(logger: logging.Logger, n_calls: int, message: str, prompt: str) -> float:
+    # the two records every message produces, as logged by bot.py and chatgpt.py
+    message_logger = log_pipeline.CategoryLogger(logger, "message")
+    prompt_logger = log_pipeline.CategoryLogger(logger, "prompt")
+
+    # CPU time of the calling thread only, the listener thread's formatting and writing is not counted
+    start_time = time.thread_time()
+    for _ in range(n_calls):
+        message_logger.info("Send message to ChatGPT: %s", message)
+        prompt_logger.info("Ask ChatGPT: %s", prompt)
+    return (time.thread_time() - start_time) / n_calls
+
+
+def reset_root_logger():
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="messages logged per setup")
+    parser.add_argument("--prompt-length", type=int, default=4000, help="characters of the logged prompt")
+    parser.add_argument("--prompt-sample-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    message = "Benchmark question about something"
+    prompt = "x" * args.prompt_length
+    logger = logging.getLogger("benchmark")
+
+    with open(os.devnull, "w") as devnull:
+        # the old setup: logging.basicConfig with f-strings, formatted and written on the calling thread
+        reset_root_logger()
+        logging.basicConfig(stream=devnull, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                            level=logging.INFO)
+        start_time = time.thread_time()
+        for _ in range(args.calls):
+            logger.info(f"Send message to ChatGPT: {message}")
+            logger.info(f"Ask ChatGPT: {prompt}")
+        synchronous_seconds = (time.thread_time() - start_time) / args.calls
+
+        reset_root_logger()
+        sys.stderr, stderr = devnull, sys.stderr
+        try:
+            listener = log_pipeline.setup_logging(sample_rates={"prompt": args.prompt_sample_rate})
+            pipeline_seconds = measure(logger, args.calls, message, prompt)
+            listener_start_time = time.perf_counter()
+            listener.stop()
+            drain_seconds = time.perf_counter() - listener_start_time
+        finally:
+            sys.stderr = stderr
+
+    print(f"calls:                  {args.calls} messages, prompt of {args.prompt_length} characters")
+    print(f"synchronous handler:    {synchronous_seconds * 1e6:.1f}us per message on the event loop")
+    print(f"queued pipeline:        {pipeline_seconds * 1e6:.1f}us per message on the event loop")
+    print(f"listener drain:         {drain_seconds:.2f}s after the last call")
+
+
+if __name__ == "__main__":
+    main()
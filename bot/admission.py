@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import contextlib
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> float:
+        """
+        Takes one token and returns 0, or returns how many seconds to wait for the next one
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class Ticket:
+    def __init__(self):
+        self.admitted = False
+        self.changed = asyncio.Event()
+
+
+class AdmissionController:
+    """
+    Decides when a generation may start.
+    Each user gets a token bucket and a FIFO, so one user's turns never race on their dialog, and at most
+    max_inflight generations run at once across all users; the rest wait in a global FIFO queue
+    """
+
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, max_inflight: int, user_rate: float, user_burst: float):
+        self.max_inflight = max_inflight
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+
+        self.n_inflight = 0
+        self.queue = collections.deque()
+        self.user_locks = {}
+        self.user_n_waiters = {}
+        self.buckets = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def take_user_token(self, user_id: int):
+        """
+        Raises RateLimitExceeded if the user sends faster than their token bucket allows
+        """
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) > self.MAX_IDLE_BUCKETS:
+                self.buckets = {key: value for key, value in self.buckets.items() if not value.is_full}
+            bucket = self.buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+
+        retry_after = bucket.take()
+        if retry_after > 0:
+            raise RateLimitExceeded(retry_after)
+
+    @contextlib.asynccontextmanager
+    async def _user_turn(self, user_id: int):
+        lock = self.user_locks.setdefault(user_id, asyncio.Lock())
+        self.user_n_waiters[user_id] = self.user_n_waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.user_n_waiters[user_id] -= 1
+            if self.user_n_waiters[user_id] == 0:
+                del self.user_n_waiters[user_id]
+                del self.user_locks[user_id]
+
+    async def _acquire_slot(self, on_queue_position: Optional[Callable[[int], Awaitable]]):
+        if self.n_inflight < self.max_inflight and len(self.queue) == 0:
+            self.n_inflight += 1
+            return
+
+        ticket = Ticket()
+        self.queue.append(ticket)
+        try:
+            while not ticket.admitted:
+                ticket.changed.clear()
+                if on_queue_position is not None:
+                    await on_queue_position(self.queue.index(ticket) + 1)
+                if not ticket.admitted:
+                    await ticket.changed.wait()
+        except BaseException:
+            if ticket.admitted:
+                self._release_slot()
+            else:
+                self.queue.remove(ticket)
+                self._notify_queue()
+            raise
+
+    def _release_slot(self):
+        self.n_inflight -= 1
+        while self.n_inflight < self.max_inflight and len(self.queue) > 0:
+            ticket = self.queue.popleft()
+            ticket.admitted = True
+            self.n_inflight += 1
+            ticket.changed.set()
+        self._notify_queue()
+
+    def _notify_queue(self):
+        for ticket in self.queue:
+            ticket.changed.set()
+
+    def try_acquire_idle_slot(self, n_reserved: int = 1) -> bool:
+        """
+        Takes a slot for background work, only if nobody is queued and n_reserved slots stay free for users
+        """
+        if len(self.queue) == 0 and self.n_inflight + n_reserved < self.max_inflight:
+            self.n_inflight += 1
+            return True
+        return False
+
+    def release_idle_slot(self):
+        self._release_slot()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id: int, on_queue_position: Optional[Callable[[int], Awaitable]] = None,
+                    take_token: bool = True):
+        """
+        Waits for the user's previous turns and a free generation slot.
+        Raises RateLimitExceeded right away if the user sends faster than their token bucket allows,
+        unless take_token is False because the caller took the token already,
+        and awaits on_queue_position(n) every time the position in the global queue changes
+        """
+        if take_token:
+            self.take_user_token(user_id)
+
+        async with self._user_turn(user_id):
+            await self._acquire_slot(on_queue_position)
+            try:
+                yield
+            finally:
+                self._release_slot()
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.n_inflight,
+            "queued": len(self.queue),
+        }
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from session_pool import SessionPool
+from token_cache import TokenCache
+from worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class Conversation:
+    """
+    Upstream conversation state of a dialog. Backends read it before a request and update it in place
+    """
+
+    def __init__(self, conversation_id: str = None, parent_id: str = None, session: str = None):
+        self.conversation_id = conversation_id
+        self.parent_id = parent_id
+        # name of the upstream session the conversation lives on
+        self.session = session
+
+
+class Backend:
+    """
+    Interface chatgpt.ChatGPT dispatches completions to
+    """
+
+    name = ""
+    # whether the upstream keeps the conversation history itself
+    is_stateful = False
+
+    def ask(self, prompt: str, conversation: Conversation, timeout: float = None,
+            history_prompt: str = None) -> AsyncIterator[str]:
+        """
+        Yields the answer as it grows, every item is the full text so far. history_prompt is the prompt with the
+        dialog history quoted, a stateful backend sends it instead of prompt if it can't continue the conversation
+        """
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class RevChatGPTAccount:
+    """
+    Creates revChatGPT clients for one account. The access token is cached on disk, so clients created after
+    a restart skip the interactive login while the token is still valid
+    """
+
+    def __init__(self, email: str, password: str, client_class, token_cache: TokenCache, refresh_margin: float = 3600):
+        self.email = email
+        self.password = password
+        self.client_class = client_class
+        self.token_cache = token_cache
+        self.refresh_margin = refresh_margin
+
+    def create_client(self):
+        client_config = {"email": self.email, "password": self.password}
+        access_token = self.token_cache.get(self.email, min_ttl=self.refresh_margin)
+        if access_token is not None:
+            client_config["access_token"] = access_token
+        else:
+            logger.info(f"Logging in to ChatGPT as {self.email}")
+
+        client = self.client_class(config=client_config)
+        self.token_cache.set(self.email, client.config["access_token"])
+        return client
+
+    def drop_token(self):
+        """
+        Forgets the cached token, e.g. after the upstream revoked it, so the next client logs in
+        """
+        self.token_cache.delete(self.email)
+
+    @property
+    def needs_refresh(self) -> bool:
+        return self.token_cache.get(self.email, min_ttl=self.refresh_margin) is None
+
+    def refresh(self, client):
+        """
+        Logs the existing client in again, requests in flight keep working with the old token
+        """
+        logger.info(f"Refreshing the ChatGPT access token of {self.email}")
+        client.login()
+        self.token_cache.set(self.email, client.config["access_token"])
+
+
+class RevChatGPTBackend(Backend):
+    """
+    Reverse engineered ChatGPT web client (revChatGPT.V1) over a pool of upstream sessions.
+    With use_stream off the blocking client runs on a worker pool and the answer arrives as a single chunk
+    """
+
+    name = "revchatgpt"
+    is_stateful = True
+
+    def __init__(self, sessions: SessionPool, use_stream: bool = True, worker_pool: WorkerPool = None,
+                 timeout: float = 360, accounts: list = None, refresh_interval: float = 600):
+        self.sessions = sessions
+        self.use_stream = use_stream
+        self.worker_pool = worker_pool
+        self.timeout = timeout
+
+        # accounts by session name, their tokens are refreshed in the background before they expire
+        self.accounts = {account.email: account for account in accounts or []}
+        self.refresh_interval = refresh_interval
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if len(self.accounts) > 0:
+            self.refresh_task = asyncio.create_task(self._refresh_forever())
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for session in self.sessions.sessions:
+                account = self.accounts.get(session.name)
+                # sessions nobody has used yet log in lazily on their first request
+                if account is None or session.bot is None or not account.needs_refresh:
+                    continue
+
+                try:
+                    await asyncio.to_thread(account.refresh, session.bot)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh the ChatGPT access token of {session.name}: {e}")
+
+    async def ask(self, prompt: str, conversation: Conversation, timeout: float = None,
+                  history_prompt: str = None) -> AsyncIterator[str]:
+        timeout = timeout or self.timeout
+
+        async with self.sessions.session(preferred=conversation.session) as session:
+            # a conversation can only be continued on the account it was started on
+            if session.name != conversation.session:
+                if conversation.conversation_id is not None and history_prompt is not None:
+                    prompt = history_prompt
+                conversation.conversation_id, conversation.parent_id = None, None
+            conversation.session = session.name
+            gpt_bot = await session.get_bot()
+
+            if self.use_stream:
+                async for chunk in gpt_bot.ask(prompt, conversation_id=conversation.conversation_id,
+                                                   parent_id=conversation.parent_id, timeout=timeout):
+                    conversation.conversation_id = chunk['conversation_id']
+                    conversation.parent_id = chunk['parent_id']
+                    yield chunk['message']
+            else:
+                answer, conversation.conversation_id, conversation.parent_id = await self.worker_pool.run(
+                    self._ask_blocking, gpt_bot, prompt, conversation.conversation_id, conversation.parent_id,
+                    timeout, timeout=timeout
+                )
+                yield answer
+
+    @staticmethod
+    def _ask_blocking(gpt_bot, prompt: str, conversation_id: str, parent_id: str, timeout: float):
+        answer = None
+        for data in gpt_bot.ask(prompt, conversation_id=conversation_id, parent_id=parent_id, timeout=timeout):
+            answer = data['message']
+            conversation_id = data['conversation_id']
+            parent_id = data['parent_id']
+
+        if answer is None:
+            raise ValueError("ChatGPT Bot error: empty answer")
+        return answer, conversation_id, parent_id
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+
+
+class OpenAIBackend(Backend):
+    """
+    Official OpenAI chat completions API, streamed over one shared keep-alive HTTP connection pool
+    """
+
+    name = "openai"
+    is_stateful = False
+
+    def __init__(self, api_key: str, model: str = "gpt-3.5-turbo", base_url: str = "https://api.openai.com/v1",
+                 timeout: float = 120, max_connections: int = 100):
+        self.model = model
+        self.timeout = timeout
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=httpx.Timeout(timeout, connect=10),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def ask(self, prompt: str, conversation: Conversation, timeout: float = None,
+                  history_prompt: str = None) -> AsyncIterator[str]:
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True
+        }
+        async with self.client.stream("POST", "/chat/completions", json=payload, timeout=timeout) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise ValueError(f"OpenAI API error {response.status_code}: {body.decode(errors='replace')[:500]}")
+
+            answer = ""
+            async for line in response.aiter_lines():
+                if loop.time() > deadline:
+                    raise TimeoutError(f"OpenAI API answer took longer than {timeout} seconds")
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+
+                delta = json.loads(data)["choices"][0]["delta"].get("content")
+                if delta:
+                    answer += delta
+                    yield answer
+
+    async def close(self):
+        await self.client.aclose()
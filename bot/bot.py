@@ -1,14 +1,19 @@
+import asyncio
+import contextlib
+import functools
 import html
 import json
 import logging
+import signal
 import traceback
+import uuid
 from datetime import datetime
+from typing import Optional
 
-import telegram
 from httpx import HTTPError
 from revChatGPT.V1 import AsyncChatbot, Chatbot
 from telegram import Update, User, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ParseMode, ChatAction
+from telegram.constants import ParseMode
 from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
@@ -16,32 +21,168 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
-    filters, ContextTypes
+    filters
 )
 from telegram.request import HTTPXRequest
 
+import admission
+import backends
+import cancellation
 import chatgpt
 import config
 import database
+import edit_scheduler
+import log_pipeline
+import markdown_renderer
+import metrics
+import response_cache
+import session_pool
+import sharding
+import summarizer
+import token_cache
+import usage
+import utils
+import worker_pool
 
 # setup
 db = database.Database()
 
-# Setup logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Setup logging, records are formatted and written on a separate thread
+log_pipeline.setup_logging(
+    level=config.log_level,
+    log_format=config.log_format,
+    sample_rates=config.log_sample_rates,
+    max_payload_length=config.log_max_payload_length
 )
 logger = logging.getLogger(__name__)
+# user messages, sampled before the record is created
+message_logger = log_pipeline.CategoryLogger(logger, "message")
 
-email = config.openai_email
-password = config.openai_password
-async_chatgpt_bot: AsyncChatbot = None
-chatgpt_bot: Chatbot = None
-if config.use_stream:
-    async_chatgpt_bot = AsyncChatbot(config={"email": email, "password": password})
-else:
-    chatgpt_bot = Chatbot(config={"email": email, "password": password})
+# completion backends are created on first use, each chat mode is served by the one configured in chat_mode_backends
+completion_backends = {}
+
+# revChatGPT access tokens survive restarts, so a warm restart doesn't log in again
+upstream_token_cache = token_cache.TokenCache(config.upstream_token_cache_path)
+
+
+def create_revchatgpt_backend() -> backends.RevChatGPTBackend:
+    accounts = [
+        backends.RevChatGPTAccount(
+            account["email"],
+            account["password"],
+            AsyncChatbot if config.use_stream else Chatbot,
+            upstream_token_cache,
+            refresh_margin=config.upstream_token_refresh_margin
+        )
+        for account in config.openai_accounts
+    ]
+    upstream_sessions = [
+        session_pool.UpstreamSession(
+            account.email,
+            account.create_client,
+            max_concurrency=config.openai_session_concurrency,
+            drop_credentials=account.drop_token
+        )
+        for account in accounts
+    ]
+    # the blocking Chatbot.ask runs here instead of on the event loop
+    ask_worker_pool = worker_pool.WorkerPool("chatgpt-ask", config.sync_ask_workers, timeout=config.sync_ask_timeout)
+
+    metrics.worker_pool_queued.labels(ask_worker_pool.name).set_function(lambda: ask_worker_pool.n_queued)
+    metrics.worker_pool_running.labels(ask_worker_pool.name).set_function(lambda: ask_worker_pool.n_running)
+    for upstream_session in upstream_sessions:
+        metrics.upstream_session_inflight.labels(upstream_session.name).set_function(
+            functools.partial(getattr, upstream_session, "n_inflight")
+        )
+
+    return backends.RevChatGPTBackend(
+        session_pool.SessionPool(upstream_sessions, cooldown=config.openai_session_cooldown),
+        use_stream=config.use_stream,
+        worker_pool=ask_worker_pool,
+        timeout=config.sync_ask_timeout,
+        accounts=accounts,
+        refresh_interval=config.upstream_token_refresh_interval
+    )
+
+
+def create_openai_backend() -> backends.OpenAIBackend:
+    return backends.OpenAIBackend(
+        config.openai_api_key,
+        model=config.openai_model,
+        base_url=config.openai_api_base_url,
+        timeout=config.openai_request_timeout,
+        max_connections=config.openai_max_connections
+    )
+
+
+BACKEND_FACTORIES = {
+    "revchatgpt": create_revchatgpt_backend,
+    "openai": create_openai_backend,
+}
+
+
+def get_completion_backend(chat_mode: str) -> backends.Backend:
+    backend_name = config.chat_mode_backends.get(chat_mode, config.default_backend)
+    if backend_name not in completion_backends:
+        backend = BACKEND_FACTORIES[backend_name]()
+        backend.start()
+        completion_backends[backend_name] = backend
+    return completion_backends[backend_name]
+
+
+# answers of stateless chat modes are reused for identical prompts
+answer_cache = response_cache.ResponseCache(
+    config.response_cache_modes,
+    max_size=config.response_cache_size,
+    ttl=config.response_cache_ttl,
+    db=db if config.response_cache_shared else None
+)
+
+# all streamed answers are edited through one scheduler to stay within Telegram limits
+telegram_edit_scheduler = edit_scheduler.EditScheduler(
+    edits_per_second=config.telegram_edits_per_second,
+    chat_edit_interval=config.telegram_chat_edit_interval
+)
+
+# one timer keeps "typing..." visible in every chat waiting for an answer
+typing_ticker = utils.TypingTicker(every_seconds=4)
+
+# token counting and its Mongo writes happen in the background
+usage_tracker = usage.UsageTracker(db, flush_interval=config.usage_flush_interval)
+
+# serializes each user's turns and caps generations in flight
+generation_admission = admission.AdmissionController(
+    max_inflight=config.max_inflight_generations,
+    user_rate=config.user_messages_per_minute / 60,
+    user_burst=config.user_messages_burst
+)
+
+# numbers other components already keep are read at scrape time
+metrics.telegram_edits.labels().set_function(lambda: telegram_edit_scheduler.n_edits)
+metrics.telegram_retry_after.labels().set_function(lambda: telegram_edit_scheduler.n_retry_after)
+metrics.telegram_streams.set_function(lambda: len(telegram_edit_scheduler.streams))
+metrics.generations_inflight.set_function(lambda: generation_admission.n_inflight)
+metrics.generations_queued.set_function(lambda: len(generation_admission.queue))
+if db.user_journal is not None:
+    metrics.mongo_write_behind_pending.set_function(lambda: len(db.user_journal.pending))
+
+metrics_server = metrics.MetricsServer(config.metrics_host, config.metrics_port) if config.metrics_port else None
+
+# long dialogs are compacted into a rolling summary while generation slots are idle
+dialog_summarizer = summarizer.DialogSummarizer(
+    db,
+    generation_admission,
+    get_completion_backend,
+    summarize_after=config.summarize_after_messages,
+    keep_recent=config.summary_keep_recent_messages,
+    max_words=config.summary_max_words
+)
+
+# generations in flight by chat, for /stop and for cancelling superseded generations
+generation_registry = cancellation.CancellationRegistry()
+
+# updates are processed concurrently, but updates from one chat still run one after another
+chat_sequencer = utils.ChatSequencer()
 
 # Disable certificate verification
 # ssl._create_default_https_context = ssl._create_unverified_context
@@ -49,28 +190,32 @@ else:
 HELP_MESSAGE = """Commands:
 ⚪ /new – Start new dialog
 ⚪ /retry – Regenerate last bot answer
+⚪ /stop – Stop generating the answer
 ⚪ /mode – Select chat mode
 ⚪ /help – Show help
 """
 
+INTERRUPTED_NOTE = "\n\n⚠️ Interrupted by a restart, send /retry to regenerate the answer"
+INTERRUPTED_NOTE_HTML = "\n\n⚠️ <i>Interrupted by a restart, send /retry to regenerate the answer</i>"
+INTERRUPTED_BEFORE_ANSWER_NOTE = "⚠️ Interrupted by a restart before the answer started, please send your message again"
 
-async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
-            user.id,
-            update.message.chat_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
+
+async def load_user_state(update: Update, user: User) -> database.UserState:
+    return await db.load_state(
+        user.id,
+        update.effective_chat.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name
+    )
 
 
 async def start_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
+    state = await load_user_state(update, update.message.from_user)
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    state.set_user_attribute("last_interaction", datetime.now())
+    state.start_new_dialog()
+    await state.commit()
 
     reply_text = "Hi! I'm **ChatGPT** bot implemented with GPT-3.5 OpenAI API 🤖\n\n"
     reply_text += HELP_MESSAGE
@@ -81,30 +226,54 @@ async def start_handle(update: Update, context: CallbackContext):
 
 
 async def help_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    state = await load_user_state(update, update.message.from_user)
+    state.set_user_attribute("last_interaction", datetime.now())
+    await state.commit()
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.MARKDOWN)
 
 
+@contextlib.asynccontextmanager
+async def admit_generation(update: Update, user: User):
+    """
+    Waits for a generation slot while showing the user their place in the queue
+    """
+    queue_message = None
+
+    async def on_queue_position(position: int):
+        nonlocal queue_message
+        text = f"⏳ You're #{position} in queue"
+        if queue_message is None:
+            queue_message = telegram_edit_scheduler.register(await update.message.reply_text(text))
+        else:
+            telegram_edit_scheduler.update(queue_message, text)
+
+    try:
+        # the rate_limited wrapper took the user's token before the update waited for its turn
+        async with generation_admission.admit(user.id, on_queue_position=on_queue_position, take_token=False):
+            if queue_message is not None:
+                telegram_edit_scheduler.unregister(queue_message)
+                await queue_message.message.delete()
+                queue_message = None
+            yield
+    finally:
+        if queue_message is not None:
+            telegram_edit_scheduler.unregister(queue_message)
+
+
 async def retry_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
-    dialog_id = db.get_user_attribute(user_id, "current_dialog_id")
-    conversation_id = db.get_dialog_attribute(user_id, "conversation_id", dialog_id)
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id)
-    if len(dialog_messages) == 0:
-        await update.message.reply_text("No message to retry 🤷‍♂️")
-        return
+    async with admit_generation(update, update.message.from_user):
+        state = await load_user_state(update, update.message.from_user)
+        state.set_user_attribute("last_interaction", datetime.now())
 
-    last_dialog_message = dialog_messages.pop()
+        if len(state.get_dialog_messages()) == 0:
+            await state.commit()
+            await update.message.reply_text("No message to retry 🤷‍♂️")
+            return
 
-    # last message was removed from the context
-    db.set_dialog_messages(user_id, dialog_messages, conversation_id, dialog_id)
+        # last message was removed from the context
+        last_dialog_message = state.pop_dialog_message()
 
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+        await generate_answer(update, context, state, last_dialog_message["user"])
 
 
 async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=False):
@@ -113,111 +282,334 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         await edited_message_handle(update, context)
         return
 
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
+    async with admit_generation(update, update.message.from_user):
+        state = await load_user_state(update, update.message.from_user)
 
-    # new dialog timeout
-    if use_new_dialog_timeout:
-        if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout:
-            db.start_new_dialog(user_id)
-            await update.message.reply_text("Starting new dialog due to timeout ✅")
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        # new dialog timeout
+        if use_new_dialog_timeout:
+            if (datetime.now() - state.get_user_attribute("last_interaction")).seconds > config.new_dialog_timeout:
+                state.start_new_dialog()
+                await update.message.reply_text("Starting new dialog due to timeout ✅")
+        state.set_user_attribute("last_interaction", datetime.now())
 
-    # send typing action
-    await update.message.chat.send_action(action=ChatAction.TYPING)
+        await generate_answer(update, context, state, message or update.message.text)
 
-    message = message or update.message.text
-    logger.info(f"Send message to ChatGPT: {message}")
 
-    dialog_id = db.get_user_attribute(user_id, "current_dialog_id")
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id)
-    conversation_id = db.get_dialog_attribute(user_id, "conversation_id", dialog_id)
-    parent_id = None
-    if len(dialog_messages) > 0:
-        parent_id = dialog_messages[-1]['parent_id']
+async def generate_answer(update: Update, context: CallbackContext, state: database.UserState, message: str):
+    message_logger.info("Send message to ChatGPT: %s", message)
+
+    dialog_messages = state.get_dialog_messages()
+    chat_mode = state.get_user_attribute("current_chat_mode")
+    backend = get_completion_backend(chat_mode)
+    conversation = backends.Conversation(
+        conversation_id=state.get_dialog_attribute("conversation_id"),
+        parent_id=dialog_messages[-1]['parent_id'] if len(dialog_messages) > 0 else None,
+        session=state.dialog.get("upstream_session")
+    )
+
+    # a message popped by /retry and a new dialog only exist in memory until committed, the checkpoint's message
+    # count has to match Mongo for the next start to tell whether the answer was saved
+    await state.commit()
+
+    # if the process dies before the answer is saved, the next start resumes it from the checkpoint
+    generation_id = str(uuid.uuid4())
+    db.checkpoint_generation(generation_id, {
+        "user_id": state.user_id,
+        "chat_id": update.effective_chat.id,
+        "dialog_id": state.dialog_id,
+        "n_dialog_messages": state.dialog["n_messages"],
+        "chat_mode": chat_mode,
+        "message": message,
+        "reply_to_message_id": update.message.message_id,
+        "conversation_id": conversation.conversation_id,
+        "parent_id": conversation.parent_id,
+        "session": conversation.session,
+        "started_at": datetime.now()
+    })
 
     answer = None
+    interrupted = False
     try:
-        if config.use_stream:
-            answer, prompt, conversation_id, parent_id = await async_message_handle(
-                update,
-                context,
-                user_id,
-                dialog_id,
-                conversation_id,
-                parent_id)
-        else:
-            answer, prompt, conversation_id, parent_id = chatgpt.ChatGPT(
-                gpt_bot=chatgpt_bot).send_message(
-                message,
-                dialog_messages=db.get_dialog_messages(user_id, dialog_id),
-                chat_mode=db.get_user_attribute(user_id, "current_chat_mode"),
-                conversation_id=conversation_id,
-                parent_id=parent_id
-            )
+        try:
+            with generation_registry.track(update.effective_chat.id) as generation:
+                try:
+                    answer, prompt = await chatgpt.ChatGPT(
+                        backend=backend,
+                        edit_scheduler=telegram_edit_scheduler,
+                        typing_ticker=typing_ticker,
+                        response_cache=answer_cache).async_send_message(
+                        update=update,
+                        context=context,
+                        message=message,
+                        dialog_messages=state.get_recent_dialog_messages(),
+                        chat_mode=chat_mode,
+                        conversation=conversation,
+                        generation=generation,
+                        dialog_summary=state.dialog_summary,
+                        checkpoint=functools.partial(db.checkpoint_generation, generation_id)
+                    )
+                except asyncio.CancelledError:
+                    # interrupted by the shutdown, the checkpoint is left for the next start,
+                    # a stop while streaming returns the partial answer instead of getting here
+                    interrupted = generation.interrupted
+                    if not generation.stopped and not interrupted:
+                        raise
+            state.set_dialog_attribute("upstream_session", conversation.session)
+        except (BadRequest, HTTPError, RetryAfter):
+            pass
+        except Exception as e:
+            logger.exception(f"Send message error: {str(e)}")
+            error_text = f"Something went wrong during completion.\nReason: {e}"
+            await state.commit()
+            await update.message.reply_text(error_text)
+            return
+        if not answer:
+            # stopped before the first chunk, an empty answer isn't worth a turn in the dialog
+            await state.commit()
+            return
+
+        await save_answer(state, message, answer, prompt, chat_mode, conversation, backend.is_stateful,
+                          stopped=generation.stopped)
+    finally:
+        # deleted after the answer is saved, a checkpoint of a saved answer is recognized by the message count
+        if not interrupted:
+            db.finish_generation(generation_id)
+
+
+async def save_answer(state: database.UserState, message: str, answer: str, prompt: str, chat_mode: str,
+                      conversation: backends.Conversation, stateful_backend: bool, stopped: bool = False):
+    usage_tracker.record(state.user_id, state.dialog_id, chat_mode, prompt, answer)
 
-            try:
-                await context.bot.send_message(chat_id=update.effective_chat.id,
-                                               text=answer,
-                                               parse_mode=ParseMode.MARKDOWN,
-                                               reply_to_message_id=update.message.message_id)
-            except telegram.error.BadRequest:
-                # answer has invalid characters, so we send it without parse_mode
-                await context.bot.send_message(chat_id=update.effective_chat.id,
-                                               text=answer,
-                                               reply_to_message_id=update.message.message_id)
-    except (BadRequest, HTTPError, RetryAfter):
-        pass
-    except Exception as e:
-        logger.exception(f"Send message error: {str(e)}")
-        error_text = f"Something went wrong during completion.\nReason: {e}"
-        # typing_task.cancel()
-        await update.message.reply_text(error_text)
-        return
     # update user data
-    new_dialog_message = {"user": message, "bot": answer, "date": datetime.now(), "parent_id": parent_id}
-    db.set_dialog_messages(
-        user_id,
-        db.get_dialog_messages(user_id, dialog_id) + [new_dialog_message],
-        conversation_id,
-        dialog_id
+    n_tokens = await asyncio.to_thread(chatgpt.ChatGPT.count_dialog_message_tokens, message, answer)
+    new_dialog_message = {
+        "user": message,
+        "bot": answer,
+        "date": datetime.now(),
+        "parent_id": conversation.parent_id,
+        "n_tokens": n_tokens
+    }
+    if stopped:
+        # the partial answer stays in the dialog, so /retry can regenerate it
+        new_dialog_message["stopped"] = True
+    state.add_dialog_message(new_dialog_message, conversation.conversation_id)
+    await state.commit()
+
+    if config.summarize_after_messages > 0:
+        dialog_summarizer.maybe_schedule(state.user_id, state.dialog, chat_mode, stateful_backend)
+
+
+async def deliver_page(bot, checkpoint: dict, page_html: str, page_text: str, message_id: int = None):
+    """
+    Edits message_id into the page, or sends the page as a new reply to the user's message
+    """
+    for text, parse_mode in ((page_html, ParseMode.HTML), (page_text, None)):
+        try:
+            if message_id is not None:
+                await bot.edit_message_text(text, chat_id=checkpoint["chat_id"], message_id=message_id,
+                                            parse_mode=parse_mode)
+            else:
+                await bot.send_message(checkpoint["chat_id"], text, parse_mode=parse_mode,
+                                       reply_to_message_id=checkpoint["reply_to_message_id"],
+                                       allow_sending_without_reply=True)
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+            if parse_mode is None:
+                raise
+
+
+async def regenerate_answer(bot, state: database.UserState, checkpoint: dict):
+    """
+    Asks the backend again and edits the answer into the message the interrupted stream left behind
+    """
+    chat_mode = checkpoint["chat_mode"]
+    backend = get_completion_backend(chat_mode)
+    conversation = backends.Conversation(
+        conversation_id=checkpoint.get("conversation_id"),
+        parent_id=checkpoint.get("parent_id"),
+        session=checkpoint.get("session")
     )
-    # typing_task.cancel()
-
-
-async def async_message_handle(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, dialog_id, conversation_id,
-                               parent_id):
-    return await chatgpt.ChatGPT(async_gpt_bot=async_chatgpt_bot).async_send_message(
-        update=update,
-        context=context,
-        dialog_messages=db.get_dialog_messages(user_id, dialog_id),
-        chat_mode=db.get_user_attribute(user_id, "current_chat_mode"),
-        conversation_id=conversation_id,
-        parent_id=parent_id
+    prompt, history_prompt = chatgpt.ChatGPT._generate_prompts(
+        checkpoint["message"], state.get_recent_dialog_messages(), chat_mode, backend.is_stateful,
+        state.dialog_summary, conversation.conversation_id
     )
+    session = conversation.session
+
+    answer = ""
+    async with contextlib.aclosing(backend.ask(prompt, conversation, history_prompt=history_prompt)) as chunks:
+        async for answer in chunks:
+            pass
+    if history_prompt is not None and conversation.session != session:
+        # the conversation was started over on another session
+        prompt = history_prompt
+    answer = chatgpt.ChatGPT._postprocess_answer(answer)
+    if len(answer) == 0:
+        raise ValueError("ChatGPT Bot error: empty answer")
+
+    renderer = markdown_renderer.MarkdownRenderer()
+    message_id = checkpoint.get("tail_message_id")
+    for page_text in utils.split_text(answer):
+        renderer.feed(page_text)
+        await deliver_page(bot, checkpoint, renderer.finish(), page_text, message_id=message_id)
+        renderer = renderer.continuation()
+        message_id = None
+
+    state.set_dialog_attribute("upstream_session", conversation.session)
+    await save_answer(state, checkpoint["message"], answer, prompt, chat_mode, conversation, backend.is_stateful)
+
+
+async def finalize_answer(bot, state: Optional[database.UserState], checkpoint: dict):
+    """
+    Keeps the partial answer like a stopped one, in the chat and, if state is given, in the dialog
+    """
+    text = checkpoint.get("text") or ""
+    answer = chatgpt.ChatGPT._postprocess_answer(text)
+    if len(answer) == 0:
+        await deliver_page(bot, checkpoint, INTERRUPTED_BEFORE_ANSWER_NOTE, INTERRUPTED_BEFORE_ANSWER_NOTE,
+                           message_id=checkpoint.get("tail_message_id"))
+        return
+
+    page_text = text[checkpoint.get("page_start") or 0:].strip()
+    renderer = markdown_renderer.MarkdownRenderer()
+    renderer.feed(page_text)
+    await deliver_page(bot, checkpoint, renderer.finish() + INTERRUPTED_NOTE_HTML, page_text + INTERRUPTED_NOTE,
+                       message_id=checkpoint.get("tail_message_id"))
+
+    if state is not None:
+        conversation = backends.Conversation(
+            conversation_id=checkpoint.get("answer_conversation_id", checkpoint.get("conversation_id")),
+            parent_id=checkpoint.get("answer_parent_id", checkpoint.get("parent_id")),
+            session=checkpoint.get("session")
+        )
+        prompt = chatgpt.ChatGPT._generate_prompt(checkpoint["message"], [], checkpoint["chat_mode"],
+                                                  conversation_id=checkpoint.get("conversation_id"))
+        await save_answer(state, checkpoint["message"], answer, prompt, checkpoint["chat_mode"], conversation,
+                          stateful_backend=True, stopped=True)
+
+
+async def resume_generation(bot, checkpoint: dict):
+    state = await db.load_state(checkpoint["user_id"], checkpoint["chat_id"])
+    if state.dialog_id == checkpoint["dialog_id"] and state.dialog["n_messages"] > checkpoint["n_dialog_messages"]:
+        # the answer was saved, only the checkpoint's delete was lost
+        return
+    if state.dialog_id != checkpoint["dialog_id"] or state.dialog["n_messages"] != checkpoint["n_dialog_messages"]:
+        # the user moved on, the partial answer is only completed in the chat
+        await finalize_answer(bot, None, checkpoint)
+        return
+
+    # pages already finished can't be replaced by a new answer, so a long answer is kept as far as it got
+    if config.resume_interrupted_generations == "regenerate" and not checkpoint.get("page_start"):
+        try:
+            async with generation_admission.admit(state.user_id):
+                await regenerate_answer(bot, state, checkpoint)
+            return
+        except Exception as e:
+            logger.warning(f"Failed to regenerate interrupted answer {checkpoint['_id']}, keeping it partial: {e}")
+
+    await finalize_answer(bot, state, checkpoint)
+
+
+async def resume_interrupted_generations(bot, started_before: datetime, shard_index: int = 0):
+    """
+    Completes the answers earlier processes were generating when they died or were shut down
+    """
+    try:
+        checkpoints = await db.get_interrupted_generations(started_before)
+    except Exception as e:
+        logger.exception(f"Failed to load interrupted generations: {str(e)}")
+        return
+
+    if config.shard_workers > 1:
+        # every shard resumes the chats routed to it
+        ring = sharding.HashRing(config.shard_workers)
+        checkpoints = [checkpoint for checkpoint in checkpoints if ring.get_shard(checkpoint["chat_id"]) == shard_index]
+    if len(checkpoints) > 0:
+        logger.info(f"Resuming {len(checkpoints)} interrupted generations")
+
+    async def resume(checkpoint: dict):
+        try:
+            # new messages from the chat wait until the interrupted answer is done
+            async with chat_sequencer.hold(checkpoint["chat_id"]):
+                await resume_generation(bot, checkpoint)
+        except Exception as e:
+            logger.exception(f"Failed to resume generation {checkpoint['_id']}: {str(e)}")
+        await db.delete_generation_checkpoint(checkpoint["_id"])
+
+    await asyncio.gather(*[resume(checkpoint) for checkpoint in checkpoints], return_exceptions=True)
+
+
+def interrupt_generations():
+    n_interrupted = generation_registry.interrupt_all()
+    if n_interrupted > 0:
+        logger.warning(f"Interrupted {n_interrupted} generations still running at shutdown, the next start resumes them")
+
+
+def begin_drain():
+    """
+    Generations in flight get shutdown_drain_timeout seconds to finish, the rest are interrupted and checkpointed
+    """
+    asyncio.get_running_loop().call_later(config.shutdown_drain_timeout, interrupt_generations)
+
+
+async def stop_handle(update: Update, context: CallbackContext):
+    if generation_registry.stop(update.effective_chat.id):
+        await update.message.reply_text("⏹ Stopped")
+    else:
+        await update.message.reply_text("Nothing to stop 🤷‍♂️")
+
+
+def rate_limited(callback):
+    """
+    Takes a token from the user's bucket as soon as a new message arrives, a message sent too fast is turned away
+    before it waits for its turn or supersedes the answer in flight
+    """
+    @functools.wraps(callback)
+    async def rate_limited_callback(update: Update, context: CallbackContext):
+        if update.message is not None:
+            try:
+                generation_admission.take_user_token(update.message.from_user.id)
+            except admission.RateLimitExceeded as e:
+                await update.message.reply_text(f"🐢 Too many messages, please try again in {e.retry_after:.0f}s")
+                return
+        return await callback(update, context)
+
+    return rate_limited_callback
+
+
+def superseding(callback):
+    """
+    Stops the chat's generation in flight before the update waits for its turn, if cancel_superseded_generations.
+    Edited messages are not answered, so they leave the generation running
+    """
+    @functools.wraps(callback)
+    async def superseding_callback(update: Update, context: CallbackContext):
+        if (config.cancel_superseded_generations and update.effective_chat is not None
+                and update.edited_message is None):
+            generation_registry.stop(update.effective_chat.id)
+        return await callback(update, context)
+
+    return superseding_callback
 
 
 async def new_dialog_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    state = await load_user_state(update, update.message.from_user)
+    state.set_user_attribute("last_interaction", datetime.now())
 
-    db.start_new_dialog(user_id)
+    state.start_new_dialog()
+    await state.commit()
     await update.message.reply_text("Starting new dialog ✅")
-    if async_chatgpt_bot is not None:
-        async_chatgpt_bot.reset_chat()
-    if chatgpt_bot is not None:
-        chatgpt_bot.reset_chat()
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = state.get_user_attribute("current_chat_mode")
     await update.message.reply_text(f"{chatgpt.CHAT_MODES[chat_mode]['welcome_message']}",
                                     parse_mode=ParseMode.MARKDOWN)
 
 
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    state = await load_user_state(update, update.message.from_user)
+    state.set_user_attribute("last_interaction", datetime.now())
+    await state.commit()
 
     keyboard = []
     for chat_mode, chat_mode_dict in chatgpt.CHAT_MODES.items():
@@ -228,16 +620,16 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
 
 
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.callback_query.from_user)
-    user_id = update.callback_query.from_user.id
+    state = await load_user_state(update, update.callback_query.from_user)
 
     query = update.callback_query
     await query.answer()
 
     chat_mode = query.data.split("|")[1]
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    state.set_user_attribute("current_chat_mode", chat_mode)
+    state.start_new_dialog()
+    await state.commit()
 
     await query.edit_message_text(
         f"**{chatgpt.CHAT_MODES[chat_mode]['name']}** chat mode is set",
@@ -248,6 +640,23 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
                                   parse_mode=ParseMode.MARKDOWN)
 
 
+async def usage_handle(update: Update, context: CallbackContext):
+    chat_mode_usage, top_users = await db.get_usage()
+
+    text = "📊 <b>Token usage by chat mode</b>\n"
+    for chat_mode_dict in sorted(chat_mode_usage, key=lambda d: d["_id"]):
+        n_tokens = chat_mode_dict["n_prompt_tokens"] + chat_mode_dict["n_completion_tokens"]
+        text += (f"{html.escape(str(chat_mode_dict['_id']))}: {n_tokens} tokens "
+                 f"({chat_mode_dict['n_prompt_tokens']} prompt, {chat_mode_dict['n_completion_tokens']} completion) "
+                 f"in {chat_mode_dict['n_requests']} requests\n")
+
+    text += "\n👤 <b>Top users</b>\n"
+    for user_dict in top_users:
+        text += f"{html.escape(str(user_dict.get('username') or user_dict['_id']))}: {user_dict['n_used_tokens']} tokens\n"
+
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
 async def edited_message_handle(update: Update, context: CallbackContext):
     text = "🥲 Unfortunately, message **editing** is not supported"
     await update.edited_message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
@@ -261,9 +670,10 @@ async def error_handle(update: object, context: CallbackContext) -> None:
         tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
         tb_string = "".join(tb_list)[:2000]
         update_str = update.to_dict() if isinstance(update, Update) else str(update)
+        update_json = log_pipeline.truncate(json.dumps(update_str, indent=2, ensure_ascii=False), 2000)
         message = (
             f"An exception was raised while handling an update\n"
-            f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
+            f"<pre>update = {html.escape(update_json)}"
             "</pre>\n\n"
             f"<pre>{html.escape(tb_string)}</pre>"
         )
@@ -283,18 +693,97 @@ async def error_handle(update: object, context: CallbackContext) -> None:
                                        text="Some error in error handler")
 
 
-def run_bot() -> None:
-    application = (
+async def migrate_database():
+    try:
+        await db.migrate()
+    except Exception as e:
+        logger.exception(f"Database migration failed: {str(e)}")
+
+
+def on_stop_signal():
+    begin_drain()
+    # what python-telegram-bot does on a stop signal
+    raise SystemExit
+
+
+async def post_init(application) -> None:
+    # checkpoints written before this point belong to earlier processes
+    started_at = datetime.now()
+
+    db.start()
+    telegram_edit_scheduler.start()
+    usage_tracker.start()
+    dialog_summarizer.start()
+    typing_ticker.start(application.bot)
+    if metrics_server is not None:
+        await metrics_server.start()
+
+    # polling starts right away, indexes and backfills catch up in the background
+    # with sharding enabled only the first shard migrates
+    if application.bot_data.get("shard_index", 0) == 0:
+        application.bot_data["migration_task"] = asyncio.create_task(migrate_database())
+
+    if config.resume_interrupted_generations != "off" and db.generation_journal is not None:
+        application.bot_data["resume_task"] = asyncio.create_task(
+            resume_interrupted_generations(application.bot, started_at, application.bot_data.get("shard_index", 0))
+        )
+
+    # shard workers ignore stop signals, the dispatcher stops them
+    if application.updater is not None:
+        loop = asyncio.get_running_loop()
+        with contextlib.suppress(NotImplementedError):
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signal_number, on_stop_signal)
+
+
+async def post_shutdown(application) -> None:
+    resume_task = application.bot_data.get("resume_task")
+    if resume_task is not None:
+        # checkpoints of answers not resumed yet stay for the next start
+        resume_task.cancel()
+
+    # a failing step doesn't keep the ones after it from running, the write-behind journals are flushed in any case
+    shutdown_steps = [
+        ("stop the metrics server", metrics_server.stop if metrics_server is not None else None),
+        ("stop the typing ticker", typing_ticker.stop),
+        ("stop the edit scheduler", telegram_edit_scheduler.stop),
+        ("stop the dialog summarizer", dialog_summarizer.stop),
+        ("flush token usage", usage_tracker.stop),
+        *((f"close the {name} backend", backend.close) for name, backend in completion_backends.items()),
+        ("flush the write-behind journals", db.stop),
+    ]
+    for description, step in shutdown_steps:
+        if step is None:
+            continue
+        try:
+            await step()
+        except Exception as e:
+            logger.exception(f"Failed to {description} at shutdown: {str(e)}")
+    db.close()
+
+
+def build_application(receive_updates: bool = True):
+    application_builder = (
         ApplicationBuilder()
         .token(config.telegram_token)
         # .connect_timeout(60)
         # .read_timeout(60)
         # .write_timeout(60)
         # .pool_timeout(60)
-        .request(HTTPXRequest(http_version="1.1"))
-        .get_updates_request(HTTPXRequest(http_version="1.1"))
-        .build()
+        .request(HTTPXRequest(http_version="1.1", connection_pool_size=config.telegram_connection_pool_size))
+        .get_updates_request(HTTPXRequest(http_version="1.1",
+                                          connection_pool_size=config.telegram_get_updates_connection_pool_size))
+        .concurrent_updates(config.concurrent_updates)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    if config.telegram_api_base_url:
+        # e.g. a local fake Bot API server
+        application_builder = application_builder.base_url(config.telegram_api_base_url)
+    if not receive_updates:
+        # shard workers get their updates from the dispatcher
+        application_builder = application_builder.updater(None)
+    application = application_builder.build()
 
     # add handlers
     if len(config.allowed_telegram_usernames) == 0:
@@ -302,21 +791,114 @@ def run_bot() -> None:
     else:
         user_filter = filters.User(username=config.allowed_telegram_usernames)
 
-    application.add_handler(CommandHandler("start", start_handle, filters=user_filter))
-    application.add_handler(CommandHandler("help", help_handle, filters=user_filter))
+    def instrumented(callback):
+        return metrics.instrument_handler(log_pipeline.with_request_id(callback))
+
+    def sequential(callback):
+        return instrumented(chat_sequencer.wrap(callback))
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, message_handle))
-    application.add_handler(CommandHandler("retry", retry_handle, filters=user_filter))
-    application.add_handler(CommandHandler("new", new_dialog_handle, filters=user_filter))
+    application.add_handler(CommandHandler("start", sequential(start_handle), filters=user_filter))
+    application.add_handler(CommandHandler("help", sequential(help_handle), filters=user_filter))
 
-    application.add_handler(CommandHandler("mode", show_chat_modes_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(set_chat_mode_handle, pattern="^set_chat_mode"))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter,
+                                           rate_limited(superseding(sequential(message_handle)))))
+    application.add_handler(CommandHandler("retry", rate_limited(superseding(sequential(retry_handle))),
+                                           filters=user_filter))
+    application.add_handler(CommandHandler("new", superseding(sequential(new_dialog_handle)), filters=user_filter))
+    # /stop must not wait behind the generation it stops
+    application.add_handler(CommandHandler("stop", instrumented(stop_handle), filters=user_filter))
+
+    application.add_handler(CommandHandler("mode", sequential(show_chat_modes_handle), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(superseding(sequential(set_chat_mode_handle)),
+                                                 pattern="^set_chat_mode"))
+
+    if len(config.admin_telegram_usernames) > 0:
+        admin_filter = filters.User(username=config.admin_telegram_usernames)
+        application.add_handler(CommandHandler("usage", instrumented(usage_handle), filters=admin_filter))
 
     application.add_error_handler(error_handle)
+    return application
+
+
+async def serve_shard(shard_index: int, update_queue) -> None:
+    application = build_application(receive_updates=False)
+    application.bot_data["shard_index"] = shard_index
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    logger.info(f"Shard {shard_index} is ready")
+    try:
+        await sharding.forward_updates(update_queue, application)
+    finally:
+        # handle everything already forwarded before shutting down
+        begin_drain()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+def run_shard_worker(shard_index: int, update_queue) -> None:
+    """
+    Entry point of a shard worker process, runs the regular handlers on the chats routed to this shard
+    """
+    global metrics_server
+
+    # the dispatcher handles Ctrl+C and SIGTERM and stops the workers once it stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    if metrics_server is not None:
+        metrics_server = metrics.MetricsServer(config.metrics_host, config.metrics_port + shard_index)
+    if shard_index > 0:
+        # archival runs once per deployment, on the first shard
+        config.archive_dialogs_after_days = 0
+
+    asyncio.run(serve_shard(shard_index, update_queue))
+
+
+def run_sharded_bot() -> None:
+    dispatcher = sharding.ShardDispatcher(
+        run_shard_worker,
+        config.shard_workers,
+        config.telegram_token,
+        telegram_api_base_url=config.telegram_api_base_url
+    )
+
+    logger.info(f"Booting ChatGPT bot with {config.shard_workers} shards")
+    if config.webhook_url:
+        dispatcher.run(webhook=dict(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=config.webhook_path,
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret_token,
+            max_connections=config.webhook_max_connections
+        ))
+    else:
+        dispatcher.run()
+
+
+def run_bot() -> None:
+    if config.shard_workers > 1:
+        run_sharded_bot()
+        return
+
+    application = build_application()
 
     # start the bot
     logger.info("Booting ChatGPT bot successfully")
-    application.run_polling()
+    if config.webhook_url:
+        application.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=config.webhook_path,
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret_token or None,
+            max_connections=config.webhook_max_connections
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import asyncio
+import contextlib
+from typing import Optional
+
+
+class Generation:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.stopped = False
+        # interrupted by a shutdown, the checkpoint stays behind so the next start resumes it
+        self.interrupted = False
+
+
+class CancellationRegistry:
+    """
+    Generations in flight keyed by chat. Stopping one cancels the task streaming it, which closes the upstream
+    stream at its next await, and marks it stopped so the partial answer is kept instead of discarded
+    """
+
+    def __init__(self):
+        self.generations = {}
+
+    @contextlib.contextmanager
+    def track(self, chat_id: int):
+        generation = Generation(asyncio.current_task())
+        self.generations[chat_id] = generation
+        try:
+            yield generation
+        finally:
+            if self.generations.get(chat_id) is generation:
+                del self.generations[chat_id]
+
+            # the stop was handled, later timeouts of the task must not mistake it for a pending cancellation
+            if (generation.stopped or generation.interrupted) and hasattr(generation.task, "uncancel"):
+                generation.task.uncancel()
+
+    def get(self, chat_id: int) -> Optional[Generation]:
+        return self.generations.get(chat_id)
+
+    def stop(self, chat_id: int) -> bool:
+        generation = self.generations.get(chat_id)
+        if generation is None or generation.stopped:
+            return False
+
+        generation.stopped = True
+        generation.task.cancel()
+        return True
+
+    def interrupt_all(self) -> int:
+        """
+        Cancels every generation still running, e.g. when the shutdown drain timeout has passed
+        """
+        n_interrupted = 0
+        for generation in self.generations.values():
+            if not generation.stopped and not generation.interrupted:
+                generation.interrupted = True
+                generation.task.cancel()
+                n_interrupted += 1
+        return n_interrupted
@@ -1,16 +1,31 @@
 import asyncio
+import contextlib
 import logging
+import time
+from typing import Callable, Optional
 
-from httpx import HTTPError
-from revChatGPT.V1 import Chatbot, AsyncChatbot
 from telegram import Message, Update
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, RetryAfter
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 
+import config
+import log_pipeline
+import metrics
+import tokenizer
 import utils
+from backends import Backend, Conversation
+from cancellation import Generation
+from edit_scheduler import EditScheduler, StreamedMessage
+from markdown_renderer import MarkdownPager
+from response_cache import ResponseCache
+from utils import TypingTicker
 
 logger = logging.getLogger(__name__)
+# whole prompts, sampled before the record is created
+prompt_logger = log_pipeline.CategoryLogger(logger, "prompt")
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
 
 CHAT_MODES = {
     "normal": {
@@ -21,142 +36,299 @@ CHAT_MODES = {
     "assistant": {
         "name": "👩🏼‍🎓 Assistant",
         "welcome_message": "👩🏼‍🎓 Hi, I'm **ChatGPT assistant**. How can I help you?",
-        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to assist users to the best of your ability. This may involve answering questions, providing helpful information, or completing tasks based on user input. In order to effectively assist users, it is important to be detailed and thorough in your responses. Use examples and evidence to support your points and justify your recommendations or solutions. Remember to always prioritize the needs and satisfaction of the user. Your ultimate goal is to provide a helpful and enjoyable experience for the user."
+        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to assist users to the best of your ability. This may involve answering questions, providing helpful information, or completing tasks based on user input. In order to effectively assist users, it is important to be detailed and thorough in your responses. Use examples and evidence to support your points and justify your recommendations or solutions. Remember to always prioritize the needs and satisfaction of the user. Your ultimate goal is to provide a helpful and enjoyable experience for the user.",
+        "context_token_budget": 1500
     },
 
     "code_assistant": {
         "name": "👩🏼‍💻 Code Assistant",
         "welcome_message": "👩🏼‍💻 Hi, I'm **ChatGPT code assistant**. How can I help you?",
-        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to assist users to write code. This may involve designing/writing/editing/describing code or providing helpful information. Where possible you should provide code examples to support your points and justify your recommendations or solutions. Make sure the code you provide is correct and can be run without errors. Be detailed and thorough in your responses. Your ultimate goal is to provide a helpful and enjoyable experience for the user. Write code inside <code>, </code> tags."
+        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to assist users to write code. This may involve designing/writing/editing/describing code or providing helpful information. Where possible you should provide code examples to support your points and justify your recommendations or solutions. Make sure the code you provide is correct and can be run without errors. Be detailed and thorough in your responses. Your ultimate goal is to provide a helpful and enjoyable experience for the user. Write code inside <code>, </code> tags.",
+        "context_token_budget": 1500
     },
 
     "text_improver": {
         "name": "📝 Text Improver",
         "welcome_message": "📝 Hi, I'm **ChatGPT text improver**. Send me any text – I'll improve it and correct all the mistakes",
-        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to correct spelling, fix mistakes and improve text sent by user. Your goal is to edit text, but not to change it's meaning. You can replace simplified A0-level words and sentences with more beautiful and elegant, upper level words and sentences. All your answers strictly follows the structure (keep html tags):\n<b>Edited text:</b>\n{EDITED TEXT}\n\n<b>Correction:</b>\n{NUMBERED LIST OF CORRECTIONS}"
+        "prompt_start": "As an advanced chatbot named ChatGPT, your primary goal is to correct spelling, fix mistakes and improve text sent by user. Your goal is to edit text, but not to change it's meaning. You can replace simplified A0-level words and sentences with more beautiful and elegant, upper level words and sentences. All your answers strictly follows the structure (keep html tags):\n<b>Edited text:</b>\n{EDITED TEXT}\n\n<b>Correction:</b>\n{NUMBERED LIST OF CORRECTIONS}",
+        "context_token_budget": 0
     },
 
     "movie_expert": {
         "name": "🎬 Movie Expert",
         "welcome_message": "🎬 Hi, I'm **ChatGPT movie expert**. How can I help you?",
-        "prompt_start": "As an advanced movie expert chatbot named ChatGPT, your primary goal is to assist users to the best of your ability. You can answer questions about movies, actors, directors, and more. You can recommend movies to users based on their preferences. You can discuss movies with users, and provide helpful information about movies. In order to effectively assist users, it is important to be detailed and thorough in your responses. Use examples and evidence to support your points and justify your recommendations or solutions. Remember to always prioritize the needs and satisfaction of the user. Your ultimate goal is to provide a helpful and enjoyable experience for the user."
+        "prompt_start": "As an advanced movie expert chatbot named ChatGPT, your primary goal is to assist users to the best of your ability. You can answer questions about movies, actors, directors, and more. You can recommend movies to users based on their preferences. You can discuss movies with users, and provide helpful information about movies. In order to effectively assist users, it is important to be detailed and thorough in your responses. Use examples and evidence to support your points and justify your recommendations or solutions. Remember to always prioritize the needs and satisfaction of the user. Your ultimate goal is to provide a helpful and enjoyable experience for the user.",
+        "context_token_budget": 1500
     },
 }
 
 
 class ChatGPT:
-    def __init__(self, gpt_bot: Chatbot = None, async_gpt_bot: AsyncChatbot = None):
-        self.gpt_bot = gpt_bot
-        self.async_gpt_bot = async_gpt_bot
+    def __init__(self, backend: Backend, edit_scheduler: EditScheduler = None, typing_ticker: TypingTicker = None,
+                 response_cache: ResponseCache = None):
+        self.backend = backend
+        self.edit_scheduler = edit_scheduler
+        self.typing_ticker = typing_ticker
+        self.response_cache = response_cache
 
-    def send_message(self, message, dialog_messages=[], chat_mode="normal", conversation_id: str = None,
-                     parent_id: str = None):
+    async def async_send_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message: str,
+                                 dialog_messages=[], chat_mode="normal", conversation: Conversation = None,
+                                 generation: Generation = None, dialog_summary: str = None,
+                                 checkpoint: Callable[[dict], None] = None):
+        """
+        Streams the answer into the chat and returns it with the prompt, the conversation is updated in place.
+        When generation is stopped the stream is closed and the partial answer is returned.
+        checkpoint is called with the streaming state after every chunk
+        """
         if chat_mode not in CHAT_MODES.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-        answer = None
-        prompt = None
-        while answer is None:
-            prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-            logger.info(f"Ask ChatGPT: {prompt}")
-            try:
-                for data in self.gpt_bot.ask(prompt, conversation_id=conversation_id, parent_id=parent_id):
-                    answer = data['message']
-                    conversation_id = data['conversation_id']
-                    parent_id = data['parent_id']
-                answer = self._postprocess_answer(answer)
+        conversation = conversation or Conversation()
 
-            except Exception as e:
-                logger.error(f"Ask ChatGPT error: {str(e)}")
-                if len(dialog_messages) == 0:
-                    raise ValueError(f"ChatGPT Bot error: {str(e)}") from e
+        # show "typing..." until the first chunk arrives
+        self.typing_ticker.register(update.effective_chat.id)
+        is_typing = True
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        prompt, history_prompt = self._generate_prompts(message, dialog_messages, chat_mode, self.backend.is_stateful,
+                                                        dialog_summary, conversation.conversation_id)
+        session = conversation.session
+        prompt_logger.info("Ask ChatGPT: %s", prompt)
 
-        return answer, prompt, conversation_id, parent_id,
+        # answers longer than one Telegram message are streamed into a chain of pages,
+        # only the last page is still being edited
+        pager = MarkdownPager()
+        tail_page: StreamedMessage or None = None
+        n_pages = 0
+        chunk_text = ''
+        cache_key = None
+        stopped = False
 
-    async def async_send_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, dialog_messages=[],
-                                 chat_mode="normal", conversation_id: str = None,
-                                 parent_id: str = None):
-        if chat_mode not in CHAT_MODES.keys():
-            raise ValueError(f"Chat mode {chat_mode} is not supported")
+        try:
+            # a hit wouldn't advance the upstream conversation, so a stateful backend only reuses answers
+            # for a conversation that hasn't started yet
+            if (self.response_cache is not None and self.response_cache.is_enabled(chat_mode)
+                    and not (self.backend.is_stateful and conversation.conversation_id is not None)):
+                cache_key = self.response_cache.make_key(self.backend.name, chat_mode, prompt)
+                cached_answer = await self.response_cache.get(cache_key)
+                if cached_answer is not None:
+                    metrics.response_cache_hits.labels(chat_mode).inc()
+                    # a hit goes through the same reply path as a single chunk answer
+                    answer_chunks = utils.iterate_async([cached_answer])
+                    cache_key = None
+                else:
+                    metrics.response_cache_misses.labels(chat_mode).inc()
+                    answer_chunks = self.backend.ask(prompt, conversation, history_prompt=history_prompt)
+            else:
+                answer_chunks = self.backend.ask(prompt, conversation, history_prompt=history_prompt)
+            start_time = time.perf_counter()
+
+            async with contextlib.aclosing(answer_chunks) as chunks:
+                async for chunk_text in chunks:
+                    if is_typing:
+                        self.typing_ticker.unregister(update.effective_chat.id)
+                        is_typing = False
+                        metrics.generation_first_chunk_seconds.labels(chat_mode).observe(
+                            time.perf_counter() - start_time
+                        )
+
+                    # seal every page that can no longer change
+                    for page_html, page_text, has_text in pager.feed(chunk_text):
+                        if tail_page is not None:
+                            await self._finish_page(tail_page, page_html, page_text)
+                            tail_page = None
+                        elif has_text:
+                            await self.send_page(update, context, page_html, plain_text=page_text)
+                            n_pages += 1
+
+                    if tail_page is not None:
+                        self.edit_scheduler.update(tail_page, pager.renderer.render())
+                    elif pager.renderer.has_text:
+                        tail_page = self.edit_scheduler.register(
+                            await self.send_page(update, context, pager.renderer.render() + '...',
+                                                 plain_text=chunk_text[pager.page_start:].strip() + '...'),
+                            parse_mode=ParseMode.HTML
+                        )
+                        n_pages += 1
 
-        # Send "Typing..." action periodically every 4 seconds until the response is received
-        typing_task = context.application.create_task(utils.send_typing_periodically(update, context, 4))
+                    if checkpoint is not None:
+                        checkpoint({
+                            "text": chunk_text,
+                            "page_start": pager.page_start,
+                            "tail_message_id": tail_page.message.message_id if tail_page is not None else None,
+                            "answer_conversation_id": conversation.conversation_id,
+                            "answer_parent_id": conversation.parent_id,
+                        })
+        except asyncio.CancelledError:
+            if generation is None or not generation.stopped:
+                self._abandon_streaming(update, is_typing, tail_page)
+                raise
+            # stopped on request, leaving the stream closed the upstream request and the partial answer is kept
+            stopped = True
+        except Exception as e:
+            metrics.generation_errors.labels(chat_mode).inc()
+            logger.exception("Ask ChatGPT bot fail: %s", e)
+            self._abandon_streaming(update, is_typing, tail_page)
+            raise e
 
-        prompt = self._generate_prompt(update.message.text, dialog_messages, chat_mode)
+        if is_typing:
+            self.typing_ticker.unregister(update.effective_chat.id)
+        if history_prompt is not None and conversation.session != session:
+            # the conversation was started over on another session, so the history went with the message
+            prompt = history_prompt
+        if stopped:
+            metrics.generations_stopped.labels(chat_mode).inc()
+            if tail_page is not None:
+                await self._finish_page(tail_page, pager.renderer.finish(), chunk_text[pager.page_start:].strip())
+            return self._postprocess_answer(chunk_text), prompt
+        if n_pages == 0:
+            metrics.generation_errors.labels(chat_mode).inc()
+            raise ValueError("ChatGPT Bot error: empty answer")
+        metrics.generation_seconds.labels(chat_mode).observe(time.perf_counter() - start_time)
 
-        initial_message: Message or None = None
-        chunk_index, chunk_text = (0, '')
+        answer = self._postprocess_answer(chunk_text)
+        try:
+            if tail_page is not None:
+                await self._finish_page(tail_page, pager.renderer.finish(), chunk_text[pager.page_start:].strip())
+            if cache_key is not None:
+                await self.response_cache.set(cache_key, answer)
+        except asyncio.CancelledError:
+            if generation is None or not generation.stopped:
+                raise
+            # stopped while the last edit was made, the whole answer is already streamed and kept
+            metrics.generations_stopped.labels(chat_mode).inc()
+            if tail_page is not None:
+                await self._finish_page(tail_page, pager.renderer.finish(), chunk_text[pager.page_start:].strip())
+        return answer, prompt
 
-        async def message_update(every_seconds: float):
-            while True:
-                try:
-                    if initial_message is not None and chunk_text != initial_message.text:
-                        await initial_message.edit_text(chunk_text)
-                except (BadRequest, HTTPError, RetryAfter):
-                    pass
-                except Exception as emsg:
-                    typing_task.cancel()
-                    logger.exception(f"Error while editing the message: {str(emsg)}")
-                    raise emsg
+    def _abandon_streaming(self, update: Update, is_typing: bool, tail_page: Optional[StreamedMessage]):
+        if is_typing:
+            self.typing_ticker.unregister(update.effective_chat.id)
+        if tail_page is not None:
+            self.edit_scheduler.unregister(tail_page)
 
-                await asyncio.sleep(every_seconds)
+    @staticmethod
+    async def send_page(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str,
+                        parse_mode: str = ParseMode.HTML, plain_text: str = None) -> Message:
+        try:
+            return await context.bot.send_message(chat_id=update.effective_chat.id,
+                                                  text=text,
+                                                  parse_mode=parse_mode,
+                                                  reply_to_message_id=update.message.message_id)
+        except BadRequest:
+            if parse_mode is None:
+                raise
 
-        message_update_task = context.application.create_task(message_update(every_seconds=0.5))
-        # try:
-        #     await asyncio.wait_for(typing_task, 300)
-        # except TimeoutError:
-        #     logger.error("Ask timeout")
-        #     raise RuntimeError("Ask timeout")
+            # rendered pages are balanced, this is only a safety net, so the page is sent as it was written
+            logger.warning("Telegram rejected a rendered page: %s", text)
+            return await context.bot.send_message(chat_id=update.effective_chat.id,
+                                                  text=plain_text or text,
+                                                  reply_to_message_id=update.message.message_id)
 
+    async def _finish_page(self, page: StreamedMessage, page_html: str, text: str):
         try:
-            async for chunk in self.async_gpt_bot.ask(prompt, conversation_id=conversation_id, parent_id=parent_id):
-                if chunk_index == 0 and initial_message is None:
-                    conversation_id = chunk['conversation_id']
-                    parent_id = chunk['parent_id']
-                    initial_message = await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        reply_to_message_id=update.message.message_id,
-                        text=chunk['message'] + '...'
-                    )
-                chunk_index, chunk_text = (chunk_index + 1, chunk['message'])
-        except Exception as e:
-            logger.exception(f"Ask ChatGPT bot fail: {str(e)}")
-            typing_task.cancel()
-            message_update_task.cancel()
-            raise e
+            await self.edit_scheduler.finish(page, page_html, parse_mode=ParseMode.HTML)
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+
+            logger.warning("Telegram rejected a rendered page: %s", page_html)
+            try:
+                await self.edit_scheduler.finish(page, text)
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+
+    @staticmethod
+    def _format_dialog_message(user_text: str, bot_text: str) -> str:
+        return f"User: {user_text}\nChatGPT: {bot_text}\n"
+
+    @staticmethod
+    def count_dialog_message_tokens(user_text: str, bot_text: str) -> int:
+        """
+        Token count of a dialog message as it appears in the prompt, stored with the message so it's computed once
+        """
+        return tokenizer.count_tokens(ChatGPT._format_dialog_message(user_text, bot_text))
+
+    @staticmethod
+    def _select_dialog_messages(dialog_messages, token_budget: int) -> list:
+        # newest turns first, stop at the first one that no longer fits
+        selected_messages = []
+        n_tokens = 0
+        for dialog_message in reversed(dialog_messages):
+            n_message_tokens = dialog_message.get("n_tokens")
+            if n_message_tokens is None:
+                n_message_tokens = ChatGPT.count_dialog_message_tokens(dialog_message["user"], dialog_message["bot"])
+
+            if n_tokens + n_message_tokens > token_budget:
+                break
+            n_tokens += n_message_tokens
+            selected_messages.append(dialog_message)
 
-        message_update_task.cancel()
-        typing_task.cancel()
-        await initial_message.edit_text(chunk_text, parse_mode=ParseMode.MARKDOWN)
-        return chunk_text, prompt, conversation_id, parent_id
+        return selected_messages[::-1]
 
-    def reset_bot(self, conversation_id):
-        if conversation_id is None:
-            self.async_gpt_bot.conversation_id = None
-            self.async_gpt_bot.parent_id = None
+    @staticmethod
+    def _context_token_budget(chat_mode: str) -> int:
+        return config.context_token_budgets.get(
+            chat_mode,
+            CHAT_MODES[chat_mode].get("context_token_budget", DEFAULT_CONTEXT_TOKEN_BUDGET)
+        )
+
+    @staticmethod
+    def uses_dialog_history(chat_mode: str, stateful_backend: bool = True) -> bool:
+        """
+        Whether prompts of the chat mode carry the dialog history themselves
+        """
+        # a stateful backend keeps the history upstream, it is only quoted when a conversation starts over
+        if stateful_backend:
+            return False
+        return ChatGPT._context_token_budget(chat_mode) > 0
 
     @staticmethod
-    def _generate_prompt(message, dialog_messages, chat_mode):
-        if chat_mode != "normal":
-            prompt = CHAT_MODES[chat_mode]["prompt_start"]
+    def _generate_prompt(message, dialog_messages, chat_mode, stateful_backend: bool = True, dialog_summary: str = None,
+                         conversation_id: str = None):
+        # the upstream conversation of a stateful backend already holds the prompt start and every earlier turn
+        if stateful_backend and conversation_id is not None:
+            return message
+
+        prompt = CHAT_MODES[chat_mode]["prompt_start"]
+        if len(prompt) > 0:
             prompt += "\n\n"
 
-            # add chat context
-            # if len(dialog_messages) > 0:
-            #     prompt += "Chat:\n"
-            #     for dialog_message in dialog_messages:
-            #         prompt += f"User: {dialog_message['user']}\n"
-            #         prompt += f"ChatGPT: {dialog_message['bot']}\n"
+        # older turns are folded into the summary, only the recent ones are quoted
+        if dialog_summary:
+            prompt += f"Summary of the earlier conversation:\n{dialog_summary}\n\n"
 
-            # current message
-            prompt += f"User: {message}\n"
-            prompt += "ChatGPT: "
+        # add chat context
+        token_budget = ChatGPT._context_token_budget(chat_mode)
+        context_messages = ChatGPT._select_dialog_messages(dialog_messages, token_budget)
+        if len(context_messages) > 0:
+            prompt += "Chat:\n"
+            for dialog_message in context_messages:
+                prompt += ChatGPT._format_dialog_message(dialog_message["user"], dialog_message["bot"])
 
-            return prompt
-        return message
+        # a new upstream conversation with nothing to set it up starts with the message itself
+        if stateful_backend and len(prompt) == 0:
+            return message
+
+        # current message
+        prompt += f"User: {message}\n"
+        prompt += "ChatGPT: "
+
+        return prompt
+
+    @staticmethod
+    def _generate_prompts(message, dialog_messages, chat_mode, stateful_backend: bool, dialog_summary: str = None,
+                          conversation_id: str = None) -> tuple:
+        """
+        Returns the prompt and, for a conversation a stateful backend continues, the prompt it sends instead
+        if it has to start the conversation over, e.g. on another session
+        """
+        prompt = ChatGPT._generate_prompt(message, dialog_messages, chat_mode, stateful_backend, dialog_summary,
+                                          conversation_id)
+        history_prompt = None
+        if stateful_backend and conversation_id is not None:
+            history_prompt = ChatGPT._generate_prompt(message, dialog_messages, chat_mode, True, dialog_summary)
+        return prompt, history_prompt
 
     @staticmethod
     def _postprocess_answer(answer):
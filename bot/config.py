@@ -1,9 +1,11 @@
+import os
 from pathlib import Path
 
 import dotenv
 import yaml
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+# CONFIG_DIR points to another directory holding config.yml and config.env, e.g. for tests
+config_dir = Path(os.environ.get("CONFIG_DIR") or Path(__file__).parent.parent.resolve() / "config")
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -21,4 +23,63 @@ mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 # mongodb_uri = f"mongodb://devbox:{config_env['MONGODB_PORT']}"
 openai_email = config_yaml["openai_email"]
 openai_password = config_yaml["openai_password"]
+# several upstream accounts can be pooled, each entry is {"email": ..., "password": ...}
+openai_accounts = config_yaml.get("openai_accounts") or [{"email": openai_email, "password": openai_password}]
+openai_session_concurrency = config_yaml.get("openai_session_concurrency", 1)
+openai_session_cooldown = config_yaml.get("openai_session_cooldown", 60)
 use_stream = (config_yaml["use_stream"] or 'True') == 'True'
+mongodb_max_workers = config_yaml.get("mongodb_max_workers", 8)
+dialog_messages_tail = config_yaml.get("dialog_messages_tail", 20)
+sync_ask_workers = config_yaml.get("sync_ask_workers", 4)
+sync_ask_timeout = config_yaml.get("sync_ask_timeout", 300)
+telegram_edits_per_second = config_yaml.get("telegram_edits_per_second", 25)
+telegram_chat_edit_interval = config_yaml.get("telegram_chat_edit_interval", 1.0)
+concurrent_updates = config_yaml.get("concurrent_updates", 64)
+telegram_connection_pool_size = config_yaml.get("telegram_connection_pool_size", 64)
+telegram_get_updates_connection_pool_size = config_yaml.get("telegram_get_updates_connection_pool_size", 1)
+telegram_api_base_url = config_yaml.get("telegram_api_base_url", "")
+webhook_url = config_yaml.get("webhook_url", "")
+webhook_listen = config_yaml.get("webhook_listen", "0.0.0.0")
+webhook_port = config_yaml.get("webhook_port", 8443)
+webhook_path = config_yaml.get("webhook_path", "telegram")
+webhook_secret_token = config_yaml.get("webhook_secret_token", "")
+webhook_max_connections = config_yaml.get("webhook_max_connections", 40)
+shard_workers = config_yaml.get("shard_workers", 0)
+max_inflight_generations = config_yaml.get("max_inflight_generations", 32)
+user_messages_per_minute = config_yaml.get("user_messages_per_minute", 10)
+user_messages_burst = config_yaml.get("user_messages_burst", 5)
+context_token_budgets = config_yaml.get("context_token_budgets") or {}
+admin_telegram_usernames = config_yaml.get("admin_telegram_usernames") or []
+usage_flush_interval = config_yaml.get("usage_flush_interval", 30)
+default_backend = config_yaml.get("default_backend", "revchatgpt")
+chat_mode_backends = config_yaml.get("chat_mode_backends") or {}
+openai_model = config_yaml.get("openai_model", "gpt-3.5-turbo")
+openai_api_base_url = config_yaml.get("openai_api_base_url", "https://api.openai.com/v1")
+openai_request_timeout = config_yaml.get("openai_request_timeout", 120)
+openai_max_connections = config_yaml.get("openai_max_connections", 100)
+response_cache_modes = config_yaml.get("response_cache_modes") or []
+response_cache_size = config_yaml.get("response_cache_size", 1000)
+response_cache_ttl = config_yaml.get("response_cache_ttl", 86400)
+response_cache_shared = config_yaml.get("response_cache_shared", False)
+metrics_host = config_yaml.get("metrics_host", "127.0.0.1")
+metrics_port = config_yaml.get("metrics_port", 0)
+upstream_token_cache_path = config_dir.parent / config_yaml.get("upstream_token_cache_path", "config/tokens/upstream_tokens.json")
+upstream_token_refresh_margin = config_yaml.get("upstream_token_refresh_margin", 3600)
+upstream_token_refresh_interval = config_yaml.get("upstream_token_refresh_interval", 600)
+user_write_behind_interval = config_yaml.get("user_write_behind_interval", 5)
+user_write_behind_max_pending = config_yaml.get("user_write_behind_max_pending", 1000)
+archive_dialogs_after_days = config_yaml.get("archive_dialogs_after_days", 30)
+archive_interval = config_yaml.get("archive_interval", 3600)
+archive_batch_size = config_yaml.get("archive_batch_size", 100)
+archive_batch_pause = config_yaml.get("archive_batch_pause", 1.0)
+cancel_superseded_generations = config_yaml.get("cancel_superseded_generations", True)
+summarize_after_messages = config_yaml.get("summarize_after_messages", 16)
+summary_keep_recent_messages = config_yaml.get("summary_keep_recent_messages", 6)
+summary_max_words = config_yaml.get("summary_max_words", 200)
+log_level = config_yaml.get("log_level", "INFO")
+log_format = config_yaml.get("log_format", "text")
+log_sample_rates = config_yaml.get("log_sample_rates", {"prompt": 0.1, "httpx": 0.01})
+log_max_payload_length = config_yaml.get("log_max_payload_length", 500)
+generation_checkpoint_interval = config_yaml.get("generation_checkpoint_interval", 5)
+resume_interrupted_generations = config_yaml.get("resume_interrupted_generations", "regenerate")
+shutdown_drain_timeout = config_yaml.get("shutdown_drain_timeout", 8)
@@ -1,31 +1,305 @@
 import asyncio
+import contextvars
+import functools
+import logging
+import time
 import uuid
-from datetime import datetime
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Optional, Any
 
+import bson
 import pymongo
+from bson.binary import Binary
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne, monitoring
 
 import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# fields handlers read from the per-update snapshot
+USER_STATE_PROJECTION = {"current_dialog_id": 1, "current_chat_mode": 1, "last_interaction": 1}
+DIALOG_STATE_PROJECTION = {
+    "user_id": 1,
+    "conversation_id": 1,
+    "chat_mode": 1,
+    "upstream_session": 1,
+    "n_messages": 1,
+    "summary": 1,
+    "n_summarized_messages": 1,
+    "messages": {"$slice": -config.dialog_messages_tail}
+}
+
+
+# index plan, created and verified at startup: (collection attribute, keys, options)
+INDEXES = [
+    # dialogs of a user, newest first
+    ("dialog_collection", [("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)], {}),
+    # the archival job scans for the least recently active dialogs
+    ("dialog_collection", [("updated_at", pymongo.ASCENDING)], {}),
+    # /usage lists the heaviest users
+    ("user_collection", [("n_used_tokens", pymongo.DESCENDING)], {}),
+    ("dialog_archive_collection", [("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)], {}),
+    # cached responses expire on their own
+    ("response_cache_collection", [("created_at", pymongo.ASCENDING)],
+     {"expireAfterSeconds": config.response_cache_ttl}),
+]
+
+# user attributes that are written right away, everything else goes through the write-behind journal.
+# current_dialog_id points at a dialog that is inserted synchronously, so it has to be as durable as the dialog,
+# and current_chat_mode has to match the mode that dialog is started in
+SYNCHRONOUS_USER_ATTRIBUTES = {"current_dialog_id", "current_chat_mode"}
+
+
+# latencies of the round trips made by the Database._run call running in this context
+_round_trip_seconds = contextvars.ContextVar("round_trip_seconds", default=None)
+
+
+class _RoundTripListener(monitoring.CommandListener):
+    """
+    Collects the latency of every command sent to the server. It runs on the Mongo threads, so the latencies are
+    handed to the calling Database._run, which observes them on the event loop
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    @staticmethod
+    def _record(event):
+        round_trip_seconds = _round_trip_seconds.get()
+        if round_trip_seconds is not None:
+            round_trip_seconds.append(event.duration_micros / 1e6)
+
+
+class WriteBehindJournal:
+    """
+    Coalesces $set updates per document in memory and writes them every flush_interval seconds as one unordered
+    bulk_write, or earlier once max_pending documents are waiting. Pending values are overlaid on reads,
+    so this process always sees its own writes. Whatever is pending when the process dies is lost.
+    A document deleted through the journal is pending as None until the delete is written
+    """
+
+    def __init__(self, db: "Database", collection, flush_interval: float = 5, max_pending: int = 1000,
+                 upsert: bool = False):
+        self.db = db
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.upsert = upsert
+
+        self.pending = {}
+        # updates of the bulk_write in flight, still overlaid until it completes
+        self.flushing = {}
+        # documents upserted by this journal, a document deleted before it was ever written costs no round trip
+        self.written = set()
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.n_updates = 0
+        self.n_flushed_documents = 0
+        self.n_flushes = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        await self.flush()
+
+    def set(self, document_id, updates: dict):
+        pending_updates = self.pending.get(document_id)
+        if pending_updates is None:
+            self.pending[document_id] = dict(updates)
+        else:
+            pending_updates.update(updates)
+        self.n_updates += 1
+        if len(self.pending) >= self.max_pending:
+            self.wakeup.set()
+
+    def delete(self, document_id):
+        if self.upsert and document_id not in self.written and document_id not in self.flushing:
+            self.pending.pop(document_id, None)
+            return
+
+        self.pending[document_id] = None
+        self.n_updates += 1
+        if len(self.pending) >= self.max_pending:
+            self.wakeup.set()
+
+    def overlay(self, document_id, document: dict) -> dict:
+        for updates in (self.flushing.get(document_id), self.pending.get(document_id)):
+            if updates is not None:
+                document.update(updates)
+        return document
+
+    def _operation(self, document_id, updates: Optional[dict]):
+        if updates is None:
+            return DeleteOne({"_id": document_id})
+        return UpdateOne({"_id": document_id}, {"$set": updates}, upsert=self.upsert)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if len(self.pending) == 0:
+                return
+
+            self.flushing, self.pending = self.pending, {}
+            try:
+                await self.db._run(
+                    self.collection.bulk_write,
+                    [self._operation(document_id, updates) for document_id, updates in self.flushing.items()],
+                    ordered=False
+                )
+                self.n_flushed_documents += len(self.flushing)
+                self.n_flushes += 1
+                if self.upsert:
+                    for document_id, updates in self.flushing.items():
+                        if updates is None:
+                            self.written.discard(document_id)
+                        else:
+                            self.written.add(document_id)
+            except Exception:
+                # $set and deletes are idempotent, so the whole batch is retried on the next flush, newer values win
+                for document_id, updates in self.flushing.items():
+                    if document_id not in self.pending:
+                        self.pending[document_id] = updates
+                    elif updates is not None and self.pending[document_id] is not None:
+                        self.pending[document_id] = {**updates, **self.pending[document_id]}
+                raise
+            finally:
+                self.flushing = {}
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to flush the write-behind journal: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "updates": self.n_updates,
+            "flushed_documents": self.n_flushed_documents,
+            "flushes": self.n_flushes,
+        }
 
 
 class Database:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+        # connect on the first round trip instead of at import
+        self.client = pymongo.MongoClient(config.mongodb_uri, maxPoolSize=config.mongodb_max_workers, connect=False,
+                                          event_listeners=[_RoundTripListener()])
         self.db = self.client["chatgpt_telegram_bot"]
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
-
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        self.usage_collection = self.db["usage"]
+        self.response_cache_collection = self.db["response_cache"]
+        # dialogs nobody touched for archive_dialogs_after_days, compressed
+        self.dialog_archive_collection = self.db["dialog_archive"]
+        # checkpoints of answers being generated, left behind by a process that died mid-stream
+        self.generation_collection = self.db["generation"]
+
+        # pymongo is blocking, so every round trip runs on a bounded pool instead of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=config.mongodb_max_workers, thread_name_prefix="mongo")
+
+        # frequent user attribute updates like last_interaction are coalesced and written in batches
+        self.user_journal = None
+        if config.user_write_behind_interval > 0:
+            self.user_journal = WriteBehindJournal(
+                self,
+                self.user_collection,
+                flush_interval=config.user_write_behind_interval,
+                max_pending=config.user_write_behind_max_pending
+            )
+
+        # streamed answers are checkpointed in memory on every chunk and written every few seconds
+        self.generation_journal = None
+        if config.generation_checkpoint_interval > 0:
+            self.generation_journal = WriteBehindJournal(
+                self,
+                self.generation_collection,
+                flush_interval=config.generation_checkpoint_interval,
+                upsert=True
+            )
+
+        self.archive_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.user_journal is not None:
+            self.user_journal.start()
+        if self.generation_journal is not None:
+            self.generation_journal.start()
+        if config.archive_dialogs_after_days > 0:
+            self.archive_task = asyncio.create_task(self._archive_forever())
+
+    async def stop(self):
+        if self.archive_task is not None:
+            self.archive_task.cancel()
+            try:
+                await self.archive_task
+            except asyncio.CancelledError:
+                pass
+            self.archive_task = None
+        # one journal failing to flush doesn't keep the other one from flushing
+        for journal in (self.user_journal, self.generation_journal):
+            if journal is None:
+                continue
+            try:
+                await journal.stop()
+            except Exception as e:
+                logger.exception(f"Failed to flush the {journal.collection.name} journal: {str(e)}")
+
+    async def _run(self, func, *args, **kwargs):
+        start_time = time.perf_counter()
+        # like asyncio.to_thread, the call runs in a copy of the caller's context, so its logs carry the request id
+        context = contextvars.copy_context()
+        round_trip_seconds = []
+        context.run(_round_trip_seconds.set, round_trip_seconds)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                functools.partial(context.run, func, *args, **kwargs)
+            )
+        finally:
+            handler = metrics.current_handler.get()
+            metrics.mongo_call_seconds.labels(handler).observe(time.perf_counter() - start_time)
+            round_trip_histogram = metrics.mongo_round_trip_seconds.labels(handler)
+            for seconds in round_trip_seconds:
+                round_trip_histogram.observe(seconds)
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self._run(self.user_collection.count_documents, {"_id": user_id}) > 0:
             return True
         else:
             if raise_exception:
                 raise ValueError(f"User {user_id} does not exist")
             else:
                 return False
-        
-    def add_new_user(
+
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -33,8 +307,16 @@ class Database:
         first_name: str = "",
         last_name: str = "",
     ):
-        user_dict = {
-            "_id": user_id,
+        user_dict = {"_id": user_id, **self._new_user_dict(chat_id, username, first_name, last_name)}
+
+        if not await self.check_if_user_exists(user_id):
+            await self._run(self.user_collection.insert_one, user_dict)
+
+        # TODO: maybe start a new dialog here?
+
+    @staticmethod
+    def _new_user_dict(chat_id: int, username: str = "", first_name: str = "", last_name: str = ""):
+        return {
             "chat_id": chat_id,
 
             "username": username,
@@ -50,96 +332,565 @@ class Database:
             "n_used_tokens": 0
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
-            
-        # TODO: maybe start a new dialog here?
-
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
-
-        dialog_id = str(uuid.uuid4())
-        conversation_id = None
-        dialog_dict = {
-            "_id": dialog_id,
+    @staticmethod
+    def _new_dialog_dict(user_id: int, chat_mode: str):
+        return {
+            "_id": str(uuid.uuid4()),
             "user_id": user_id,
-            "conversation_id": conversation_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "conversation_id": None,
+            "upstream_session": None,
+            "chat_mode": chat_mode,
             "start_time": datetime.now(),
+            "updated_at": datetime.now(),
+            "n_messages": 0,
             "messages": []
         }
 
+    async def migrate(self):
+        await self._run(self._migrate)
+
+    def _migrate(self):
+        # dialogs written before append-only storage have no message counter
+        self.dialog_collection.update_many(
+            {"n_messages": {"$exists": False}},
+            [{"$set": {"n_messages": {"$size": "$messages"}}}]
+        )
+        # older dialogs don't track their last activity, their start is the best guess
+        self.dialog_collection.update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": "$start_time"}}]
+        )
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        for collection_name, keys, options in INDEXES:
+            collection = getattr(self, collection_name)
+            try:
+                index_name = collection.create_index(keys, **options)
+            except pymongo.errors.OperationFailure as e:
+                # e.g. an index with the same keys but different options, dropping it is left to the operator
+                logger.error(f"Failed to create index {keys} on {collection.name}: {e}")
+                continue
+
+            index_info = collection.index_information().get(index_name)
+            if index_info is None or [tuple(key) for key in index_info["key"]] != list(keys):
+                logger.error(f"Index {index_name} on {collection.name} doesn't match the index plan: {index_info}")
+
+    async def load_state(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ) -> "UserState":
+        """
+        Registers the user if needed and loads the user with their current dialog in a single executor hop
+        """
+        user_dict, dialog_dict = await self._run(
+            self._load_state, user_id, chat_id, username, first_name, last_name
+        )
+        if self.user_journal is not None:
+            self.user_journal.overlay(user_id, user_dict)
+
+        state = UserState(self, user_dict, dialog_dict)
+        if dialog_dict is None:
+            state.start_new_dialog()
+
+        return state
+
+    def _load_state(self, user_id: int, chat_id: int, username: str, first_name: str, last_name: str):
+        user_dict = self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": self._new_user_dict(chat_id, username, first_name, last_name)},
+            projection=USER_STATE_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        dialog_dict = None
+        if user_dict["current_dialog_id"] is not None:
+            dialog_filter = {"_id": user_dict["current_dialog_id"], "user_id": user_id}
+            dialog_dict = self.dialog_collection.find_one(dialog_filter, projection=DIALOG_STATE_PROJECTION)
+
+            # the user is back after a long break, so their dialog comes back from the archive
+            if dialog_dict is None and self._restore_dialog(dialog_filter):
+                dialog_dict = self.dialog_collection.find_one(dialog_filter, projection=DIALOG_STATE_PROJECTION)
+
+            # the migration may not have reached this dialog yet, and only the tail of its messages is loaded
+            if dialog_dict is not None and "n_messages" not in dialog_dict:
+                dialog_dict["n_messages"] = self._count_dialog_messages(dialog_filter)
+
+        return user_dict, dialog_dict
+
+    def _count_dialog_messages(self, dialog_filter: dict) -> int:
+        # conditional, so a counter set in the meantime (and incremented since) isn't overwritten
+        self.dialog_collection.update_one(
+            {**dialog_filter, "n_messages": {"$exists": False}},
+            [{"$set": {"n_messages": {"$size": "$messages"}}}]
+        )
+        dialog_dict = self.dialog_collection.find_one(dialog_filter, projection={"n_messages": 1})
+        return dialog_dict["n_messages"]
+
+    @staticmethod
+    def _compress_dialog(dialog_dict: dict) -> dict:
+        return {
+            "_id": dialog_dict["_id"],
+            "user_id": dialog_dict["user_id"],
+            "start_time": dialog_dict.get("start_time"),
+            "updated_at": dialog_dict.get("updated_at"),
+            "archived_at": datetime.now(),
+            "dialog": Binary(zlib.compress(bson.encode(dialog_dict))),
+        }
+
+    @staticmethod
+    def _decompress_dialog(archive_dict: dict) -> dict:
+        return bson.decode(zlib.decompress(archive_dict["dialog"]))
+
+    def _restore_dialog(self, dialog_filter: dict) -> bool:
+        archive_dict = self.dialog_archive_collection.find_one(dialog_filter)
+        if archive_dict is None:
+            return False
+
+        dialog_dict = self._decompress_dialog(archive_dict)
+        dialog_dict["updated_at"] = datetime.now()
+        self.dialog_collection.replace_one({"_id": dialog_dict["_id"]}, dialog_dict, upsert=True)
+        self.dialog_archive_collection.delete_one({"_id": dialog_dict["_id"]})
+        return True
+
+    def _archive_dialogs(self, inactive_since: datetime, batch_size: int) -> int:
+        """
+        Moves one batch of dialogs inactive since inactive_since into the archive, returns how many were moved
+        """
+        dialogs = list(
+            self.dialog_collection
+            .find({"updated_at": {"$lt": inactive_since}})
+            .sort("updated_at", pymongo.ASCENDING)
+            .limit(batch_size)
+        )
+        if len(dialogs) == 0:
+            return 0
+
+        # replace, so a copy left behind by an interrupted run doesn't fail the batch
+        self.dialog_archive_collection.bulk_write(
+            [ReplaceOne({"_id": dialog["_id"]}, self._compress_dialog(dialog), upsert=True) for dialog in dialogs],
+            ordered=False
+        )
+        # dialogs that became active in the meantime stay, their archived copy is overwritten next time
+        result = self.dialog_collection.delete_many({
+            "_id": {"$in": [dialog["_id"] for dialog in dialogs]},
+            "updated_at": {"$lt": inactive_since}
+        })
+        return result.deleted_count
+
+    async def archive_inactive_dialogs(self, inactive_days: float, batch_size: int = 100) -> int:
+        inactive_since = datetime.now() - timedelta(days=inactive_days)
+
+        n_archived = 0
+        while True:
+            n_batch_archived = await self._run(self._archive_dialogs, inactive_since, batch_size)
+            n_archived += n_batch_archived
+            if n_batch_archived < batch_size:
+                return n_archived
+
+            # leave the executor and Mongo to the handlers between batches
+            await asyncio.sleep(config.archive_batch_pause)
+
+    async def _archive_forever(self):
+        while True:
+            try:
+                n_archived = await self.archive_inactive_dialogs(
+                    config.archive_dialogs_after_days,
+                    batch_size=config.archive_batch_size
+                )
+                if n_archived > 0:
+                    logger.info(f"Archived {n_archived} inactive dialogs")
+            except Exception as e:
+                logger.exception(f"Failed to archive inactive dialogs: {str(e)}")
+
+            await asyncio.sleep(config.archive_interval)
+
+    def _defer_user_updates(self, user_id: int, user_updates: dict) -> dict:
+        """
+        Hands the user updates that can wait to the write-behind journal and returns the ones to write now
+        """
+        if self.user_journal is None:
+            return user_updates
+
+        deferred_updates = {key: value for key, value in user_updates.items()
+                            if key not in SYNCHRONOUS_USER_ATTRIBUTES}
+        if len(deferred_updates) > 0:
+            self.user_journal.set(user_id, deferred_updates)
+        return {key: value for key, value in user_updates.items() if key in SYNCHRONOUS_USER_ATTRIBUTES}
+
+    def _commit_state(self, state: "UserState", user_updates: dict):
+        if state.new_dialog is not None:
+            self.dialog_collection.insert_one(state.new_dialog)
+        else:
+            dialog_filter = {"_id": state.dialog_id, "user_id": state.user_id}
+            dialog_update = {}
+            if len(state.dialog_updates) > 0 or state.n_popped_messages > 0 or state.n_pushed_messages > 0:
+                dialog_update["$set"] = {**state.dialog_updates, "updated_at": datetime.now()}
+
+            # $pop and $push can't touch the same array in one update
+            for _ in range(state.n_popped_messages):
+                self.dialog_collection.update_one(
+                    dialog_filter,
+                    {**dialog_update, "$pop": {"messages": 1}, "$inc": {"n_messages": -1}}
+                )
+                dialog_update = {}
+
+            if state.n_pushed_messages > 0:
+                pushed_messages = state.dialog["messages"][-state.n_pushed_messages:]
+                dialog_update["$push"] = {"messages": {"$each": pushed_messages}}
+                dialog_update["$inc"] = {"n_messages": state.n_pushed_messages}
+
+            if len(dialog_update) > 0:
+                self.dialog_collection.update_one(dialog_filter, dialog_update)
+
+        if len(user_updates) > 0:
+            self.user_collection.update_one({"_id": state.user_id}, {"$set": user_updates})
+
+    async def start_new_dialog(self, user_id: int):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        dialog_dict = self._new_dialog_dict(user_id, await self.get_user_attribute(user_id, "current_chat_mode"))
+        dialog_id = dialog_dict["_id"]
+
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        await self._run(self.dialog_collection.insert_one, dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
+        await self._run(
+            self.user_collection.update_one,
             {"_id": user_id},
             {"$set": {"current_dialog_id": dialog_id}}
         )
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = await self._run(self.user_collection.find_one, {"_id": user_id})
+        if self.user_journal is not None:
+            self.user_journal.overlay(user_id, user_dict)
 
         if key not in user_dict:
             raise ValueError(f"User {user_id} does not have a value for {key}")
 
         return user_dict[key]
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_updates = self._defer_user_updates(user_id, {key: value})
+        if len(user_updates) > 0:
+            await self._run(self.user_collection.update_one, {"_id": user_id}, {"$set": user_updates})
 
-        if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
-        # self.check_if_user_exists()
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None, offset: Optional[int] = None,
+                                  limit: Optional[int] = None):
+        """
+        Returns the dialog messages, or a page of them when offset and/or limit are given.
+        A negative offset counts from the end, so offset=-n returns the last n messages
+        """
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        projection = None
+        if offset is not None and limit is not None:
+            projection = {"messages": {"$slice": [offset, limit]}}
+        elif offset is not None:
+            projection = {"messages": {"$slice": offset}}
+        elif limit is not None:
+            projection = {"messages": {"$slice": limit}}
+
+        dialog_dict = await self._run(
+            self.dialog_collection.find_one,
+            {"_id": dialog_id, "user_id": user_id},
+            projection=projection
+        )
         if dialog_dict is None:
             raise ValueError("Please start a new dialog")
 
         return dialog_dict["messages"]
 
-    def get_dialog_attribute(self, user_id: int, key: str, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def add_dialog_message(self, user_id: int, dialog_message: dict, conversation_id: str,
+                                 dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self._run(
+            self.dialog_collection.update_one,
+            {"_id": dialog_id, "user_id": user_id},
+            {
+                "$set": {"conversation_id": conversation_id, "updated_at": datetime.now()},
+                "$push": {"messages": dialog_message},
+                "$inc": {"n_messages": 1}
+            }
+        )
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None):
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self._run(
+            self.dialog_collection.update_one,
+            {"_id": dialog_id, "user_id": user_id, "n_messages": {"$gt": 0}},
+            {"$pop": {"messages": 1}, "$inc": {"n_messages": -1}}
+        )
+
+    async def get_dialog_attribute(self, user_id: int, key: str, dialog_id: Optional[str] = None):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        dialog_dict = await self._run(self.dialog_collection.find_one, {"_id": dialog_id, "user_id": user_id})
         if key not in dialog_dict:
             raise ValueError(f"User {user_id} does not have a value for {key} in dialog")
 
         return dialog_dict[key]
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, conversation_id: str,
-                            dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, conversation_id: str,
+                                  dialog_id: Optional[str] = None):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.dialog_collection.update_one(
+        await self._run(
+            self.dialog_collection.update_one,
             {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"conversation_id": conversation_id, "messages": dialog_messages}}
+            {"$set": {
+                "conversation_id": conversation_id,
+                "messages": dialog_messages,
+                "n_messages": len(dialog_messages),
+                "updated_at": datetime.now()
+            }}
         )
 
-    async def async_set_dialog_messages(self, user_id: int, dialog_messages: list, conversation_id: str,
-                                        dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
-
-        if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+    async def add_usage(self, user_increments: dict, dialog_increments: dict, chat_mode_increments: dict):
+        """
+        Applies the $inc counters and clears the ones written, so after a failure only the rest is left
+        """
+        await self._run(self._add_usage, user_increments, dialog_increments, chat_mode_increments)
+
+    def _add_usage(self, user_increments: dict, dialog_increments: dict, chat_mode_increments: dict):
+        for collection, increments, upsert in (
+            (self.user_collection, user_increments, False),
+            (self.dialog_collection, dialog_increments, False),
+            (self.usage_collection, chat_mode_increments, True),
+        ):
+            if len(increments) > 0:
+                keys = list(increments)
+                try:
+                    collection.bulk_write(
+                        [UpdateOne({"_id": key}, {"$inc": dict(increments[key])}, upsert=upsert) for key in keys],
+                        ordered=False
+                    )
+                except pymongo.errors.BulkWriteError as e:
+                    # unordered, so every update but the failed ones was applied, only those are retried
+                    failed_keys = {keys[error["index"]] for error in e.details.get("writeErrors", [])}
+                    for key in keys:
+                        if key not in failed_keys:
+                            del increments[key]
+                    raise
+                # written, so a retry of the failed rest doesn't count these twice
+                increments.clear()
+
+    async def get_usage(self, n_top_users: int = 10):
+        """
+        Returns the per chat mode counters and the users that used the most tokens
+        """
+        return await self._run(self._get_usage, n_top_users)
+
+    def _get_usage(self, n_top_users: int):
+        chat_mode_usage = list(self.usage_collection.find({}))
+        top_users = list(
+            self.user_collection
+            .find({}, projection={"username": 1, "n_used_tokens": 1})
+            .sort("n_used_tokens", pymongo.DESCENDING)
+            .limit(n_top_users)
+        )
+        return chat_mode_usage, top_users
+
+    async def get_dialog_summary(self, dialog_id: str) -> Optional[dict]:
+        """
+        Returns the summary, how many of the oldest messages it covers and the message count of the dialog
+        """
+        return await self._run(
+            self.dialog_collection.find_one,
+            {"_id": dialog_id},
+            projection={"user_id": 1, "summary": 1, "n_summarized_messages": 1, "n_messages": 1}
+        )
 
-        await asyncio.get_event_loop().run_in_executor(
-            None,
+    async def set_dialog_summary(self, dialog_id: str, summary: str, n_summarized_messages: int,
+                                 previous_n_summarized_messages: int) -> bool:
+        """
+        Stores the summary unless another one was stored since previous_n_summarized_messages was read
+        """
+        result = await self._run(
             self.dialog_collection.update_one,
-            {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"conversation_id": conversation_id, "messages": dialog_messages}}
+            {
+                "_id": dialog_id,
+                "n_summarized_messages": previous_n_summarized_messages or {"$in": [0, None]},
+                "n_messages": {"$gte": n_summarized_messages}
+            },
+            {"$set": {"summary": summary, "n_summarized_messages": n_summarized_messages}}
+        )
+        return result.modified_count > 0
+
+    def checkpoint_generation(self, generation_id: str, fields: dict):
+        """
+        Records the state of an answer being generated, written with the next journal flush
+        """
+        if self.generation_journal is not None:
+            self.generation_journal.set(generation_id, fields)
+
+    def finish_generation(self, generation_id: str):
+        if self.generation_journal is not None:
+            self.generation_journal.delete(generation_id)
+
+    async def get_interrupted_generations(self, started_before: datetime) -> list:
+        """
+        Checkpoints of generations that started before this process and never finished
+        """
+        return await self._run(
+            lambda: list(self.generation_collection.find({"started_at": {"$lt": started_before}}))
         )
+
+    async def delete_generation_checkpoint(self, generation_id: str):
+        await self._run(self.generation_collection.delete_one, {"_id": generation_id})
+
+    async def get_cached_response(self, key: str) -> Optional[str]:
+        cache_dict = await self._run(self.response_cache_collection.find_one, {"_id": key}, projection={"answer": 1})
+        if cache_dict is None:
+            return None
+
+        return cache_dict["answer"]
+
+    async def set_cached_response(self, key: str, answer: str):
+        await self._run(
+            self.response_cache_collection.update_one,
+            {"_id": key},
+            {"$set": {"answer": answer, "created_at": datetime.now()}},
+            upsert=True
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+class UserState:
+    """
+    Snapshot of a user and their current dialog taken once per update.
+    Handlers read and modify it in memory, then commit() writes every change back at once
+    """
+
+    def __init__(self, db: Database, user_dict: dict, dialog_dict: Optional[dict]):
+        self.db = db
+        self.user = user_dict
+        self.dialog = dialog_dict
+
+        self.user_updates = {}
+        self.dialog_updates = {}
+        # dialog created during this update, inserted as a whole on commit
+        self.new_dialog = None
+        # messages are stored append-only, so only the changes to the tail are written back
+        self.n_popped_messages = 0
+        self.n_pushed_messages = 0
+
+    @property
+    def user_id(self) -> int:
+        return self.user["_id"]
+
+    @property
+    def dialog_id(self) -> str:
+        return self.dialog["_id"]
+
+    def get_user_attribute(self, key: str):
+        if key not in self.user:
+            raise ValueError(f"User {self.user_id} does not have a value for {key}")
+
+        return self.user[key]
+
+    def set_user_attribute(self, key: str, value: Any):
+        self.user[key] = value
+        self.user_updates[key] = value
+
+    def get_dialog_attribute(self, key: str):
+        if key not in self.dialog:
+            raise ValueError(f"User {self.user_id} does not have a value for {key} in dialog")
+
+        return self.dialog[key]
+
+    def set_dialog_attribute(self, key: str, value: Any):
+        self.dialog[key] = value
+        if self.new_dialog is None:
+            self.dialog_updates[key] = value
+
+    def get_dialog_messages(self) -> list:
+        """
+        Returns the last messages of the dialog (up to dialog_messages_tail), use n_dialog_messages for the total
+        """
+        return self.dialog["messages"]
+
+    @property
+    def n_dialog_messages(self) -> int:
+        return self.dialog["n_messages"]
+
+    @property
+    def dialog_summary(self) -> Optional[str]:
+        return self.dialog.get("summary")
+
+    def get_recent_dialog_messages(self) -> list:
+        """
+        Returns the loaded messages that the dialog summary doesn't cover yet
+        """
+        n_summarized_messages = self.dialog.get("n_summarized_messages") or 0
+        first_loaded_message = self.dialog["n_messages"] - len(self.dialog["messages"])
+        return self.dialog["messages"][max(n_summarized_messages - first_loaded_message, 0):]
+
+    def add_dialog_message(self, dialog_message: dict, conversation_id: str):
+        self.set_dialog_attribute("conversation_id", conversation_id)
+        self.dialog["messages"].append(dialog_message)
+        self.dialog["n_messages"] += 1
+        self.n_pushed_messages += 1
+
+    def pop_dialog_message(self) -> dict:
+        if len(self.dialog["messages"]) == 0:
+            raise ValueError(f"User {self.user_id} has no messages to pop in dialog")
+
+        dialog_message = self.dialog["messages"].pop()
+        self.dialog["n_messages"] -= 1
+        if self.n_pushed_messages > 0:
+            self.n_pushed_messages -= 1
+        else:
+            self.n_popped_messages += 1
+
+        return dialog_message
+
+    def start_new_dialog(self) -> str:
+        self.dialog = self.db._new_dialog_dict(self.user_id, self.user["current_chat_mode"])
+        self.new_dialog = self.dialog
+        self.dialog_updates = {}
+        self.n_popped_messages = 0
+        self.n_pushed_messages = 0
+        self.set_user_attribute("current_dialog_id", self.dialog_id)
+
+        return self.dialog_id
+
+    async def commit(self):
+        user_updates = self.db._defer_user_updates(self.user_id, self.user_updates)
+        if (self.new_dialog is not None or len(self.dialog_updates) > 0 or len(user_updates) > 0
+                or self.n_popped_messages > 0 or self.n_pushed_messages > 0):
+            await self.db._run(self.db._commit_state, self, user_updates)
+
+        self.new_dialog = None
+        self.user_updates = {}
+        self.dialog_updates = {}
+        self.n_popped_messages = 0
+        self.n_pushed_messages = 0
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+from typing import Optional
+
+from httpx import HTTPError
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, NetworkError
+
+import log_pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class StreamedMessage:
+    def __init__(self, message: Message, parse_mode: str = None):
+        self.message = message
+        self.parse_mode = parse_mode
+        # edits run on the scheduler's tasks, they are logged under the request that streams the message
+        self.request_id = log_pipeline.request_id.get()
+        self.chat_id = message.chat_id
+        self.sent_text = message.text
+        self.pending_text = None
+        self.last_edit_time = 0.0
+        # the intermediate edit in flight, the final edit waits for it so older text can't land after the final one
+        self.edit_task: Optional[asyncio.Task] = None
+
+    @property
+    def editing(self) -> bool:
+        return self.edit_task is not None and not self.edit_task.done()
+
+    @property
+    def has_pending_text(self) -> bool:
+        return self.pending_text is not None and self.pending_text != self.sent_text
+
+
+class EditScheduler:
+    """
+    Owns every in-flight streamed answer and decides when each one is edited.
+    Pending text is coalesced per message, so only the latest text is ever sent. Edits are limited by a per-chat
+    interval and a global edits-per-second budget that is shared fairly between streams, and chats that got
+    RetryAfter are left alone until the deadline passes
+    """
+
+    def __init__(self, edits_per_second: float = 25, chat_edit_interval: float = 1.0, max_final_edit_attempts: int = 3):
+        self.edits_per_second = edits_per_second
+        self.chat_edit_interval = chat_edit_interval
+        self.max_final_edit_attempts = max_final_edit_attempts
+
+        self.streams = set()
+        self.chat_last_edit_time = {}
+        self.chat_blocked_until = {}
+
+        self.tokens = edits_per_second
+        self.tokens_updated_at = 0.0
+
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.n_edits = 0
+        self.n_retry_after = 0
+
+    def start(self):
+        self.tokens_updated_at = asyncio.get_running_loop().time()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def register(self, message: Message, parse_mode: str = None) -> StreamedMessage:
+        """
+        Starts streaming into message, intermediate edits are sent with parse_mode
+        """
+        stream = StreamedMessage(message, parse_mode)
+        # the message was just sent, which counts against the chat budget like an edit
+        stream.last_edit_time = asyncio.get_running_loop().time()
+        self.chat_last_edit_time[stream.chat_id] = stream.last_edit_time
+        self.streams.add(stream)
+        return stream
+
+    def update(self, stream: StreamedMessage, text: str):
+        stream.pending_text = text
+        self.wakeup.set()
+
+    def unregister(self, stream: StreamedMessage):
+        self.streams.discard(stream)
+        if not any(other.chat_id == stream.chat_id for other in self.streams):
+            self.chat_last_edit_time.pop(stream.chat_id, None)
+            if self.chat_blocked_until.get(stream.chat_id, 0.0) < asyncio.get_running_loop().time():
+                self.chat_blocked_until.pop(stream.chat_id, None)
+
+    async def finish(self, stream: StreamedMessage, text: str, **kwargs) -> Message:
+        """
+        Stops streaming the message and makes the final edit, waiting for the chat budget and
+        RetryAfter deadlines instead of dropping it
+        """
+        self.unregister(stream)
+        if stream.editing:
+            await asyncio.wait({stream.edit_task})
+        if text == stream.sent_text and kwargs.get("parse_mode") == stream.parse_mode:
+            # the last intermediate edit already shows the final text
+            return stream.message
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_final_edit_attempts):
+            ready_at = max(
+                stream.last_edit_time + self.chat_edit_interval,
+                self.chat_blocked_until.get(stream.chat_id, 0.0)
+            )
+            if ready_at > loop.time():
+                await asyncio.sleep(ready_at - loop.time())
+
+            try:
+                self.n_edits += 1
+                stream.last_edit_time = loop.time()
+                message = await stream.message.edit_text(text, **kwargs)
+                stream.sent_text = text
+                return message
+            except RetryAfter as e:
+                self.n_retry_after += 1
+                self.chat_blocked_until[stream.chat_id] = loop.time() + e.retry_after
+                if attempt == self.max_final_edit_attempts - 1:
+                    raise
+
+    def _stream_interval(self) -> float:
+        # with many concurrent streams each one gets a smaller share of the global budget
+        return max(self.chat_edit_interval, len(self.streams) / self.edits_per_second)
+
+    def _ready_at(self, stream: StreamedMessage, interval: float) -> float:
+        return max(
+            stream.last_edit_time + interval,
+            self.chat_last_edit_time.get(stream.chat_id, 0.0) + self.chat_edit_interval,
+            self.chat_blocked_until.get(stream.chat_id, 0.0)
+        )
+
+    def _refill_tokens(self, now: float):
+        self.tokens = min(
+            self.edits_per_second,
+            self.tokens + (now - self.tokens_updated_at) * self.edits_per_second
+        )
+        self.tokens_updated_at = now
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            self._refill_tokens(now)
+            interval = self._stream_interval()
+
+            pending_streams = [stream for stream in self.streams if stream.has_pending_text and not stream.editing]
+            ready_streams = sorted(
+                (stream for stream in pending_streams if self._ready_at(stream, interval) <= now),
+                key=lambda stream: stream.last_edit_time
+            )
+
+            edited_chats = set()
+            for stream in ready_streams:
+                if self.tokens < 1:
+                    break
+                if stream.chat_id in edited_chats:
+                    continue
+
+                self.tokens -= 1
+                edited_chats.add(stream.chat_id)
+                stream.last_edit_time = now
+                self.chat_last_edit_time[stream.chat_id] = now
+                stream.edit_task = loop.create_task(self._edit(stream, stream.pending_text))
+
+            # sleep until the next stream becomes ready, or until a new chunk arrives
+            waiting_streams = [stream for stream in pending_streams if not stream.editing]
+            timeout = None
+            if len(waiting_streams) > 0:
+                next_ready_at = min(self._ready_at(stream, interval) for stream in waiting_streams)
+                if self.tokens < 1:
+                    next_ready_at = max(next_ready_at, now + (1 - self.tokens) / self.edits_per_second)
+                timeout = max(next_ready_at - loop.time(), 0.01)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _edit(self, stream: StreamedMessage, text: str):
+        log_pipeline.request_id.set(stream.request_id)
+        try:
+            self.n_edits += 1
+            await stream.message.edit_text(text, parse_mode=stream.parse_mode)
+            stream.sent_text = text
+        except RetryAfter as e:
+            self.n_retry_after += 1
+            self.chat_blocked_until[stream.chat_id] = asyncio.get_running_loop().time() + e.retry_after
+            logger.warning("Telegram asked to retry edits in chat %s after %ss", stream.chat_id, e.retry_after)
+        except BadRequest:
+            # e.g. "message is not modified", retrying the same text would fail again
+            stream.sent_text = text
+        except (HTTPError, NetworkError):
+            pass
+        except Exception as e:
+            logger.exception("Error while editing the message: %s", e)
+        finally:
+            self.wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self.streams),
+            "edits": self.n_edits,
+            "retry_after": self.n_retry_after,
+        }
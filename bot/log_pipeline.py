@@ -0,0 +1,232 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# ties together everything logged while one update is handled: Telegram, upstream and database events
+request_id = contextvars.ContextVar("request_id", default="-")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+
+# share of INFO and DEBUG records kept by category, and the queue the listener thread reads, set by setup_logging
+_sample_rates = {}
+_queue = None
+
+
+def with_request_id(callback):
+    """
+    Runs an update handler with the update id as request id
+    """
+    @functools.wraps(callback)
+    async def callback_with_request_id(update, context):
+        token = request_id.set(str(getattr(update, "update_id", "-")))
+        try:
+            return await callback(update, context)
+        finally:
+            request_id.reset(token)
+
+    return callback_with_request_id
+
+
+def truncate(text: str, max_length: int) -> str:
+    if max_length <= 0 or len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}... ({len(text) - max_length} more characters)"
+
+
+def _sampled_out(category: str) -> bool:
+    sample_rate = _sample_rates.get(category, 1.0)
+    return sample_rate < 1.0 and random.random() >= sample_rate
+
+
+class CategoryLogger:
+    """
+    Logs the records of one category of a logger, e.g. full prompts, for close to nothing on the calling thread.
+    Sampling is decided before anything is built, and a record that is kept goes on the queue as its arguments,
+    the listener thread creates the LogRecord. Filters of the logger and its handlers don't see these records
+    """
+
+    def __init__(self, logger: logging.Logger, category: str):
+        self.logger = logger
+        self.category = category
+
+    def debug(self, msg: str, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg: str, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def log(self, level: int, msg: str, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and _sampled_out(self.category):
+            return
+        if _queue is None:
+            # no pipeline set up, the record takes the usual way
+            self.logger.log(level, msg, *args, extra={"category": self.category})
+            return
+        _queue.put((self.logger.name, level, msg, args, self.category, request_id.get(), time.time()))
+
+
+def _make_record(name: str, level: int, msg: str, args: tuple, category: str, record_request_id: str,
+                 created: float) -> logging.LogRecord:
+    return logging.makeLogRecord({
+        "name": name,
+        "levelno": level,
+        "levelname": logging.getLevelName(level),
+        "msg": msg,
+        "args": args,
+        "created": created,
+        "msecs": int((created - int(created)) * 1000),
+        "category": category,
+        "request_id": record_request_id,
+    })
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Stamps records with the request id and samples records below WARNING by category. The category is the
+    "category" extra of a record, or else the top level logger name, e.g. {"prompt": 0.1, "httpx": 0.01}
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            if _sampled_out(getattr(record, "category", None) or record.name.split(".", 1)[0]):
+                return False
+
+        record.request_id = request_id.get()
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Enqueues records as they are, so messages are formatted on the listener thread instead of the event loop
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # SimpleQueue.put is thread safe on its own, the handler lock would only be taken and released for nothing
+        if not self.filter(record):
+            return False
+        self.enqueue(record)
+        return True
+
+
+class _QueueListener(QueueListener):
+    """
+    Creates the records CategoryLogger enqueued as arguments, and can be stopped more than once,
+    by its owner and again at exit
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = False
+
+    def prepare(self, record):
+        if isinstance(record, tuple):
+            return _make_record(*record)
+        return record
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+
+
+class TruncatingFormatter(logging.Formatter):
+    """
+    Truncates long payloads such as prompts and answers before they are formatted into the message
+    """
+
+    def __init__(self, fmt: str = TEXT_FORMAT, max_payload_length: int = 1000):
+        super().__init__(fmt)
+        self.max_payload_length = max_payload_length
+
+    def _truncate_record(self, record: logging.LogRecord):
+        # with arguments the payloads are the arguments, cutting the format string could cut a placeholder
+        if isinstance(record.msg, str) and not record.args:
+            record.msg = truncate(record.msg, self.max_payload_length)
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                truncate(arg, self.max_payload_length) if isinstance(arg, str) else arg for arg in record.args
+            )
+
+    def format(self, record: logging.LogRecord) -> str:
+        self._truncate_record(record)
+        return super().format(record)
+
+
+class JsonFormatter(TruncatingFormatter):
+    """
+    One JSON object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        self._truncate_record(record)
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        category = getattr(record, "category", None)
+        if category is not None:
+            entry["category"] = category
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = "INFO", log_format: str = "text", sample_rates: dict = None,
+                  max_payload_length: int = 1000) -> QueueListener:
+    """
+    Routes every log record through a queue to a listener thread that formats and writes it,
+    the logging call itself only filters and enqueues
+    """
+    stream_handler = logging.StreamHandler()
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter(max_payload_length=max_payload_length))
+    else:
+        stream_handler.setFormatter(TruncatingFormatter(max_payload_length=max_payload_length))
+
+    # none of the formats show these, so records skip collecting them on the calling thread
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    # skips the stack walk of findCaller() for every record. The attribute is private, but it is the switch the
+    # "Optimization" section of the logging HOWTO documents, checked against the CPython 3.10 the image runs
+    logging._srcfile = None
+
+    global _queue
+
+    _sample_rates.clear()
+    _sample_rates.update(sample_rates or {})
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter())
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener = _QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    _queue = log_queue
+    # flushes what is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
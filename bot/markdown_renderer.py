@@ -0,0 +1,264 @@
+import html
+import re
+
+from utils import MESSAGE_PAGE_SIZE, find_page_end
+
+FENCE = "```"
+HEADING_RE = re.compile(r"^(\s*)#{1,6}\s+(.*)$")
+BULLET_RE = re.compile(r"^(\s*)[*\-+]\s+(.*)$")
+TAG_RE = re.compile(r"<[^>]*>")
+
+INLINE_TAGS = {"**": "b", "__": "b", "*": "i", "_": "i", "~~": "s"}
+
+
+def _escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def _has_visible_text(html_text: str) -> bool:
+    return len(TAG_RE.sub("", html_text).strip()) > 0
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def render_inline(line: str, complete: bool = True) -> str:
+    """
+    Renders bold, italic, strikethrough, inline code and links of a single line to Telegram HTML.
+    Markers without a partner are literal in a complete line and are closed at the end of an incomplete one,
+    so a line that is still being streamed already shows its formatting
+    """
+    out = []
+    # (marker, index in out of its opening tag)
+    stack = []
+    i = 0
+    n = len(line)
+    while i < n:
+        char = line[i]
+
+        if char == "`":
+            run_end = i
+            while run_end < n and line[run_end] == "`":
+                run_end += 1
+            marker = line[i:run_end]
+            code_end = line.find(marker, run_end)
+            if code_end != -1:
+                out.append(f"<code>{_escape(line[run_end:code_end])}</code>")
+                i = code_end + len(marker)
+            elif not complete:
+                out.append(f"<code>{_escape(line[run_end:])}</code>")
+                i = n
+            else:
+                out.append(marker)
+                i = run_end
+            continue
+
+        if char == "[":
+            text_end = line.find("](", i + 1)
+            url_end = line.find(")", text_end + 2) if text_end != -1 else -1
+            if url_end != -1:
+                url = line[text_end + 2:url_end].strip()
+                out.append(f'<a href="{html.escape(url)}">{_escape(line[i + 1:text_end])}</a>')
+                i = url_end + 1
+                continue
+
+        if char in "*_~":
+            marker = line[i:i + 2] if line[i:i + 2] in ("**", "__", "~~") else char
+            if marker in INLINE_TAGS:
+                before = line[i - 1] if i > 0 else " "
+                after = line[i + len(marker)] if i + len(marker) < n else " "
+                can_close = not before.isspace() and any(open_marker == marker for open_marker, _ in stack)
+                can_open = not after.isspace()
+                if char == "_":
+                    # snake_case identifiers are not emphasis
+                    can_close = can_close and not _is_word_char(after)
+                    can_open = can_open and not _is_word_char(before)
+
+                if can_close:
+                    # markers opened inside the closed span and never closed are literal
+                    while stack[-1][0] != marker:
+                        open_marker, index = stack.pop()
+                        out[index] = _escape(open_marker)
+                    _, index = stack.pop()
+                    if index == len(out) - 1:
+                        # an empty span, drop it instead of sending empty tags
+                        out.pop()
+                    else:
+                        out.append(f"</{INLINE_TAGS[marker]}>")
+                    i += len(marker)
+                    continue
+                if can_open:
+                    stack.append((marker, len(out)))
+                    out.append(f"<{INLINE_TAGS[marker]}>")
+                    i += len(marker)
+                    continue
+
+        out.append(_escape(char))
+        i += 1
+
+    while stack:
+        marker, index = stack.pop()
+        if complete:
+            out[index] = _escape(marker)
+        elif index == len(out) - 1:
+            out.pop()
+        else:
+            out.append(f"</{INLINE_TAGS[marker]}>")
+    return "".join(out)
+
+
+class MarkdownRenderer:
+    """
+    Renders the Markdown of ChatGPT answers to Telegram HTML while the answer is streamed.
+    Complete lines are rendered once and kept, only the line still being written is rendered again on every call,
+    so feeding a chunk costs time proportional to the chunk and its line, and every prefix renders to balanced HTML
+    """
+
+    def __init__(self, code_language: str = None):
+        # code_language is not None while inside a fenced code block, "" for a block without a language
+        self.code_language = code_language
+        self.parts = [self._open_code_block(code_language)] if code_language is not None else []
+        self.line = ""
+        self.has_committed_text = False
+
+    @staticmethod
+    def _open_code_block(language: str) -> str:
+        if language:
+            return f'<pre><code class="language-{html.escape(language)}">'
+        return "<pre>"
+
+    @staticmethod
+    def _close_code_block(language: str) -> str:
+        return "</code></pre>" if language else "</pre>"
+
+    def _render_line(self, line: str, complete: bool) -> tuple:
+        """
+        Returns the HTML of a line and the code block state after it
+        """
+        stripped_line = line.strip()
+        if self.code_language is not None:
+            if stripped_line.startswith(FENCE):
+                return self._close_code_block(self.code_language), None
+            return _escape(line), self.code_language
+
+        if stripped_line.startswith(FENCE):
+            language = stripped_line[len(FENCE):].strip().split(" ")[0]
+            return self._open_code_block(language), language
+
+        match = HEADING_RE.match(line)
+        if match is not None:
+            # the whole heading is bold already, Telegram rejects bold nested in bold
+            heading = render_inline(match.group(2).replace("**", "").replace("__", ""), complete)
+            return (f"{match.group(1)}<b>{heading}</b>" if heading else match.group(1)), None
+
+        match = BULLET_RE.match(line)
+        if match is not None:
+            return f"{match.group(1)}• {render_inline(match.group(2), complete)}", None
+
+        return render_inline(line, complete), None
+
+    def _close_body(self, body: str, code_language: str) -> str:
+        if code_language is None:
+            return body
+        if body.endswith(self._open_code_block(code_language)):
+            # an empty code block, Telegram rejects empty entities
+            return body[:-len(self._open_code_block(code_language))]
+        # no empty line at the end of the code block
+        return body.rstrip("\n") + self._close_code_block(code_language)
+
+    def _commit_line(self, line: str):
+        line_html, code_language = self._render_line(line, complete=True)
+        if self.code_language is not None and code_language is None:
+            # the fence closing the code block
+            self.parts.append(self._close_body(self.parts.pop(), self.code_language) + "\n")
+        elif self.code_language is None and code_language is not None:
+            # the fence opening a code block
+            self.parts.append(line_html)
+        else:
+            self.parts.append(line_html + "\n")
+        self.code_language = code_language
+
+        if not self.has_committed_text and _has_visible_text(line_html):
+            self.has_committed_text = True
+
+    def feed(self, text: str):
+        lines = (self.line + text).split("\n")
+        self.line = lines.pop()
+        for line in lines:
+            self._commit_line(line)
+
+    @property
+    def has_text(self) -> bool:
+        """
+        Whether the rendered message would show anything, Telegram rejects messages without visible text
+        """
+        return self.has_committed_text or _has_visible_text(self._render_line(self.line, complete=False)[0])
+
+    def render(self) -> str:
+        """
+        HTML of everything fed so far, with every open tag closed
+        """
+        body = "".join(self.parts)
+        line_html, code_language = self._render_line(self.line, complete=False)
+        if self.code_language is not None and code_language is None:
+            # the line closes the code block
+            return self._close_body(body, self.code_language).strip()
+        if self.code_language is None and code_language is not None:
+            # the line opens a code block that has no content yet
+            return body.strip()
+        return self._close_body(body + line_html, code_language).strip()
+
+    def finish(self) -> str:
+        """
+        Renders the last line as complete, e.g. once the answer or its page is done
+        """
+        if len(self.line) > 0:
+            self._commit_line(self.line)
+            self.line = ""
+        return self._close_body("".join(self.parts), self.code_language).strip()
+
+    def continuation(self) -> "MarkdownRenderer":
+        """
+        Renderer for the next page of the answer, a code block left open on this page continues on the next one
+        """
+        return MarkdownRenderer(self.code_language)
+
+
+class MarkdownPager:
+    """
+    Splits a streamed answer into Telegram pages and renders them. Only the last page, starting at page_start,
+    still grows, the pages before it are sealed as soon as the answer has grown past them
+    """
+
+    def __init__(self, page_size: int = MESSAGE_PAGE_SIZE):
+        self.page_size = page_size
+        self.page_start = 0
+        self.renderer = MarkdownRenderer()
+        # the code block state the last page began with and how far into the answer its renderer has seen
+        self.page_code_language = None
+        self.rendered_end = 0
+
+    def feed(self, text: str) -> list:
+        """
+        Takes the whole answer so far and returns the pages it seals as (html, plain text, has text) tuples
+        """
+        sealed_pages = []
+        page_end = self.page_start + find_page_end(text[self.page_start:], self.page_size)
+        while page_end < len(text):
+            if page_end < self.rendered_end:
+                # the break falls inside text the renderer has already seen, the page is rendered again from its start
+                self.renderer = MarkdownRenderer(self.page_code_language)
+                self.rendered_end = self.page_start
+            self.renderer.feed(text[self.rendered_end:page_end])
+            page_html = self.renderer.finish()
+            sealed_pages.append((page_html, text[self.page_start:page_end].strip(), self.renderer.has_text))
+
+            self.renderer = self.renderer.continuation()
+            self.page_code_language = self.renderer.code_language
+            self.page_start = self.rendered_end = page_end
+            page_end = self.page_start + find_page_end(text[self.page_start:], self.page_size)
+
+        self.renderer.feed(text[self.rendered_end:])
+        self.rendered_end = len(text)
+        return sealed_pages
@@ -0,0 +1,302 @@
+import contextvars
+import functools
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# every update handler runs in its own context, so Mongo calls can be attributed to it
+current_handler = contextvars.ContextVar("current_handler", default="background")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Value:
+    """
+    A single labelled counter or gauge value. All updates happen on the event loop, so plain attribute
+    updates are enough and no locks are taken
+    """
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Reads the value from function at scrape time, for numbers other components already keep
+        """
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label strings are rendered once per child, never on the hot path
+        self.children = {}
+        self.children_labels = {}
+
+        (registry if registry is not None else default_registry).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+
+            child = self._new_child()
+            self.children[values] = child
+            self.children_labels[values] = ",".join(
+                f'{name}="{_escape_label_value(value)}"' for name, value in zip(self.labelnames, values)
+            )
+        return child
+
+    def _samples(self, values: tuple, child) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self.children.items()):
+            for suffix, labels, value in self._samples(values, child):
+                labels = ",".join(filter(None, (self.children_labels[values], labels)))
+                labels = f"{{{labels}}}" if labels else ""
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self, values: tuple, child: _Value) -> list:
+        return [("_total", "", child.get())]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+    def _samples(self, values: tuple, child: _Value) -> list:
+        return [("", "", child.get())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self, values: tuple, child: _HistogramValue) -> list:
+        samples = []
+        cumulative_count = 0
+        for bucket, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative_count += count
+            samples.append(("_bucket", f'le="{_format_value(bucket)}"', cumulative_count))
+        samples.append(("_sum", "", child.sum))
+        samples.append(("_count", "", cumulative_count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+default_registry = Registry()
+
+
+def instrument_handler(callback, name: str = None):
+    """
+    Times an update handler and attributes the Mongo calls made while it runs to it
+    """
+    name = name or callback.__name__
+    handler_seconds = update_handler_seconds.labels(name)
+
+    @functools.wraps(callback)
+    async def instrumented_callback(update, context):
+        token = current_handler.set(name)
+        start_time = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start_time)
+            current_handler.reset(token)
+
+    return instrumented_callback
+
+
+class MetricsServer:
+    """
+    Serves the registry in the Prometheus text format on a local HTTP endpoint
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9090, registry: Registry = None):
+        self.host = host
+        self.port = port
+        self.registry = registry if registry is not None else default_registry
+        self.runner: Optional[web.AppRunner] = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format-Version": "0.0.4"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# update handlers
+update_handler_seconds = Histogram(
+    "chatgpt_bot_update_handler_seconds", "Time spent handling an update, including waiting for the chat",
+    ("handler",)
+)
+
+# generations
+generation_first_chunk_seconds = Histogram(
+    "chatgpt_bot_generation_first_chunk_seconds", "Time from asking the backend to its first chunk", ("chat_mode",)
+)
+generation_seconds = Histogram(
+    "chatgpt_bot_generation_seconds", "Time from asking the backend to the complete answer", ("chat_mode",)
+)
+generation_errors = Counter(
+    "chatgpt_bot_generation_errors", "Generations that failed", ("chat_mode",)
+)
+generations_stopped = Counter(
+    "chatgpt_bot_generations_stopped", "Generations stopped by /stop or a newer message", ("chat_mode",)
+)
+dialog_summaries = Counter(
+    "chatgpt_bot_dialog_summaries", "Rolling dialog summaries stored", ("chat_mode",)
+)
+response_cache_hits = Counter(
+    "chatgpt_bot_response_cache_hits", "Answers served from the response cache", ("chat_mode",)
+)
+response_cache_misses = Counter(
+    "chatgpt_bot_response_cache_misses", "Cacheable prompts that had to be generated", ("chat_mode",)
+)
+
+# Telegram
+telegram_edits = Counter(
+    "chatgpt_bot_telegram_edits", "Edits of streamed messages sent to Telegram"
+)
+telegram_retry_after = Counter(
+    "chatgpt_bot_telegram_retry_after", "Edits Telegram rejected with RetryAfter"
+)
+telegram_streams = Gauge(
+    "chatgpt_bot_telegram_streams", "Messages currently being streamed"
+)
+
+# MongoDB
+# one sample per command sent to the server, a bulk_write or a find and its getMores are several round trips
+mongo_round_trip_seconds = Histogram(
+    "chatgpt_bot_mongo_round_trip_seconds", "Latency of MongoDB round trips by the update handler that made them",
+    ("handler",)
+)
+# one sample per call on the Mongo executor, a call makes one or more round trips
+mongo_call_seconds = Histogram(
+    "chatgpt_bot_mongo_call_seconds", "Latency of MongoDB executor calls by the update handler that made them",
+    ("handler",)
+)
+mongo_write_behind_pending = Gauge(
+    "chatgpt_bot_mongo_write_behind_pending", "Users with attribute updates waiting in the write-behind journal"
+)
+
+# queues
+generations_inflight = Gauge(
+    "chatgpt_bot_generations_inflight", "Generations currently running"
+)
+generations_queued = Gauge(
+    "chatgpt_bot_generations_queued", "Generations waiting for admission"
+)
+worker_pool_queued = Gauge(
+    "chatgpt_bot_worker_pool_queued", "Blocking calls waiting for a worker thread", ("pool",)
+)
+worker_pool_running = Gauge(
+    "chatgpt_bot_worker_pool_running", "Blocking calls running on a worker thread", ("pool",)
+)
+upstream_session_inflight = Gauge(
+    "chatgpt_bot_upstream_session_inflight", "Requests in flight per upstream ChatGPT session", ("session",)
+)
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Exact-match cache of answers for chat modes that don't depend on dialog history.
+    Answers are keyed by a hash of the normalized final prompt and kept in an in-process LRU, optionally backed
+    by a Mongo collection shared between bot processes whose documents expire through a TTL index.
+    The shared tier is best effort, its failures are logged and count as misses and skipped writes
+    """
+
+    def __init__(self, chat_modes: list, max_size: int = 1000, ttl: float = 86400, db=None):
+        self.chat_modes = set(chat_modes)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db = db
+
+        self.entries = OrderedDict()
+
+        self.n_hits = 0
+        self.n_shared_hits = 0
+        self.n_misses = 0
+
+    def is_enabled(self, chat_mode: str) -> bool:
+        return chat_mode in self.chat_modes
+
+    @staticmethod
+    def make_key(backend_name: str, chat_mode: str, prompt: str) -> str:
+        normalized_prompt = re.sub(r"\s+", " ", prompt).strip()
+        return hashlib.sha256(f"{backend_name}\0{chat_mode}\0{normalized_prompt}".encode()).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        answer, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return answer
+
+    def _set_local(self, key: str, answer: str):
+        self.entries[key] = (answer, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        answer = self._get_local(key)
+        if answer is not None:
+            self.n_hits += 1
+            return answer
+
+        if self.db is not None:
+            try:
+                answer = await self.db.get_cached_response(key)
+            except Exception as e:
+                logger.warning(f"Failed to read the shared response cache: {str(e)}")
+            if answer is not None:
+                self.n_hits += 1
+                self.n_shared_hits += 1
+                self._set_local(key, answer)
+                return answer
+
+        self.n_misses += 1
+        return None
+
+    async def set(self, key: str, answer: str):
+        self._set_local(key, answer)
+        if self.db is not None:
+            try:
+                await self.db.set_cached_response(key, answer)
+            except Exception as e:
+                logger.warning(f"Failed to write the shared response cache: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "hits": self.n_hits,
+            "shared_hits": self.n_shared_hits,
+            "misses": self.n_misses,
+        }
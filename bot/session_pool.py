@@ -0,0 +1,186 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses and revChatGPT error types that are about the account rather than the request
+AUTH_ERROR_STATUS_CODES = {401, 403}
+AUTH_ERROR_TYPES = {"EXPIRED_ACCESS_TOKEN_ERROR", "INVALID_ACCESS_TOKEN_ERROR", "AUTHENTICATION_ERROR"}
+SESSION_ERROR_STATUS_CODES = AUTH_ERROR_STATUS_CODES | {429}
+SESSION_ERROR_TYPES = AUTH_ERROR_TYPES | {"RATE_LIMIT_ERROR"}
+
+
+def _error_code(error: Exception):
+    return getattr(error, "code", None) or getattr(error, "status_code", None)
+
+
+def is_auth_error(error: Exception) -> bool:
+    """
+    Whether the upstream rejected the account's credentials, e.g. its login failed or its token was revoked
+    """
+    code = _error_code(error)
+    if code in AUTH_ERROR_STATUS_CODES or getattr(code, "name", None) in AUTH_ERROR_TYPES:
+        return True
+    return type(error).__name__ == "AuthenticationError"
+
+
+def is_session_error(error: Exception) -> bool:
+    """
+    Whether the upstream rejected the account itself, e.g. its login failed, its token expired or it is rate limited
+    """
+    code = _error_code(error)
+    if code in SESSION_ERROR_STATUS_CODES or getattr(code, "name", None) in SESSION_ERROR_TYPES:
+        return True
+    return is_auth_error(error)
+
+
+class UpstreamSession:
+    def __init__(self, name: str, create_bot, max_concurrency: int = 1, drop_credentials=None):
+        """
+        create_bot is a blocking callable that logs in and returns the client, it runs on first use.
+        drop_credentials forgets the credentials the upstream rejected, so the next create_bot logs in again
+        """
+        self.name = name
+        self.create_bot = create_bot
+        self.drop_credentials = drop_credentials
+        self.bot = None
+        self.bot_lock = asyncio.Lock()
+        self.max_concurrency = max_concurrency
+
+        self.n_inflight = 0
+        self.n_served = 0
+        # failures since the last success, and cooldowns since then, each one twice as long as the one before
+        self.n_errors = 0
+        self.n_cooldowns = 0
+        self.disabled_until = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return time.monotonic() >= self.disabled_until
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.n_inflight < self.max_concurrency
+
+    async def get_bot(self):
+        if self.bot is None:
+            async with self.bot_lock:
+                if self.bot is None:
+                    self.bot = await asyncio.to_thread(self.create_bot)
+        return self.bot
+
+    def reset_bot(self):
+        """
+        Drops the client and its credentials, requests in flight keep the old client
+        """
+        if self.drop_credentials is not None:
+            self.drop_credentials()
+        self.bot = None
+
+
+class SessionPool:
+    """
+    Schedules requests over several upstream ChatGPT sessions.
+    A conversation sticks to the session it was started on (its name is stored next to conversation_id),
+    new conversations go to the least loaded session. A session the upstream rejects, or one that fails
+    max_errors times in a row, is taken out of rotation for a while, unless it is the last one in rotation.
+    A session whose credentials are rejected logs in again on its next request
+    """
+
+    def __init__(self, sessions: list, cooldown: float = 60, max_errors: int = 3, max_cooldown: float = None):
+        if len(sessions) == 0:
+            raise ValueError("Session pool needs at least one upstream session")
+
+        self.sessions = sessions
+        self.sessions_by_name = {session.name: session for session in sessions}
+        self.cooldown = cooldown
+        self.max_errors = max_errors
+        self.max_cooldown = max_cooldown if max_cooldown is not None else cooldown * 16
+        self.condition = asyncio.Condition()
+
+    def _pick(self, preferred: str = None):
+        enabled_sessions = [session for session in self.sessions if session.enabled]
+        if len(enabled_sessions) == 0:
+            raise RuntimeError("All ChatGPT sessions are temporarily unavailable, please try again later")
+
+        sticky_session = self.sessions_by_name.get(preferred)
+        if sticky_session is not None and sticky_session.enabled:
+            return sticky_session if sticky_session.has_capacity else None
+
+        free_sessions = [session for session in enabled_sessions if session.has_capacity]
+        if len(free_sessions) == 0:
+            return None
+
+        return min(free_sessions, key=lambda session: (session.n_inflight, session.n_served))
+
+    async def acquire(self, preferred: str = None) -> UpstreamSession:
+        async with self.condition:
+            while True:
+                session = self._pick(preferred)
+                if session is not None:
+                    session.n_inflight += 1
+                    return session
+
+                await self.condition.wait()
+
+    async def release(self, session: UpstreamSession):
+        async with self.condition:
+            session.n_inflight -= 1
+            session.n_served += 1
+            self.condition.notify_all()
+
+    def report_error(self, session: UpstreamSession, error: Exception):
+        session.n_errors += 1
+        if is_auth_error(error):
+            # a revoked token still looks valid by its expiry, the next request logs in again instead of reusing it
+            logger.warning(f"ChatGPT session {session.name} was rejected, logging in again on its next request")
+            session.reset_bot()
+
+        if not is_session_error(error) and session.n_errors < self.max_errors:
+            # a bad answer or a timeout says little about the account
+            logger.warning(f"ChatGPT session {session.name} failed ({session.n_errors} in a row): {str(error)}")
+            return
+
+        if not any(other_session.enabled for other_session in self.sessions if other_session is not session):
+            logger.warning(f"ChatGPT session {session.name} failed but is the last one in rotation: {str(error)}")
+            return
+
+        cooldown = min(self.cooldown * 2 ** session.n_cooldowns, self.max_cooldown)
+        session.n_cooldowns += 1
+        session.disabled_until = time.monotonic() + cooldown
+        logger.warning(f"ChatGPT session {session.name} is out of rotation for {cooldown}s: {str(error)}")
+
+    def report_success(self, session: UpstreamSession):
+        session.n_errors = 0
+        session.n_cooldowns = 0
+
+    @contextlib.asynccontextmanager
+    async def session(self, preferred: str = None):
+        session = await self.acquire(preferred)
+        try:
+            yield session
+        except TelegramError:
+            # Telegram failures say nothing about the upstream session
+            raise
+        except Exception as e:
+            self.report_error(session, e)
+            raise
+        else:
+            self.report_success(session)
+        finally:
+            await self.release(session)
+
+    def stats(self) -> list:
+        return [
+            {
+                "name": session.name,
+                "inflight": session.n_inflight,
+                "served": session.n_served,
+                "enabled": session.enabled,
+            }
+            for session in self.sessions
+        ]
@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+from typing import Callable, Optional
+
+import httpx
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# update fields that carry the chat, in the order they are looked up
+CHAT_UPDATE_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member",
+    "chat_join_request",
+)
+USER_UPDATE_FIELDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer")
+
+
+def extract_chat_id(update: dict) -> int:
+    """
+    Chat an update belongs to, read from the raw JSON so the dispatcher never parses updates into objects
+    """
+    for field in CHAT_UPDATE_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+
+    callback_query = update.get("callback_query")
+    if callback_query is not None:
+        if "message" in callback_query:
+            return callback_query["message"]["chat"]["id"]
+        return callback_query["from"]["id"]
+
+    for field in USER_UPDATE_FIELDS:
+        if field in update:
+            return update[field].get("from", update[field].get("user", {})).get("id", 0)
+
+    return 0
+
+
+class HashRing:
+    """
+    Consistent hash ring of shards, each shard owns n_replicas points so chats spread evenly
+    and changing the number of shards only moves the chats of the added or removed shard
+    """
+
+    def __init__(self, n_shards: int, n_replicas: int = 64):
+        self.points = sorted(
+            (self._hash(f"{shard}:{replica}"), shard)
+            for shard in range(n_shards)
+            for replica in range(n_replicas)
+        )
+        self.point_hashes = [point_hash for point_hash, _ in self.points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def get_shard(self, chat_id: int) -> int:
+        index = bisect.bisect(self.point_hashes, self._hash(str(chat_id))) % len(self.points)
+        return self.points[index][1]
+
+
+class ShardDispatcher:
+    """
+    Receives updates by long polling or webhook and forwards the raw JSON to worker processes,
+    every chat always goes to the same worker, so per-chat ordering holds across the deployment.
+    Workers run worker_target(shard_index, update_queue) and are restarted if they die
+    """
+
+    def __init__(self, worker_target: Callable, n_workers: int, telegram_token: str,
+                 telegram_api_base_url: str = "", restart_interval: float = 1.0):
+        self.worker_target = worker_target
+        self.n_workers = n_workers
+        self.telegram_token = telegram_token
+        self.telegram_api_base_url = telegram_api_base_url or "https://api.telegram.org/bot"
+        self.restart_interval = restart_interval
+
+        # spawned workers start from a clean interpreter instead of a copy of the dispatcher's threads
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.ring = HashRing(n_workers)
+        self.update_queues = [self.mp_context.Queue() for _ in range(n_workers)]
+        self.workers: list = [None] * n_workers
+        self.stopping: Optional[asyncio.Event] = None
+        # getUpdates offset after the last update handed to a shard, Telegram drops what is before it once confirmed
+        self.offset: Optional[int] = None
+
+        self.n_dispatched = [0] * n_workers
+
+    def _start_worker(self, shard_index: int):
+        worker = self.mp_context.Process(
+            target=self.worker_target,
+            args=(shard_index, self.update_queues[shard_index]),
+            name=f"shard-{shard_index}",
+            daemon=False
+        )
+        worker.start()
+        self.workers[shard_index] = worker
+        logger.info(f"Started shard worker {shard_index} (pid {worker.pid})")
+
+    def dispatch(self, update: dict):
+        shard_index = self.ring.get_shard(extract_chat_id(update))
+        self.update_queues[shard_index].put(update)
+        self.n_dispatched[shard_index] += 1
+
+    async def _supervise(self):
+        while not self.stopping.is_set():
+            for shard_index, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    logger.error(f"Shard worker {shard_index} exited with code {worker.exitcode}, restarting it")
+                    self._start_worker(shard_index)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.restart_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _call(self, client: httpx.AsyncClient, method: str, **params) -> dict:
+        response = await client.post(f"{self.telegram_api_base_url}{self.telegram_token}/{method}", json=params)
+        return response.json()
+
+    async def _poll(self):
+        async with httpx.AsyncClient(timeout=httpx.Timeout(40, connect=10)) as client:
+            await self._call(client, "deleteWebhook")
+            while not self.stopping.is_set():
+                try:
+                    result = await self._call(client, "getUpdates", offset=self.offset, timeout=30)
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+
+                if not result.get("ok"):
+                    retry_after = result.get("parameters", {}).get("retry_after", 1)
+                    logger.warning(f"getUpdates failed: {result.get('description')}")
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                for update in result["result"]:
+                    self.offset = update["update_id"] + 1
+                    self.dispatch(update)
+
+    async def _confirm_offset(self):
+        """
+        Confirms the updates handed to the shards, otherwise Telegram delivers the last batch again after a restart
+        """
+        if self.offset is None:
+            return
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                result = await self._call(client, "getUpdates", offset=self.offset, timeout=0, limit=1)
+            if not result.get("ok"):
+                logger.warning(f"Failed to confirm the last updates: {result.get('description')}")
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Failed to confirm the last updates: {e}")
+
+    async def _serve_webhook(self, listen: str, port: int, url_path: str, webhook_url: str, secret_token: str,
+                             max_connections: int):
+        async def handle_update(request: web.Request) -> web.Response:
+            if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                return web.Response(status=403)
+            self.dispatch(await request.json())
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(f"/{url_path.strip('/')}", handle_update)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+
+        async with httpx.AsyncClient(timeout=30) as client:
+            params = {"url": webhook_url, "max_connections": max_connections}
+            if secret_token:
+                params["secret_token"] = secret_token
+            result = await self._call(client, "setWebhook", **params)
+            if not result.get("ok"):
+                raise RuntimeError(f"setWebhook failed: {result.get('description')}")
+
+        try:
+            await self.stopping.wait()
+        finally:
+            await runner.cleanup()
+
+    async def _run(self, webhook: Optional[dict]):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, self.stopping.set)
+
+        for shard_index in range(self.n_workers):
+            self._start_worker(shard_index)
+
+        supervisor = asyncio.create_task(self._supervise())
+        receiver = asyncio.create_task(self._serve_webhook(**webhook) if webhook is not None else self._poll())
+        await self.stopping.wait()
+
+        # stop receiving, then let every worker drain its queue and shut down cleanly
+        for task in (receiver, supervisor):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        for update_queue in self.update_queues:
+            update_queue.put(None)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.join)
+        if webhook is None:
+            # like python-telegram-bot's Updater, once the shards have handled everything they were given
+            await self._confirm_offset()
+        logger.info(f"Dispatched updates per shard: {self.n_dispatched}")
+
+    def run(self, webhook: dict = None):
+        """
+        Blocks until SIGINT or SIGTERM. webhook holds the _serve_webhook arguments, long polling is used without it
+        """
+        asyncio.run(self._run(webhook))
+
+
+async def forward_updates(update_queue, application, poll_interval: float = 1.0):
+    """
+    Worker side: feeds updates from the dispatcher into the application until the dispatcher sends None
+    or goes away without saying so
+    """
+    from telegram import Update
+
+    loop = asyncio.get_running_loop()
+    dispatcher = multiprocessing.parent_process()
+    while True:
+        try:
+            update_dict = await loop.run_in_executor(None, update_queue.get, True, poll_interval)
+        except queue.Empty:
+            if dispatcher is not None and not dispatcher.is_alive():
+                logger.error("Dispatcher exited, stopping the shard")
+                return
+            continue
+
+        if update_dict is None:
+            return
+        await application.update_queue.put(Update.de_json(update_dict, application.bot))
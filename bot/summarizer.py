@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import logging
+from typing import Callable, Optional
+
+import log_pipeline
+import metrics
+from backends import Backend, Conversation
+from chatgpt import ChatGPT
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Summarize the conversation between User and ChatGPT below, so that ChatGPT can continue it \
+from the summary alone. Keep facts, names, numbers, code identifiers, decisions and open questions, drop small talk. \
+Write at most {max_words} words and reply with the summary only.
+
+{previous_summary}Conversation:
+{conversation}"""
+
+
+class DialogSummarizer:
+    """
+    Compacts long dialogs in the background. Once more than summarize_after messages of a dialog aren't covered by
+    its summary, all but the keep_recent newest of them are folded into a rolling summary stored on the dialog.
+    Summaries are generated one at a time and only while the admission controller has idle slots,
+    so users never wait behind them
+    """
+
+    def __init__(self, db, admission, get_backend: Callable[[str], Backend], summarize_after: int = 16,
+                 keep_recent: int = 6, max_words: int = 200, idle_poll_interval: float = 1.0, timeout: float = 120):
+        self.db = db
+        self.admission = admission
+        self.get_backend = get_backend
+        self.summarize_after = summarize_after
+        self.keep_recent = keep_recent
+        self.max_words = max_words
+        self.idle_poll_interval = idle_poll_interval
+        self.timeout = timeout
+
+        self.queue = asyncio.Queue()
+        self.scheduled_dialogs = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._summarize_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def maybe_schedule(self, user_id: int, dialog: dict, chat_mode: str, stateful_backend: bool) -> bool:
+        """
+        Queues the dialog for summarization if it is long enough and its prompts carry the history
+        """
+        if not ChatGPT.uses_dialog_history(chat_mode, stateful_backend):
+            return False
+
+        n_unsummarized_messages = dialog["n_messages"] - (dialog.get("n_summarized_messages") or 0)
+        if n_unsummarized_messages <= self.summarize_after or dialog["_id"] in self.scheduled_dialogs:
+            return False
+
+        self.scheduled_dialogs.add(dialog["_id"])
+        self.queue.put_nowait((user_id, dialog["_id"], chat_mode, log_pipeline.request_id.get()))
+        return True
+
+    async def _summarize_forever(self):
+        while True:
+            user_id, dialog_id, chat_mode, request_id = await self.queue.get()
+            # logged under the request whose answer made the dialog long enough
+            log_pipeline.request_id.set(request_id)
+            try:
+                while not self.admission.try_acquire_idle_slot():
+                    await asyncio.sleep(self.idle_poll_interval)
+
+                try:
+                    await self._summarize(user_id, dialog_id, chat_mode)
+                finally:
+                    self.admission.release_idle_slot()
+            except Exception as e:
+                logger.exception(f"Failed to summarize dialog {dialog_id}: {str(e)}")
+            finally:
+                self.scheduled_dialogs.discard(dialog_id)
+
+    async def _summarize(self, user_id: int, dialog_id: str, chat_mode: str):
+        dialog_dict = await self.db.get_dialog_summary(dialog_id)
+        if dialog_dict is None:
+            return
+
+        n_summarized_messages = dialog_dict.get("n_summarized_messages") or 0
+        n_new_summarized_messages = dialog_dict["n_messages"] - self.keep_recent - n_summarized_messages
+        if n_new_summarized_messages <= 0:
+            return
+
+        dialog_messages = await self.db.get_dialog_messages(
+            user_id, dialog_id=dialog_id, offset=n_summarized_messages, limit=n_new_summarized_messages
+        )
+        previous_summary = dialog_dict.get("summary")
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.max_words,
+            previous_summary=f"Summary of the conversation before:\n{previous_summary}\n\n" if previous_summary else "",
+            conversation="".join(
+                ChatGPT._format_dialog_message(dialog_message["user"], dialog_message["bot"])
+                for dialog_message in dialog_messages
+            )
+        )
+
+        # a fresh conversation, the dialog's own upstream conversation must not see the summary request
+        summary = ""
+        async with contextlib.aclosing(
+            self.get_backend(chat_mode).ask(prompt, Conversation(), timeout=self.timeout)
+        ) as chunks:
+            async for summary in chunks:
+                pass
+
+        summary = summary.strip()
+        if len(summary) == 0:
+            raise ValueError("empty summary")
+
+        n_summarized_messages += len(dialog_messages)
+        if await self.db.set_dialog_summary(dialog_id, summary, n_summarized_messages,
+                                            dialog_dict.get("n_summarized_messages")):
+            metrics.dialog_summaries.labels(chat_mode).inc()
+            logger.info(f"Summarized {len(dialog_messages)} messages of dialog {dialog_id}")
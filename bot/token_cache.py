@@ -0,0 +1,84 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    Upstream access tokens persisted in a JSON file, so a restart reuses them instead of logging in again
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.tokens = self._read()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable token cache {self.path}: {e}")
+            return {}
+
+    def _write(self):
+        # write to a temporary file first so a crash never leaves a truncated cache behind
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.tokens, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def expires_at(token: str) -> Optional[float]:
+        """
+        Expiry of a JWT access token as a unix timestamp, None if the token doesn't say
+        """
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def get(self, name: str, min_ttl: float = 0) -> Optional[str]:
+        """
+        Returns the cached token if it stays valid for at least min_ttl seconds
+        """
+        token = self.tokens.get(name)
+        if token is None:
+            return None
+
+        expires_at = self.expires_at(token)
+        if expires_at is not None and expires_at - time.time() < min_ttl:
+            return None
+        return token
+
+    def set(self, name: str, token: str):
+        with self.lock:
+            if self.tokens.get(name) == token:
+                return
+
+            self.tokens[name] = token
+            self._persist()
+
+    def delete(self, name: str):
+        with self.lock:
+            if self.tokens.pop(name, None) is not None:
+                self._persist()
+
+    def _persist(self):
+        try:
+            self._write()
+        except OSError as e:
+            logger.warning(f"Failed to persist token cache {self.path}: {e}")
@@ -0,0 +1,26 @@
+import functools
+import logging
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+ENCODING_NAME = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        # the encoding is downloaded on first use, without it token counts are estimated
+        logger.warning(f"Failed to load tiktoken encoding {ENCODING_NAME}, estimating token counts: {str(e)}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+
+    return len(encoding.encode(text, disallowed_special=()))
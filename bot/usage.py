@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+
+import tokenizer
+
+logger = logging.getLogger(__name__)
+
+
+class UsageTracker:
+    """
+    Counts prompt and completion tokens in the background and keeps the totals in memory.
+    Every flush_interval seconds the totals are written to Mongo as one batch of $inc updates
+    per user, per dialog and per chat mode
+    """
+
+    def __init__(self, db, flush_interval: float = 30):
+        self.db = db
+        self.flush_interval = flush_interval
+
+        self.queue = asyncio.Queue()
+        self.user_increments = defaultdict(lambda: defaultdict(int))
+        self.dialog_increments = defaultdict(lambda: defaultdict(int))
+        self.chat_mode_increments = defaultdict(lambda: defaultdict(int))
+
+        self.flush_lock = asyncio.Lock()
+        self.count_task: Optional[asyncio.Task] = None
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.count_task = asyncio.create_task(self._count_forever())
+        self.flush_task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self.count_task is not None:
+            # the count task finishes the batch it is counting and everything queued before None
+            self.queue.put_nowait(None)
+            await self.count_task
+            self.count_task = None
+
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+
+        # count whatever was recorded since and write everything out
+        records = []
+        while not self.queue.empty():
+            records.append(self.queue.get_nowait())
+        if len(records) > 0:
+            self._accumulate(records, await asyncio.to_thread(self._count_records, records))
+        await self.flush()
+
+    def record(self, user_id: int, dialog_id: str, chat_mode: str, prompt: str, completion: str):
+        self.queue.put_nowait((user_id, dialog_id, chat_mode, prompt, completion))
+
+    @staticmethod
+    def _count_records(records: list) -> list:
+        return [
+            (tokenizer.count_tokens(prompt), tokenizer.count_tokens(completion))
+            for _, _, _, prompt, completion in records
+        ]
+
+    def _accumulate(self, records: list, token_counts: list):
+        for (user_id, dialog_id, chat_mode, _, _), (n_prompt_tokens, n_completion_tokens) in zip(records, token_counts):
+            n_tokens = n_prompt_tokens + n_completion_tokens
+
+            user_increments = self.user_increments[user_id]
+            user_increments["n_used_tokens"] += n_tokens
+            user_increments["n_prompt_tokens"] += n_prompt_tokens
+            user_increments["n_completion_tokens"] += n_completion_tokens
+            user_increments[f"n_used_tokens_by_chat_mode.{chat_mode}"] += n_tokens
+
+            dialog_increments = self.dialog_increments[dialog_id]
+            dialog_increments["n_prompt_tokens"] += n_prompt_tokens
+            dialog_increments["n_completion_tokens"] += n_completion_tokens
+
+            chat_mode_increments = self.chat_mode_increments[chat_mode]
+            chat_mode_increments["n_requests"] += 1
+            chat_mode_increments["n_prompt_tokens"] += n_prompt_tokens
+            chat_mode_increments["n_completion_tokens"] += n_completion_tokens
+
+    async def _count_forever(self):
+        stopping = False
+        while not stopping:
+            records = [await self.queue.get()]
+            while not self.queue.empty():
+                records.append(self.queue.get_nowait())
+
+            # None is queued by stop()
+            stopping = None in records
+            records = [record for record in records if record is not None]
+            if len(records) == 0:
+                continue
+
+            try:
+                token_counts = await asyncio.to_thread(self._count_records, records)
+            except Exception as e:
+                logger.exception(f"Failed to count tokens: {str(e)}")
+                continue
+            self._accumulate(records, token_counts)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # a flush in flight completes even when stop() cancels this task, stop() waits for it on the lock
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                logger.exception(f"Failed to flush token usage: {str(e)}")
+
+    @staticmethod
+    def _merge(increments: defaultdict, unwritten_increments: dict):
+        for key, counters in unwritten_increments.items():
+            for field, value in counters.items():
+                increments[key][field] += value
+
+    async def flush(self):
+        async with self.flush_lock:
+            if len(self.user_increments) == 0 and len(self.chat_mode_increments) == 0:
+                return
+
+            user_increments, self.user_increments = self.user_increments, defaultdict(lambda: defaultdict(int))
+            dialog_increments, self.dialog_increments = self.dialog_increments, defaultdict(lambda: defaultdict(int))
+            chat_mode_increments, self.chat_mode_increments = (
+                self.chat_mode_increments, defaultdict(lambda: defaultdict(int))
+            )
+
+            try:
+                await self.db.add_usage(user_increments, dialog_increments, chat_mode_increments)
+            except Exception:
+                # $inc isn't idempotent, add_usage clears what it wrote and only the rest is retried on the next flush
+                self._merge(self.user_increments, user_increments)
+                self._merge(self.dialog_increments, dialog_increments)
+                self._merge(self.chat_mode_increments, chat_mode_increments)
+                raise
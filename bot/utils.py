@@ -1,15 +1,136 @@
 import asyncio
+import contextlib
+import functools
+import logging
+from typing import Optional
 
-from telegram import Update
+from telegram import Bot, Update
 from telegram.constants import ChatAction
-from telegram.ext import ContextTypes
 
+logger = logging.getLogger(__name__)
 
-async def send_typing_periodically(update: Update, context: ContextTypes.DEFAULT_TYPE, every_seconds: float):
+# Telegram allows 4096 characters per message, keep a margin for the "..." suffix and markup
+MESSAGE_PAGE_SIZE = 4000
+PAGE_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+async def iterate_async(items):
+    for item in items:
+        yield item
+
+
+def find_page_end(text: str, page_size: int = MESSAGE_PAGE_SIZE) -> int:
     """
-    Sends the typing action periodically to the chat
+    Returns where the first page of text ends, preferring paragraph, line, sentence and word boundaries.
+    The result only depends on text[:page_size], so it stays the same while a streamed answer keeps growing
     """
-    while True:
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        # await update.message.chat.send_action(action=ChatAction.TYPING)
-        await asyncio.sleep(every_seconds)
+    if len(text) <= page_size:
+        return len(text)
+
+    window = text[:page_size]
+    for separator in PAGE_SEPARATORS:
+        position = window.rfind(separator)
+        if position > page_size // 2:
+            return position + len(separator)
+
+    return page_size
+
+
+def split_text(text: str, page_size: int = MESSAGE_PAGE_SIZE) -> list:
+    pages = []
+    while len(text) > page_size:
+        page_end = find_page_end(text, page_size)
+        pages.append(text[:page_end].strip())
+        text = text[page_end:]
+    pages.append(text.strip())
+
+    return [page for page in pages if len(page) > 0]
+
+
+class TypingTicker:
+    """
+    Keeps the typing action visible in every registered chat from a single timer.
+    Chats are reference counted, so overlapping requests in one chat share one indicator
+    """
+
+    def __init__(self, every_seconds: float = 4):
+        self.every_seconds = every_seconds
+        self.chats = {}
+        self.bot: Optional[Bot] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def register(self, chat_id: int):
+        self.chats[chat_id] = self.chats.get(chat_id, 0) + 1
+        if self.chats[chat_id] == 1:
+            # show the indicator right away instead of waiting for the next tick
+            asyncio.create_task(self._send_typing(chat_id))
+
+    def unregister(self, chat_id: int):
+        n_registrations = self.chats.get(chat_id, 0) - 1
+        if n_registrations > 0:
+            self.chats[chat_id] = n_registrations
+        else:
+            self.chats.pop(chat_id, None)
+
+    async def _send_typing(self, chat_id: int):
+        try:
+            await self.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e:
+            logger.debug("Failed to send typing action to chat %s: %s", chat_id, e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.every_seconds)
+            await asyncio.gather(*[self._send_typing(chat_id) for chat_id in list(self.chats)])
+
+
+class ChatSequencer:
+    """
+    Keeps updates from one chat in order when the application processes updates concurrently.
+    Wrapped callbacks hold a per-chat lock, and asyncio locks wake their waiters first-in, first-out
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.n_waiters = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_id: int):
+        """
+        Holds the chat's turn, for work on a chat that doesn't come from an update
+        """
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        self.n_waiters[chat_id] = self.n_waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.n_waiters[chat_id] -= 1
+            if self.n_waiters[chat_id] == 0:
+                del self.n_waiters[chat_id]
+                del self.locks[chat_id]
+
+    def wrap(self, callback):
+        @functools.wraps(callback)
+        async def sequential_callback(update: Update, context):
+            chat_id = update.effective_chat.id if update.effective_chat is not None else None
+            if chat_id is None:
+                return await callback(update, context)
+
+            async with self.hold(chat_id):
+                return await callback(update, context)
+
+        return sequential_callback
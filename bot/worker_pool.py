@@ -0,0 +1,72 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    Runs blocking calls on a bounded thread pool so they never block the event loop.
+    At most max_workers calls run at once, the rest wait in an asyncio queue that is visible in stats()
+    """
+
+    def __init__(self, name: str, max_workers: int, timeout: float = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.semaphore = asyncio.Semaphore(max_workers)
+
+        self.n_queued = 0
+        self.n_running = 0
+        self.n_completed = 0
+        self.n_failed = 0
+        self.n_timeouts = 0
+
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        timeout = timeout or self.timeout
+
+        self.n_queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.n_queued -= 1
+
+        self.n_running += 1
+        # the call runs in a copy of the caller's context, so what it logs carries the request id
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+        # the slot is held until the thread really finishes, even if the caller timed out
+        future.add_done_callback(self._release)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.n_timeouts += 1
+            logger.warning(f"{self.name} call timed out after {timeout} seconds, {self.stats()}")
+            raise TimeoutError(f"{self.name} call timed out after {timeout} seconds")
+
+    def _release(self, future: asyncio.Future):
+        self.n_running -= 1
+        if future.cancelled() or future.exception() is not None:
+            self.n_failed += 1
+        else:
+            self.n_completed += 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.n_queued,
+            "running": self.n_running,
+            "completed": self.n_completed,
+            "failed": self.n_failed,
+            "timeouts": self.n_timeouts,
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
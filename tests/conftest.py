@@ -0,0 +1,30 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+repository_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the bot's modules import each other as top level modules, as when bot/bot.py is run
+sys.path.insert(0, os.path.join(repository_dir, "bot"))
+
+# tests run with the example config, without background writers, summaries and archival
+config_dir = tempfile.mkdtemp(prefix="chatgpt-telegram-bot-tests-")
+with open(os.path.join(repository_dir, "config", "config.example.yml")) as f:
+    config_yaml = yaml.safe_load(f)
+config_yaml.update({
+    "user_write_behind_interval": 0,
+    "archive_dialogs_after_days": 0,
+    "summarize_after_messages": 0,
+    "log_sample_rates": {},
+})
+with open(os.path.join(config_dir, "config.yml"), "w") as f:
+    yaml.safe_dump(config_yaml, f)
+shutil.copy(os.path.join(repository_dir, "config", "config.example.env"), os.path.join(config_dir, "config.env"))
+os.environ["CONFIG_DIR"] = config_dir
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(config_dir, ignore_errors=True)
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    import pymongo
+    monkeypatch.setattr(pymongo, "MongoClient", mongomock.MongoClient)
+
+    import database
+    return database.Database()
+
+
+def test_unmigrated_long_dialog_is_counted_in_full(db):
+    import config
+
+    async def run():
+        state = await db.load_state(1, 1)
+        await state.commit()
+
+        # a dialog written before the message counter existed, longer than the loaded tail
+        n_messages = config.dialog_messages_tail + 5
+        messages = [{"user": f"question {i}", "bot": f"answer {i}"} for i in range(n_messages)]
+        db.dialog_collection.update_one({"_id": state.dialog_id},
+                                        {"$set": {"messages": messages}, "$unset": {"n_messages": ""}})
+
+        state = await db.load_state(1, 1)
+        assert len(state.get_dialog_messages()) == config.dialog_messages_tail
+        assert state.n_dialog_messages == n_messages
+        assert db.dialog_collection.find_one({"_id": state.dialog_id})["n_messages"] == n_messages
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+import types
+
+from edit_scheduler import EditScheduler
+
+
+class SlowMessage:
+    """
+    A message whose first edit takes longer than the chat edit interval and the edits after it
+    """
+
+    def __init__(self, first_edit_seconds: float):
+        self.chat_id = 1
+        self.message_id = 1
+        self.text = "..."
+        self.edit_seconds = [first_edit_seconds]
+        self.edits = []
+
+    async def edit_text(self, text, **kwargs):
+        edit_seconds = self.edit_seconds.pop() if self.edit_seconds else 0
+        await asyncio.sleep(edit_seconds)
+        self.edits.append(text)
+        return types.SimpleNamespace(text=text)
+
+
+def test_final_edit_waits_for_the_edit_in_flight():
+    async def run():
+        scheduler = EditScheduler(chat_edit_interval=0.01)
+        scheduler.start()
+        message = SlowMessage(first_edit_seconds=0.2)
+        stream = scheduler.register(message)
+
+        scheduler.update(stream, "partial answer")
+        while not stream.editing:
+            await asyncio.sleep(0.01)
+        await scheduler.finish(stream, "final answer")
+        await scheduler.stop()
+
+        assert message.edits == ["partial answer", "final answer"]
+
+    asyncio.run(run())
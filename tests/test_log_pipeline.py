@@ -0,0 +1,38 @@
+import json
+import logging
+
+import pytest
+
+import log_pipeline
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    root_logger = logging.getLogger()
+    handlers, level = list(root_logger.handlers), root_logger.level
+    monkeypatch.setattr(log_pipeline, "_queue", None)
+    yield log_pipeline.setup_logging
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    for handler in handlers:
+        root_logger.addHandler(handler)
+    root_logger.setLevel(level)
+
+
+def test_category_records_are_sampled_and_stamped(pipeline, capsys):
+    listener = pipeline(log_format="json", sample_rates={"prompt": 0.0}, max_payload_length=10)
+    logger = logging.getLogger("test")
+    token = log_pipeline.request_id.set("42")
+    try:
+        log_pipeline.CategoryLogger(logger, "message").info("Send message to ChatGPT: %s", "a long user message")
+        log_pipeline.CategoryLogger(logger, "prompt").info("Ask ChatGPT: %s", "a prompt that is sampled out")
+        log_pipeline.CategoryLogger(logger, "prompt").log(logging.WARNING, "Prompt rejected: %s", "kept")
+    finally:
+        log_pipeline.request_id.reset(token)
+    listener.stop()
+
+    entries = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert [(entry["category"], entry["request_id"], entry["message"]) for entry in entries] == [
+        ("message", "42", "Send message to ChatGPT: a long use... (9 more characters)"),
+        ("prompt", "42", "Prompt rejected: kept"),
+    ]
@@ -0,0 +1,47 @@
+import utils
+from markdown_renderer import MarkdownPager, MarkdownRenderer
+
+
+def stream(pager: MarkdownPager, chunks: list) -> list:
+    """
+    Feeds the growing answer chunk by chunk and returns the html and plain text of every page, the last one included
+    """
+    pages = []
+    for chunk_text in chunks:
+        pages += [(page_html, page_text) for page_html, page_text, _ in pager.feed(chunk_text)]
+    pages.append((pager.renderer.finish(), chunks[-1][pager.page_start:].strip()))
+    return pages
+
+
+def test_page_break_inside_rendered_text_is_not_repeated():
+    # the first chunk fits one page, the next one moves the break back to the paragraph break near 3500
+    answer = "a" * 3500 + "\n\n" + "b " * 1500
+    pages = stream(MarkdownPager(), [answer[:3990], answer])
+
+    assert [page_text for _, page_text in pages] == utils.split_text(answer)
+    assert pages[0][0] == "a" * 3500
+    assert pages[1][0] == ("b " * 1500).strip()
+
+
+def test_rerendered_page_keeps_its_code_block():
+    # the empty line in the code block is the page break, the second page continues the block
+    answer = "```python\n" + "x = 1\n" * 580 + "\n" + "y = 2\n" * 300 + "```\n\n" + "c " * 1500
+    pages = stream(MarkdownPager(), [answer[:3990], answer])
+
+    assert [page_text for _, page_text in pages] == utils.split_text(answer)
+    assert pages[1][0].startswith('<pre><code class="language-python">y = 2\n')
+
+    renderer = MarkdownRenderer()
+    for page_html, page_text in pages:
+        renderer.feed(page_text + "\n")
+        assert page_html == renderer.finish()
+        renderer = renderer.continuation()
+
+
+def test_growing_answer_matches_split_text():
+    answer = "".join(f"Paragraph {i}: " + "word " * (i * 37 % 400) + "\n\n" for i in range(60))
+    chunks = [answer[:end] for end in range(0, len(answer), 997)] + [answer]
+
+    pages = stream(MarkdownPager(), chunks)
+
+    assert [page_text for _, page_text in pages] == utils.split_text(answer)
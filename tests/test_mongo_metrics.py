@@ -0,0 +1,35 @@
+import asyncio
+import types
+
+import pytest
+
+import database
+import metrics
+
+
+def test_round_trips_are_attributed_to_the_handler():
+    async def run():
+        db = database.Database()
+        listener = database._RoundTripListener()
+
+        def bulk_write():
+            # what pymongo reports for a call that takes two round trips
+            for _ in range(2):
+                listener.succeeded(types.SimpleNamespace(duration_micros=1500))
+
+        round_trips = metrics.mongo_round_trip_seconds.labels("message_handle")
+        calls = metrics.mongo_call_seconds.labels("message_handle")
+        n_round_trips, round_trip_seconds, n_calls = sum(round_trips.counts), round_trips.sum, sum(calls.counts)
+
+        token = metrics.current_handler.set("message_handle")
+        try:
+            await db._run(bulk_write)
+        finally:
+            metrics.current_handler.reset(token)
+        db.executor.shutdown()
+
+        assert sum(round_trips.counts) - n_round_trips == 2
+        assert round_trips.sum - round_trip_seconds == pytest.approx(0.003)
+        assert sum(calls.counts) - n_calls == 1
+
+    asyncio.run(run())
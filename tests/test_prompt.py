@@ -0,0 +1,55 @@
+import asyncio
+
+from backends import Conversation, RevChatGPTBackend
+from chatgpt import CHAT_MODES, ChatGPT
+from session_pool import SessionPool, UpstreamSession
+
+DIALOG_MESSAGES = [{"user": "earlier question", "bot": "earlier answer"}]
+
+
+class FakeClient:
+    def __init__(self):
+        self.prompts = []
+
+    async def ask(self, prompt, conversation_id=None, parent_id=None, timeout=None):
+        self.prompts.append((prompt, conversation_id))
+        yield {"message": "answer", "conversation_id": conversation_id or "new-conversation", "parent_id": "parent"}
+
+
+def test_continued_conversation_gets_the_message_only():
+    for chat_mode in ("normal", "assistant"):
+        prompt, history_prompt = ChatGPT._generate_prompts("question", DIALOG_MESSAGES, chat_mode, True,
+                                                           conversation_id="conversation")
+        assert prompt == "question"
+        assert "earlier answer" in history_prompt
+
+
+def test_new_conversation_gets_the_history():
+    prompt, history_prompt = ChatGPT._generate_prompts("question", DIALOG_MESSAGES, "assistant", True)
+    assert prompt.startswith(CHAT_MODES["assistant"]["prompt_start"])
+    assert "earlier answer" in prompt
+    assert history_prompt is None
+
+    # nothing to set a new conversation up with
+    assert ChatGPT._generate_prompt("question", [], "normal", True) == "question"
+
+
+def test_session_switch_sends_the_history():
+    async def run():
+        clients = {"session-0": FakeClient(), "session-1": FakeClient()}
+        pool = SessionPool([UpstreamSession(name, lambda: None) for name in clients])
+        for session in pool.sessions:
+            session.bot = clients[session.name]
+        backend = RevChatGPTBackend(pool)
+
+        # the session the conversation was started on is out of rotation
+        pool.sessions_by_name["session-0"].disabled_until = float("inf")
+        conversation = Conversation("conversation", "parent", session="session-0")
+        async for _ in backend.ask("question", conversation, history_prompt="history and question"):
+            pass
+
+        assert clients["session-1"].prompts == [("history and question", None)]
+        assert conversation.session == "session-1"
+        assert conversation.conversation_id == "new-conversation"
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import asyncio
+import types
+
+from backends import Conversation
+from chatgpt import ChatGPT
+from edit_scheduler import EditScheduler
+from response_cache import ResponseCache
+from utils import TypingTicker
+
+
+class UnavailableDatabase:
+    async def get_cached_response(self, key: str):
+        raise ConnectionError("MongoDB is down")
+
+    async def set_cached_response(self, key: str, answer: str):
+        raise ConnectionError("MongoDB is down")
+
+
+def test_shared_tier_failures_are_misses_and_skipped_writes():
+    async def run():
+        cache = ResponseCache(["text_improver"], db=UnavailableDatabase())
+        key = cache.make_key("openai", "text_improver", "Fix  this text")
+
+        assert await cache.get(key) is None
+        await cache.set(key, "Fixed text")
+        assert await cache.get(key) == "Fixed text"
+        assert cache.stats() == {"size": 1, "hits": 1, "shared_hits": 0, "misses": 1}
+
+    asyncio.run(run())
+
+
+class StatefulBackend:
+    name = "stateful"
+    is_stateful = True
+
+    def __init__(self):
+        self.prompts = []
+
+    async def ask(self, prompt, conversation, timeout=None, history_prompt=None):
+        self.prompts.append(prompt)
+        conversation.parent_id = f"parent-{len(self.prompts)}"
+        yield "upstream answer"
+
+
+class FakeBot:
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+    async def send_message(self, chat_id, text, **kwargs):
+        async def edit_text(text, **kwargs):
+            pass
+
+        return types.SimpleNamespace(chat_id=chat_id, message_id=1, text=text, edit_text=edit_text)
+
+
+def test_continued_stateful_conversation_bypasses_the_cache():
+    async def run():
+        cache = ResponseCache(["assistant"])
+        backend = StatefulBackend()
+        await cache.set(cache.make_key(backend.name, "assistant", "question"), "cached answer")
+
+        typing_ticker = TypingTicker()
+        typing_ticker.bot = FakeBot()
+        chatgpt = ChatGPT(backend=backend, edit_scheduler=EditScheduler(), typing_ticker=typing_ticker,
+                          response_cache=cache)
+        update = types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=1),
+                                       message=types.SimpleNamespace(message_id=1))
+        conversation = Conversation("conversation", "parent-0")
+
+        answer, _ = await chatgpt.async_send_message(update, types.SimpleNamespace(bot=FakeBot()), "question",
+                                                     chat_mode="assistant", conversation=conversation)
+        assert answer == "upstream answer"
+        assert backend.prompts == ["question"]
+        assert conversation.parent_id == "parent-1"
+
+    asyncio.run(run())
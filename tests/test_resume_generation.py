@@ -0,0 +1,192 @@
+import asyncio
+import types
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+
+class BlockingBackend:
+    """
+    Never answers, like an upstream that is still thinking when the process shuts down
+    """
+
+    name = "blocking"
+    is_stateful = False
+
+    async def ask(self, prompt, conversation, timeout=None, history_prompt=None):
+        await asyncio.Event().wait()
+        yield ""
+
+
+class CannedBackend:
+    name = "canned"
+    is_stateful = False
+
+    def __init__(self, answer: str):
+        self.answer = answer
+
+    async def ask(self, prompt, conversation, timeout=None, history_prompt=None):
+        yield self.answer
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent_messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent_messages.append((chat_id, text))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.sent_messages.append((chat_id, text))
+
+
+def make_update(user_id: int, text: str, update_id: int):
+    async def reply_text(text, **kwargs):
+        pass
+
+    user = types.SimpleNamespace(id=user_id, username="user", first_name="First", last_name="Last")
+    message = types.SimpleNamespace(from_user=user, text=text, message_id=update_id, reply_text=reply_text)
+    return types.SimpleNamespace(update_id=update_id, message=message, edited_message=None,
+                                 effective_chat=types.SimpleNamespace(id=user_id))
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    import pymongo
+    monkeypatch.setattr(pymongo, "MongoClient", mongomock.MongoClient)
+
+    import bot
+    # every test gets a fresh in-memory database
+    monkeypatch.setattr(bot, "db", bot.database.Database())
+    return bot
+
+
+async def crash(bot, handler, update):
+    """
+    Runs the handler until its answer is being generated, then drops it as if the process was killed
+    """
+    handling = asyncio.create_task(handler(update, types.SimpleNamespace(bot=FakeBot())))
+    while len(bot.db.generation_journal.pending) == 0:
+        await asyncio.sleep(0.01)
+    # what the journal would have written before the process was killed
+    (generation_id, checkpoint), = bot.db.generation_journal.pending.items()
+
+    handling.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await handling
+    return {"_id": generation_id, **checkpoint}
+
+
+def test_crashed_retry_is_regenerated(bot, monkeypatch):
+    async def run():
+        state = await bot.db.load_state(1, 1)
+        for i in range(2):
+            state.add_dialog_message({"user": f"question {i}", "bot": f"answer {i}", "parent_id": None}, None)
+        await state.commit()
+
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: BlockingBackend())
+        checkpoint = await crash(bot, bot.retry_handle, make_update(1, "/retry", 10))
+
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: CannedBackend("regenerated answer"))
+        telegram_bot = FakeBot()
+        await bot.resume_generation(telegram_bot, checkpoint)
+
+        state = await bot.db.load_state(1, 1)
+        assert [message["bot"] for message in state.get_dialog_messages()] == ["answer 0", "regenerated answer"]
+        assert telegram_bot.sent_messages == [(1, "regenerated answer")]
+
+    asyncio.run(run())
+
+
+def test_crashed_first_message_is_saved(bot, monkeypatch):
+    async def run():
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: BlockingBackend())
+        checkpoint = await crash(bot, bot.message_handle, make_update(2, "first question", 20))
+
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: CannedBackend("first answer"))
+        await bot.resume_generation(FakeBot(), checkpoint)
+
+        state = await bot.db.load_state(2, 2)
+        assert state.dialog_id == checkpoint["dialog_id"]
+        assert [message["bot"] for message in state.get_dialog_messages()] == ["first answer"]
+
+    asyncio.run(run())
+
+
+class StallingBackend:
+    """
+    Streams the first chunk, then keeps thinking until it is stopped
+    """
+
+    name = "stalling"
+    is_stateful = False
+
+    def __init__(self, first_chunk: str):
+        self.first_chunk = first_chunk
+
+    async def ask(self, prompt, conversation, timeout=None, history_prompt=None):
+        if self.first_chunk:
+            yield self.first_chunk
+        await asyncio.Event().wait()
+        yield ""
+
+
+class StreamingBot:
+    """
+    Keeps the text every sent message shows after its edits
+    """
+
+    def __init__(self):
+        self.texts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        index = len(self.texts)
+        self.texts.append(text)
+
+        async def edit_text(text, **kwargs):
+            self.texts[index] = text
+
+        return types.SimpleNamespace(chat_id=chat_id, message_id=index, text=text, edit_text=edit_text)
+
+
+async def stop(bot, update):
+    telegram_bot = StreamingBot()
+    handling = asyncio.create_task(bot.message_handle(update, types.SimpleNamespace(bot=telegram_bot)))
+
+    async def started():
+        while bot.generation_registry.get(update.effective_chat.id) is None:
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(started(), timeout=5)
+    # the first chunk, if there is one, is streamed before the stop
+    await asyncio.sleep(0.05)
+
+    bot.generation_registry.stop(update.effective_chat.id)
+    await asyncio.wait_for(handling, timeout=5)
+    return telegram_bot
+
+
+def test_stopped_answer_keeps_the_streamed_part(bot, monkeypatch):
+    async def run():
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: StallingBackend("partial answer"))
+        telegram_bot = await stop(bot, make_update(3, "question", 30))
+        assert telegram_bot.texts == ["partial answer"]
+
+        state = await bot.db.load_state(3, 3)
+        dialog_message, = state.get_dialog_messages()
+        assert dialog_message["bot"] == "partial answer"
+        assert dialog_message["stopped"]
+
+    asyncio.run(run())
+
+
+def test_answer_stopped_before_the_first_chunk_is_not_saved(bot, monkeypatch):
+    async def run():
+        monkeypatch.setattr(bot, "get_completion_backend", lambda chat_mode: StallingBackend(""))
+        await stop(bot, make_update(4, "question", 40))
+
+        state = await bot.db.load_state(4, 4)
+        assert state.get_dialog_messages() == []
+        assert state.n_dialog_messages == 0
+
+    asyncio.run(run())
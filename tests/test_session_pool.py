@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+
+from backends import RevChatGPTAccount
+from session_pool import SessionPool, UpstreamSession
+from token_cache import TokenCache
+
+
+class UpstreamError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"status {code}")
+        self.code = code
+
+
+# a day from now, tokens made by one test compare equal
+TOKEN_EXPIRES_AT = int(time.time()) + 86400
+
+
+def make_token(name: str) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": TOKEN_EXPIRES_AT, "name": name}).encode()).decode()
+    return f"header.{payload.rstrip('=')}.signature"
+
+
+class FakeClient:
+    """
+    Logs in with the password unless it is given an access token
+    """
+
+    n_logins = 0
+
+    def __init__(self, config: dict):
+        self.config = config
+        if "access_token" not in config:
+            FakeClient.n_logins += 1
+            self.config["access_token"] = make_token(f"login-{FakeClient.n_logins}")
+
+
+def make_pool(n_sessions: int) -> SessionPool:
+    return SessionPool([UpstreamSession(f"session-{i}", lambda: None) for i in range(n_sessions)], cooldown=60)
+
+
+async def fail(pool: SessionPool, error: Exception, preferred: str = None):
+    with pytest.raises(type(error)):
+        async with pool.session(preferred):
+            raise error
+
+
+def test_bad_answers_keep_the_session_in_rotation():
+    async def run():
+        pool = make_pool(2)
+        for _ in range(pool.max_errors - 1):
+            await fail(pool, ValueError("ChatGPT Bot error: empty answer"), preferred="session-0")
+        assert pool.sessions[0].enabled
+
+        await fail(pool, ValueError("ChatGPT Bot error: empty answer"), preferred="session-0")
+        assert not pool.sessions[0].enabled
+
+    asyncio.run(run())
+
+
+def test_rate_limited_session_backs_off():
+    async def run():
+        pool = make_pool(2)
+        await fail(pool, UpstreamError(429), preferred="session-0")
+        first_disabled_until = pool.sessions[0].disabled_until
+
+        pool.sessions[0].disabled_until = 0
+        await fail(pool, UpstreamError(429), preferred="session-0")
+        assert pool.sessions[0].disabled_until - first_disabled_until == pytest.approx(60, abs=1)
+
+        pool.sessions[0].disabled_until = 0
+        async with pool.session("session-0"):
+            pass
+        assert pool.sessions[0].n_cooldowns == 0
+
+    asyncio.run(run())
+
+
+def test_last_session_stays_in_rotation():
+    async def run():
+        pool = make_pool(1)
+        for _ in range(pool.max_errors + 1):
+            await fail(pool, UpstreamError(401))
+        assert pool.sessions[0].enabled
+
+        async with pool.session() as session:
+            assert session is pool.sessions[0]
+
+    asyncio.run(run())
+
+
+def test_rejected_token_is_dropped_and_logged_in_again(tmp_path):
+    async def run():
+        token_cache = TokenCache(str(tmp_path / "tokens.json"))
+        # revoked upstream, but its expiry says it is still valid
+        token_cache.set("user@example.com", make_token("revoked"))
+        account = RevChatGPTAccount("user@example.com", "password", FakeClient, token_cache)
+        pool = SessionPool([
+            UpstreamSession(account.email, account.create_client, drop_credentials=account.drop_token)
+        ])
+
+        async with pool.session() as session:
+            assert (await session.get_bot()).config["access_token"] == make_token("revoked")
+        assert FakeClient.n_logins == 0
+
+        await fail(pool, UpstreamError(401))
+
+        async with pool.session() as session:
+            assert (await session.get_bot()).config["access_token"] == make_token("login-1")
+        assert FakeClient.n_logins == 1
+        assert TokenCache(str(tmp_path / "tokens.json")).get(account.email) == make_token("login-1")
+
+    asyncio.run(run())
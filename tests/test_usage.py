@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import database
+from usage import UsageTracker
+
+
+class FlakyDatabase:
+    """
+    Writes the user counters, then fails on the dialog counters the first time
+    """
+
+    def __init__(self):
+        self.n_calls = 0
+        self.written = {"user": {}, "dialog": {}, "chat_mode": {}}
+
+    async def add_usage(self, user_increments: dict, dialog_increments: dict, chat_mode_increments: dict):
+        self.n_calls += 1
+        for name, increments in (("user", user_increments), ("dialog", dialog_increments),
+                                 ("chat_mode", chat_mode_increments)):
+            if name == "dialog" and self.n_calls == 1:
+                raise ConnectionError("MongoDB is down")
+            for key, counters in increments.items():
+                written_counters = self.written[name].setdefault(key, {})
+                for field, value in counters.items():
+                    written_counters[field] = written_counters.get(field, 0) + value
+            increments.clear()
+
+
+def test_failed_flush_keeps_unwritten_counters():
+    async def run():
+        db = FlakyDatabase()
+        tracker = UsageTracker(db, flush_interval=3600)
+        tracker.start()
+        tracker.record(1, "dialog", "assistant", "prompt", "completion")
+        with pytest.raises(ConnectionError):
+            await tracker.stop()
+
+        # the next flush writes the rest without counting the user twice
+        await tracker.flush()
+        dialog_counters = db.written["dialog"]["dialog"]
+        assert dialog_counters["n_prompt_tokens"] > 0
+        assert db.written["user"][1]["n_used_tokens"] == (
+            dialog_counters["n_prompt_tokens"] + dialog_counters["n_completion_tokens"]
+        )
+        assert db.written["chat_mode"]["assistant"] == {"n_requests": 1, **dialog_counters}
+
+    asyncio.run(run())
+
+
+class PartlyFailingCollection:
+    """
+    Applies every update of a bulk_write but the second one, like an unordered bulk_write with one write error
+    """
+
+    def __init__(self):
+        self.applied = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.applied += [request._filter["_id"] for i, request in enumerate(requests) if i != 1]
+        raise BulkWriteError({
+            "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}],
+            "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0, "nMatched": len(requests) - 1,
+            "nModified": len(requests) - 1, "nRemoved": 0, "upserted": [],
+        })
+
+
+def test_partly_failed_bulk_write_keeps_only_the_failed_counters():
+    db = database.Database()
+    db.user_collection = PartlyFailingCollection()
+    user_increments = {user_id: {"n_used_tokens": 10} for user_id in (1, 2, 3)}
+
+    with pytest.raises(BulkWriteError):
+        db._add_usage(user_increments, {}, {})
+    db.executor.shutdown()
+
+    assert db.user_collection.applied == [1, 3]
+    assert user_increments == {2: {"n_used_tokens": 10}}